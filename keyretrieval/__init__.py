@@ -34,20 +34,27 @@
 #
 # ***** END LICENSE BLOCK *****
 
-
-from mozsvc.config import get_configurator
-from mozsvc.plugin import load_and_register
+# The web framework is only imported when the app is actually built, so
+# that command-line tools using the storage backends start up quickly.
 
 
 def includeme(config):
+    from mozsvc.plugin import load_and_register
     config.include("pyramid_multiauth")
     config.include("cornice")
     config.include("mozsvc")
-    load_and_register("storage", config)
+    config.include("keyretrieval.metrics")
+    config.include("keyretrieval.ratelimit")
+    store = load_and_register("storage", config)
+    if "metrics" in config.registry:
+        from keyretrieval.metrics import instrument_storage
+        instrument_storage(store, config.registry["metrics"])
+    config.include("keyretrieval.changes")
     config.scan("keyretrieval.views")
 
 
 def main(global_config, **settings):
+    from mozsvc.config import get_configurator
     config = get_configurator(global_config, **settings)
     config.include(includeme)
     return config.make_wsgi_app()
@@ -0,0 +1,258 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Benchmarks for the key-retrieval service.
+
+These are not run as part of the test suite.  Each submodule can be run
+as a script, e.g.::
+
+    python -m keyretrieval.benchmarks.bulk --count 10000
+
+The load-testing benchmarks (storage, views) run a matrix of read/write
+mixes, payload sizes and concurrency levels, printing a summary table and
+optionally writing the full results as JSON so that they can be compared
+between runs::
+
+    python -m keyretrieval.benchmarks.views --output results.json
+
+"""
+
+import os
+import sys
+import time
+import random
+import optparse
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+@contextmanager
+def temp_sqlite_uri():
+    """Context manager yielding the sqluri of a temporary sqlite file."""
+    fd, filename = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        yield "sqlite:///" + filename
+    finally:
+        os.unlink(filename)
+
+
+def time_call(func, *args, **kwds):
+    """Call the given function, returning the time taken in seconds."""
+    start = time.time()
+    func(*args, **kwds)
+    return time.time() - start
+
+
+def print_rate(name, count, elapsed):
+    """Print a one-line summary of operations per second."""
+    rate = count / elapsed if elapsed > 0 else float("inf")
+    print "%-30s %8d ops in %7.3fs  %10.1f ops/sec" % (name, count,
+                                                        elapsed, rate)
+
+
+def percentile(sorted_values, fraction):
+    """Get the given percentile from an already-sorted list of values."""
+    if not sorted_values:
+        return 0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    """Summarize a list of per-operation latencies, in seconds."""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "ops": count,
+        "elapsed": elapsed,
+        "ops_per_sec": count / elapsed if elapsed > 0 else 0,
+        "mean_ms": sum(latencies) * 1000 / count if count else 0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run_threads(target, count):
+    """Run count copies of target(n) in threads, waiting for them all."""
+    threads = [threading.Thread(target=target, args=(n,))
+               for n in xrange(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_workload(read, write, read_ratio, concurrency, num_ops, num_users,
+                 run_concurrently=run_threads):
+    """Run a mix of reads and writes from several threads.
+
+    The "read" and "write" arguments are callables taking a userid.  Each
+    of "concurrency" threads performs its share of "num_ops" operations on
+    randomly-chosen userids, picking a read with probability "read_ratio".
+    Returns a summary dict as produced by summarize().
+
+    Threads are started using the "run_concurrently" function, which can
+    be replaced to use e.g. greenlets instead; see run_threads().
+    """
+    latencies = []
+    errors = []
+
+    def worker(seed):
+        rand = random.Random(seed)
+        local_latencies = []
+        try:
+            for i in xrange(num_ops // concurrency):
+                userid = "user%d" % (rand.randrange(num_users),)
+                if rand.random() < read_ratio:
+                    op = read
+                else:
+                    op = write
+                start = time.time()
+                op(userid)
+                local_latencies.append(time.time() - start)
+        except Exception, e:
+            errors.append(e)
+        latencies.extend(local_latencies)
+
+    start = time.time()
+    run_concurrently(worker, concurrency)
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    return summarize(latencies, elapsed)
+
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def parse_float_list(value):
+    return [float(item) for item in value.split(",")]
+
+
+def make_option_parser(**defaults):
+    """Make an OptionParser for the load-testing benchmark options."""
+    parser = optparse.OptionParser()
+    parser.add_option("--ops", type="int", default=2000,
+                      help="number of operations per run")
+    parser.add_option("--users", type="int", default=1000,
+                      help="number of distinct userids to operate on")
+    parser.add_option("--read-ratios", default="1.0,0.9,0.5",
+                      help="comma-separated fractions of reads in the mix")
+    parser.add_option("--payload-sizes", default="64,1024,8192",
+                      help="comma-separated payload sizes in bytes")
+    parser.add_option("--concurrency", default="1,4,16",
+                      help="comma-separated numbers of client threads")
+    parser.add_option("--sqluri", default=None,
+                      help="database to use; defaults to a temp sqlite file")
+    parser.add_option("--output", default=None,
+                      help="file to write JSON results to; '-' for stdout")
+    parser.set_defaults(**defaults)
+    return parser
+
+
+def run_matrix(name, setup, opts):
+    """Run a benchmark across the matrix of options given on command-line.
+
+    The "setup" argument is a callable taking a sqluri and returning a
+    tuple of (populate, read, write) callables; populate takes a list of
+    (userid, data) pairs and is called before each run, while read and
+    write take a userid, with write storing a payload of "payload_size"
+    bytes that is passed to setup as a keyword argument.
+    """
+    results = []
+    # Keep the summary table out of the way of JSON written to stdout.
+    if opts.output == "-":
+        out = sys.stderr
+    else:
+        out = sys.stdout
+    header = ("bench", "reads", "payload", "conc", "ops/sec", "p50 ms",
+              "p99 ms")
+    print >> out, "%-8s %6s %8s %5s %10s %9s %9s" % header
+    for payload_size in parse_int_list(opts.payload_sizes):
+        for read_ratio in parse_float_list(opts.read_ratios):
+            for concurrency in parse_int_list(opts.concurrency):
+                with _maybe_temp_sqlite_uri(opts.sqluri) as sqluri:
+                    populate, read, write = setup(sqluri,
+                                                  payload_size=payload_size)
+                    data = "X" * payload_size
+                    populate([("user%d" % (i,), data)
+                              for i in xrange(opts.users)])
+                    summary = run_workload(read, write, read_ratio,
+                                           concurrency, opts.ops, opts.users)
+                summary.update({
+                    "benchmark": name,
+                    "read_ratio": read_ratio,
+                    "payload_size": payload_size,
+                    "concurrency": concurrency,
+                })
+                results.append(summary)
+                print >> out, "%-8s %6.2f %8d %5d %10.1f %9.3f %9.3f" % (
+                    name, read_ratio, payload_size, concurrency,
+                    summary["ops_per_sec"], summary["p50_ms"],
+                    summary["p99_ms"])
+    if opts.output is not None:
+        write_results(results, opts.output)
+    return results
+
+
+def write_results(results, filename):
+    """Write a list of result dicts to the named file as JSON."""
+    output = {"python": sys.version.split()[0], "time": time.time(),
+              "results": results}
+    if filename == "-":
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(filename, "w") as f:
+            json.dump(output, f, indent=2)
+
+
+@contextmanager
+def _maybe_temp_sqlite_uri(sqluri):
+    if sqluri is not None:
+        yield sqluri
+    else:
+        with temp_sqlite_uri() as sqluri:
+            yield sqluri
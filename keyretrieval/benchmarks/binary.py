@@ -0,0 +1,166 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Compare text and binary data columns through the full WSGI application.
+
+For each of the text and binary storage modes, and for reads and writes
+separately, a fresh process serves a burst of requests with payloads of
+"payload_size" bytes (the 8KB maximum by default) and reports latency,
+CPU time per request and the growth in peak memory use while serving.
+Python 2 has no allocation tracer, so the CPU time and peak memory stand
+in for the cost of copying and re-encoding the payload.
+
+Request bodies are given to the application as an unbuffered stream, as
+they would be by a real server.  Use --compress to store the payloads
+compressed, where the binary column also avoids base64.
+
+"""
+
+import resource
+import multiprocessing
+from StringIO import StringIO
+
+from webob import Request
+
+from keyretrieval import main as make_app
+from keyretrieval.storage import IKeyRetrievalStorage
+from keyretrieval.benchmarks import (make_option_parser, run_workload,
+                                     temp_sqlite_uri, write_results,
+                                     parse_int_list)
+from keyretrieval.benchmarks.views import get_settings
+
+
+def make_payload(size):
+    """Make a payload resembling a JSON document of the given size."""
+    prefix = '{"key": "'
+    return prefix + "A" * (size - len(prefix) - 2) + '"}'
+
+
+def _get_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _get_peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_child(queue, sqluri, binary, compress, op, data, opts, concurrency):
+    """Serve one burst of requests, putting a summary dict on the queue."""
+    settings = get_settings(sqluri)
+    settings["storage.binary"] = binary
+    settings["storage.compress"] = compress
+    app = make_app({}, **settings)
+    store = app.registry.getUtility(IKeyRetrievalStorage)
+    store.set_many([("user%d" % (i,), data) for i in xrange(opts.users)])
+
+    def read(userid):
+        request = Request.blank("/" + userid)
+        request.environ["REMOTE_USER"] = userid
+        response = request.get_response(app)
+        if response.status_int != 200:
+            raise RuntimeError("GET failed: %s" % (response.status,))
+
+    def write(userid):
+        request = Request.blank("/" + userid, method="PUT")
+        request.environ["REMOTE_USER"] = userid
+        request.environ["wsgi.input"] = StringIO(data)
+        request.environ.pop("webob.is_body_seekable", None)
+        request.content_length = len(data)
+        request.content_type = "text/plain"
+        response = request.get_response(app)
+        if response.status_int != 204:
+            raise RuntimeError("PUT failed: %s" % (response.status,))
+
+    # Warm up the code paths, so that their setup isn't counted.
+    read("user0")
+    write("user0")
+    start_cpu = _get_cpu_time()
+    start_rss = _get_peak_rss_kb()
+    if op == "read":
+        summary = run_workload(read, None, 1, concurrency, opts.ops,
+                               opts.users)
+    else:
+        summary = run_workload(None, write, 0, concurrency, opts.ops,
+                               opts.users)
+    summary["cpu_ms_per_op"] = (_get_cpu_time() - start_cpu) * 1000 / \
+                               summary["ops"]
+    summary["peak_rss_growth_kb"] = _get_peak_rss_kb() - start_rss
+    queue.put(summary)
+
+
+def main(args=None):
+    parser = make_option_parser(payload_sizes="8192", concurrency="1,16")
+    parser.add_option("--compress", action="store_true", default=False,
+                      help="store the payloads compressed")
+    opts, args = parser.parse_args(args)
+    results = []
+    print "%-7s %-6s %5s %10s %9s %9s %8s %8s" % (
+        "column", "op", "conc", "ops/sec", "p50 ms", "p99 ms", "cpu ms",
+        "rss KB")
+    for payload_size in parse_int_list(opts.payload_sizes):
+        data = make_payload(payload_size)
+        for concurrency in parse_int_list(opts.concurrency):
+            for op in ("read", "write"):
+                for binary in (False, True):
+                    with temp_sqlite_uri() as sqluri:
+                        queue = multiprocessing.Queue()
+                        args = (queue, opts.sqluri or sqluri, binary,
+                                opts.compress, op, data, opts, concurrency)
+                        child = multiprocessing.Process(target=run_child,
+                                                        args=args)
+                        child.start()
+                        summary = queue.get()
+                        child.join()
+                    column = binary and "binary" or "text"
+                    summary.update({"benchmark": "binary", "column": column,
+                                    "op": op, "concurrency": concurrency,
+                                    "payload_size": payload_size,
+                                    "compress": opts.compress})
+                    results.append(summary)
+                    print "%-7s %-6s %5d %10.1f %9.3f %9.3f %8.3f %8d" % (
+                        column, op, concurrency, summary["ops_per_sec"],
+                        summary["p50_ms"], summary["p99_ms"],
+                        summary["cpu_ms_per_op"],
+                        summary["peak_rss_growth_kb"])
+    if opts.output is not None:
+        write_results(results, opts.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
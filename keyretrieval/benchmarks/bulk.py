@@ -0,0 +1,93 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Compare bulk storage operations against looping over single-key ones.
+
+"""
+
+import optparse
+
+from keyretrieval.storage.sql import SQLKeyRetrievalStorage
+from keyretrieval.benchmarks import temp_sqlite_uri, time_call, print_rate
+
+
+def run(store, count):
+    items = [("user%d" % (i,), "X" * 256) for i in xrange(count)]
+    userids = [userid for (userid, data) in items]
+
+    def loop_set():
+        for userid, data in items:
+            store.set(userid, data)
+
+    def loop_get():
+        for userid in userids:
+            store.get(userid)
+
+    def loop_delete():
+        for userid in userids:
+            store.delete(userid)
+
+    print_rate("set (loop)", count, time_call(loop_set))
+    print_rate("get (loop)", count, time_call(loop_get))
+    print_rate("delete (loop)", count, time_call(loop_delete))
+    print_rate("set_many", count, time_call(store.set_many, items))
+    print_rate("get_many", count, time_call(store.get_many, userids))
+    print_rate("delete_many", count, time_call(store.delete_many, userids))
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option("--count", type="int", default=5000,
+                      help="number of userids to operate on")
+    parser.add_option("--batch-size", type="int", default=500,
+                      help="number of userids per bulk statement")
+    parser.add_option("--sqluri", default=None,
+                      help="database to use; defaults to a temp sqlite file")
+    opts, args = parser.parse_args(args)
+    if opts.sqluri is not None:
+        store = SQLKeyRetrievalStorage(opts.sqluri, create_tables=True,
+                                       batch_size=opts.batch_size)
+        run(store, opts.count)
+    else:
+        with temp_sqlite_uri() as sqluri:
+            store = SQLKeyRetrievalStorage(sqluri, create_tables=True,
+                                           batch_size=opts.batch_size)
+            run(store, opts.count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Compare thread-per-request against greenlets with a storage thread pool.
+
+Each run holds "concurrency" requests in flight against the SQL storage
+layer, either as that many OS threads calling it directly, or as that many
+greenlets calling it through GeventKeyRetrievalStorage.  The --latency
+option adds an artificial delay to every storage call, to stand in for a
+database on the other end of a network.  Requires gevent.
+
+"""
+
+import time
+
+import gevent
+
+from keyretrieval.storage.sql import SQLKeyRetrievalStorage
+from keyretrieval.storage.green import GeventKeyRetrievalStorage
+from keyretrieval.benchmarks import (make_option_parser, run_workload,
+                                     run_threads, temp_sqlite_uri,
+                                     write_results, parse_int_list,
+                                     parse_float_list)
+
+
+class SlowStorage(object):
+    """Storage wrapper that sleeps before each call."""
+
+    def __init__(self, storage, latency):
+        self.storage = storage
+        self.latency = latency
+
+    def get(self, userid):
+        time.sleep(self.latency)
+        return self.storage.get(userid)
+
+    def set(self, userid, data, if_match=None):
+        time.sleep(self.latency)
+        return self.storage.set(userid, data, if_match)
+
+
+def run_greenlets(target, count):
+    """Run count copies of target(n) in greenlets, waiting for them all."""
+    gevent.joinall([gevent.spawn(target, n) for n in xrange(count)])
+
+
+def main(args=None):
+    parser = make_option_parser(concurrency="10,100,1000", read_ratios="0.9",
+                                payload_sizes="1024")
+    parser.add_option("--latency", type="float", default=2,
+                      help="milliseconds of simulated latency per call")
+    parser.add_option("--threadpool-size", type="int", default=20,
+                      help="size of the thread pool used with greenlets")
+    opts, args = parser.parse_args(args)
+    results = []
+    with temp_sqlite_uri() as sqluri:
+        store = SQLKeyRetrievalStorage(sqluri, create_tables=True)
+        data = "X" * parse_int_list(opts.payload_sizes)[0]
+        store.set_many([("user%d" % (i,), data) for i in xrange(opts.users)])
+        slow_store = SlowStorage(store, opts.latency / 1000.0)
+        green_store = GeventKeyRetrievalStorage(slow_store,
+                        threadpool_size=opts.threadpool_size)
+        read_ratio = parse_float_list(opts.read_ratios)[0]
+        modes = (("threads", slow_store, run_threads),
+                 ("greenlets", green_store, run_greenlets))
+        for concurrency in parse_int_list(opts.concurrency):
+            for mode, target, run_concurrently in modes:
+
+                def write(userid, target=target):
+                    target.set(userid, data)
+
+                summary = run_workload(target.get, write, read_ratio,
+                                       concurrency,
+                                       max(opts.ops, concurrency),
+                                       opts.users, run_concurrently)
+                summary.update({"benchmark": "green", "mode": mode,
+                                "concurrency": concurrency,
+                                "latency_ms": opts.latency})
+                results.append(summary)
+                print "%-10s %5d %10.1f ops/sec %8.3f p50 ms %8.3f p99 ms" % (
+                    mode, concurrency, summary["ops_per_sec"],
+                    summary["p50_ms"], summary["p99_ms"])
+    if opts.output is not None:
+        write_results(results, opts.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
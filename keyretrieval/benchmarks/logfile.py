@@ -0,0 +1,89 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Compare the append-only log backend against SQLite.
+
+Runs the usual matrix of read/write mixes, payload sizes and concurrency
+levels against LogKeyRetrievalStorage and against SQLKeyRetrievalStorage
+on a temporary sqlite file, with each write synced to disk by both.  Use
+--no-sync to let the log backend skip its fsyncs.
+
+"""
+
+import shutil
+import tempfile
+
+from keyretrieval.storage.logfile import LogKeyRetrievalStorage
+from keyretrieval.benchmarks import make_option_parser, run_matrix
+from keyretrieval.benchmarks.storage import setup as setup_sql
+
+
+def main(args=None):
+    parser = make_option_parser()
+    parser.add_option("--no-sync", action="store_false", dest="sync",
+                      default=True, help="don't fsync the log after writes")
+    opts, args = parser.parse_args(args)
+    tmpdirs = []
+    stores = []
+
+    def setup_log(sqluri, payload_size):
+        tmpdirs.append(tempfile.mkdtemp())
+        store = LogKeyRetrievalStorage(tmpdirs[-1], sync=opts.sync)
+        stores.append(store)
+        data = "X" * payload_size
+
+        def read(userid):
+            store.get(userid)
+
+        def write(userid):
+            store.set(userid, data)
+
+        return store.set_many, read, write
+
+    try:
+        results = run_matrix("sqlite", setup_sql, opts)
+        results.extend(run_matrix("log", setup_log, opts))
+    finally:
+        for store in stores:
+            store.close()
+        for tmpdir in tmpdirs:
+            shutil.rmtree(tmpdir)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Compare per-process and shared caches across several worker processes.
+
+Each run starts "workers" processes that read random userids through a
+CachingKeyRetrievalStorage in front of the same sqlite database, either
+with a cache private to each process or with a SharedMemoryCache in a
+file that they all map.  Both have room for twice as many values as
+there are userids, since a shared cache can only hold a few values whose
+userids hash alike.  It reports the overall hit rate, the latency of
+cache hits, the memory held by cached values across all the workers, and
+the average growth in each worker's peak memory use.
+
+"""
+
+import os
+import time
+import random
+import shutil
+import resource
+import tempfile
+import multiprocessing
+
+from keyretrieval.storage.sql import SQLKeyRetrievalStorage
+from keyretrieval.storage.cache import (CachingKeyRetrievalStorage,
+                                        SharedMemoryCache)
+from keyretrieval.benchmarks import (make_option_parser, summarize,
+                                     write_results, parse_int_list)
+
+
+def run_worker(queue, start, seed, sqluri, shared_file, opts):
+    """Read random userids, putting a result dict on the queue."""
+    store = CachingKeyRetrievalStorage(SQLKeyRetrievalStorage(sqluri),
+                                       cache_max_items=opts.users * 2,
+                                       cache_max_bytes=1024 * 1024 * 1024,
+                                       cache_shared_file=shared_file)
+    rand = random.Random(seed)
+    hit_latencies = []
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start.wait()
+    started = time.time()
+    for i in xrange(opts.ops):
+        userid = "user%d" % (rand.randrange(opts.users),)
+        hits = store.hits
+        op_start = time.time()
+        store.get(userid)
+        if store.hits != hits:
+            hit_latencies.append(time.time() - op_start)
+    elapsed = time.time() - started
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({"hits": store.hits, "misses": store.misses,
+               "elapsed": elapsed, "hit_latencies": hit_latencies,
+               "cache_bytes": store.cache.total_bytes,
+               "rss_growth_kb": rss - start_rss})
+
+
+def run(sqluri, shared_file, workers, opts):
+    queue = multiprocessing.Queue()
+    start = multiprocessing.Event()
+    children = [multiprocessing.Process(target=run_worker,
+                                        args=(queue, start, n, sqluri,
+                                              shared_file, opts))
+                for n in xrange(workers)]
+    for child in children:
+        child.start()
+    # Give the workers a moment to set up, so they start together.
+    time.sleep(0.5)
+    start.set()
+    results = [queue.get() for child in children]
+    for child in children:
+        child.join()
+    latencies = []
+    for result in results:
+        latencies.extend(result["hit_latencies"])
+    summary = summarize(latencies, max(r["elapsed"] for r in results))
+    hits = sum(r["hits"] for r in results)
+    summary["hit_rate"] = float(hits) / (hits + sum(r["misses"]
+                                                    for r in results))
+    summary["ops_per_sec"] = workers * opts.ops / summary["elapsed"]
+    if shared_file is None:
+        summary["cache_bytes"] = sum(r["cache_bytes"] for r in results)
+    else:
+        cache = SharedMemoryCache(shared_file, opts.users * 2)
+        summary["cache_bytes"] = cache.total_bytes
+        cache.close()
+    summary["rss_growth_kb"] = sum(r["rss_growth_kb"]
+                                   for r in results) / workers
+    return summary
+
+
+def main(args=None):
+    parser = make_option_parser(payload_sizes="1024,8192")
+    parser.add_option("--workers", default="1,4,8",
+                      help="comma-separated numbers of worker processes")
+    opts, args = parser.parse_args(args)
+    results = []
+    print "%-7s %8s %7s %8s %10s %9s %9s %9s %9s" % (
+        "cache", "payload", "workers", "hit rate", "ops/sec", "hit p50",
+        "hit p99", "cache KB", "rss KB")
+    for payload_size in parse_int_list(opts.payload_sizes):
+        data = "X" * payload_size
+        for workers in parse_int_list(opts.workers):
+            for mode in ("local", "shared"):
+                tmpdir = tempfile.mkdtemp()
+                try:
+                    sqluri = opts.sqluri
+                    if sqluri is None:
+                        sqluri = "sqlite:///" + os.path.join(tmpdir, "db")
+                    store = SQLKeyRetrievalStorage(sqluri,
+                                                   create_tables=True)
+                    store.set_many(("user%d" % (i,), data)
+                                   for i in xrange(opts.users))
+                    shared_file = None
+                    if mode == "shared":
+                        shared_file = os.path.join(tmpdir, "cache")
+                    summary = run(sqluri, shared_file, workers, opts)
+                finally:
+                    shutil.rmtree(tmpdir)
+                summary.update({"benchmark": "sharedcache", "cache": mode,
+                                "payload_size": payload_size,
+                                "workers": workers})
+                results.append(summary)
+                print "%-7s %8d %7d %8.3f %10.1f %9.3f %9.3f %9d %9d" % (
+                    mode, payload_size, workers, summary["hit_rate"],
+                    summary["ops_per_sec"], summary["p50_ms"],
+                    summary["p99_ms"], summary["cache_bytes"] // 1024,
+                    summary["rss_growth_kb"])
+    if opts.output is not None:
+        write_results(results, opts.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
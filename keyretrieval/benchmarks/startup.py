@@ -0,0 +1,188 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Measure how long a fresh process takes to start serving requests.
+
+Each run starts a new python process which imports keyretrieval, builds
+the app with the given storage backend, and serves a single request,
+timing each of these phases.  The median over all runs is reported, along
+with the number of modules imported and whether SQLAlchemy was among
+them.  Authentication is stubbed out with REMOTE_USER.
+
+"""
+
+import os
+import sys
+import shutil
+import optparse
+import tempfile
+import subprocess
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from keyretrieval.benchmarks import write_results
+
+
+# Run in the child process.  It must not import keyretrieval before
+# starting the clock, so it is passed to "python -c" rather than run as
+# a module of this package.
+CHILD_SCRIPT = """
+import sys, time, json
+settings = json.loads(sys.argv[1])
+start = time.time()
+import keyretrieval
+imported = time.time()
+app = keyretrieval.main({}, **settings)
+created = time.time()
+from webob import Request
+request = Request.blank("/user1", environ={"REMOTE_USER": "user1"})
+request.get_response(app)
+served = time.time()
+json.dump({"import_ms": (imported - start) * 1000,
+           "app_factory_ms": (created - imported) * 1000,
+           "first_request_ms": (served - created) * 1000,
+           "total_ms": (served - start) * 1000,
+           "modules": len(sys.modules),
+           "sqlalchemy_imported": "sqlalchemy" in sys.modules},
+          sys.stdout)
+"""
+
+PHASES = ("import_ms", "app_factory_ms", "first_request_ms", "total_ms")
+
+
+def get_settings(backend, tmpdir, warm_up):
+    settings = {
+        "multiauth.policies": "remoteuser",
+        "multiauth.policy.remoteuser.use":
+            "pyramid.authentication.RemoteUserAuthenticationPolicy",
+    }
+    if backend == "sql":
+        settings.update({
+            "storage.backend":
+                "keyretrieval.storage.sql:SQLKeyRetrievalStorage",
+            "storage.sqluri": "sqlite:///" + os.path.join(tmpdir, "keys.db"),
+            "storage.create_tables": True,
+            "storage.warm_up": warm_up,
+        })
+    else:
+        settings.update({
+            "storage.backend":
+                "keyretrieval.storage.logfile:LogKeyRetrievalStorage",
+            "storage.path": tmpdir,
+            "storage.sync": False,
+        })
+    return settings
+
+
+def run_child(settings):
+    """Start up the app in a fresh process, returning its timings."""
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (path,
+                                        env.get("PYTHONPATH"))))
+    child = subprocess.Popen([sys.executable, "-c", CHILD_SCRIPT,
+                              json.dumps(settings)],
+                             stdout=subprocess.PIPE, env=env)
+    output = child.communicate()[0]
+    if child.returncode != 0:
+        raise RuntimeError("child process failed with %d"
+                           % (child.returncode,))
+    return json.loads(output)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option("--runs", type="int", default=10,
+                      help="number of processes to start per configuration")
+    parser.add_option("--backends", default="sql,log",
+                      help="comma-separated backends to try: sql, log")
+    parser.add_option("--output", default=None,
+                      help="file to write JSON results to; '-' for stdout")
+    opts, args = parser.parse_args(args)
+    # Keep the summary table out of the way of JSON written to stdout.
+    if opts.output == "-":
+        out = sys.stderr
+    else:
+        out = sys.stdout
+    configs = []
+    for backend in opts.backends.split(","):
+        if backend == "sql":
+            configs.append(("sql", "false"))
+            configs.append(("sql", "true"))
+        else:
+            configs.append((backend, None))
+    results = []
+    print >> out, "%-14s %9s %9s %9s %9s %8s %6s" % ("backend", "import",
+        "factory", "1st req", "total", "modules", "sqla")
+    for backend, warm_up in configs:
+        runs = []
+        for i in xrange(opts.runs):
+            # Each run gets a fresh database, as after a deployment.
+            tmpdir = tempfile.mkdtemp()
+            try:
+                runs.append(run_child(get_settings(backend, tmpdir, warm_up)))
+            finally:
+                shutil.rmtree(tmpdir)
+        name = backend
+        if warm_up is not None:
+            name = "%s warm=%s" % (backend, warm_up)
+        summary = {"benchmark": "startup", "backend": name,
+                   "runs": opts.runs, "modules": runs[-1]["modules"],
+                   "sqlalchemy_imported": runs[-1]["sqlalchemy_imported"]}
+        for phase in PHASES:
+            summary[phase] = median([run[phase] for run in runs])
+        results.append(summary)
+        print >> out, "%-14s %9.1f %9.1f %9.1f %9.1f %8d %6s" % (name,
+            summary["import_ms"], summary["app_factory_ms"],
+            summary["first_request_ms"], summary["total_ms"],
+            summary["modules"], summary["sqlalchemy_imported"])
+    if opts.output is not None:
+        write_results(results, opts.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
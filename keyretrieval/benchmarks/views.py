@@ -0,0 +1,94 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Load-test the views through the full WSGI application.
+
+Authentication is stubbed out by configuring pyramid_multiauth to trust
+the REMOTE_USER environ key, so these numbers do not include the cost of
+BrowserID verification.
+
+"""
+
+from webob import Request
+
+from keyretrieval import main as make_app
+from keyretrieval.storage import IKeyRetrievalStorage
+from keyretrieval.benchmarks import make_option_parser, run_matrix
+
+
+def get_settings(sqluri):
+    """Get app settings for the given database, with auth stubbed out."""
+    return {
+        "storage.backend": "keyretrieval.storage.sql:SQLKeyRetrievalStorage",
+        "storage.sqluri": sqluri,
+        "storage.create_tables": True,
+        "multiauth.policies": "remoteuser",
+        "multiauth.policy.remoteuser.use":
+            "pyramid.authentication.RemoteUserAuthenticationPolicy",
+    }
+
+
+def setup(sqluri, payload_size):
+    app = make_app({}, **get_settings(sqluri))
+    store = app.registry.getUtility(IKeyRetrievalStorage)
+    data = "X" * payload_size
+
+    def read(userid):
+        request = Request.blank("/" + userid)
+        request.environ["REMOTE_USER"] = userid
+        response = request.get_response(app)
+        if response.status_int != 200:
+            raise RuntimeError("GET failed: %s" % (response.status,))
+
+    def write(userid):
+        request = Request.blank("/" + userid, method="PUT", body=data)
+        request.environ["REMOTE_USER"] = userid
+        request.content_type = "text/plain"
+        response = request.get_response(app)
+        if response.status_int != 204:
+            raise RuntimeError("PUT failed: %s" % (response.status,))
+
+    return store.set_many, read, write
+
+
+def main(args=None):
+    opts, args = make_option_parser().parse_args(args)
+    return run_matrix("views", setup, opts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Measure the effect of write batching on a burst of concurrent writes.
+
+Each run has "concurrency" threads writing to the SQL storage layer with
+write batching off, and then on with each of the given batch delays.  It
+reports writes and commits per second; without batching there is one
+commit per write.  Every tenth write is a delete, to mirror key rotation.
+
+"""
+
+import random
+
+from sqlalchemy import event
+
+from keyretrieval.storage.sql import SQLKeyRetrievalStorage
+from keyretrieval.benchmarks import (make_option_parser, run_workload,
+                                     temp_sqlite_uri, write_results,
+                                     parse_int_list, parse_float_list)
+
+
+def main(args=None):
+    parser = make_option_parser(concurrency="1,8,32", read_ratios="0",
+                                payload_sizes="1024")
+    parser.add_option("--batch-size", type="int", default=50,
+                      help="maximum number of writes per batch")
+    parser.add_option("--batch-delays", default="0.5,2",
+                      help="comma-separated batch delays in milliseconds")
+    opts, args = parser.parse_args(args)
+    data = "X" * parse_int_list(opts.payload_sizes)[0]
+    modes = [("unbatched", 0, 0)]
+    for delay in parse_float_list(opts.batch_delays):
+        modes.append(("batch %gms" % (delay,), opts.batch_size,
+                      delay / 1000.0))
+    results = []
+    print "%-14s %5s %12s %12s %9s %9s" % ("mode", "conc", "writes/sec",
+                                          "commits/sec", "p50 ms", "p99 ms")
+    for concurrency in parse_int_list(opts.concurrency):
+        for mode, batch_size, delay in modes:
+            with temp_sqlite_uri() as sqluri:
+                store = SQLKeyRetrievalStorage(opts.sqluri or sqluri,
+                                               create_tables=True,
+                                               write_batch_size=batch_size,
+                                               write_batch_delay=delay)
+                commits = []
+                event.listen(store._engine, "commit",
+                             lambda conn: commits.append(1))
+                rand = random.Random(0)
+
+                def write(userid):
+                    if rand.random() < 0.1:
+                        try:
+                            store.delete(userid)
+                        except KeyError:
+                            pass
+                    else:
+                        store.set(userid, data)
+
+                summary = run_workload(None, write, 0, concurrency,
+                                       max(opts.ops, concurrency),
+                                       opts.users)
+            summary.update({"benchmark": "writebatch", "mode": mode,
+                            "concurrency": concurrency,
+                            "commits": len(commits),
+                            "commits_per_sec":
+                                len(commits) / summary["elapsed"]})
+            results.append(summary)
+            print "%-14s %5d %12.1f %12.1f %9.3f %9.3f" % (
+                mode, concurrency, summary["ops_per_sec"],
+                summary["commits_per_sec"], summary["p50_ms"],
+                summary["p99_ms"])
+    if opts.output is not None:
+        write_results(results, opts.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
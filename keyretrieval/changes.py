@@ -0,0 +1,459 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Change notifications for the key-retrieval service.
+
+Rather than repeatedly fetching their key data to see whether it changed,
+clients can wait on the /{username}/changes endpoint, which returns as
+soon as the data for that user changes.  It is switched on by a [changes]
+section in the config file::
+
+    [changes]
+    enabled = true
+    timeout = 60
+    workers = 4
+    shared_file = /var/run/keyretrieval/changes
+    pubsub_dir = /var/run/keyretrieval/pubsub
+
+Each user has a change sequence number, which the storage layer bumps on
+every set() or delete() of their data.  By default these are kept in the
+memory of each process and changes are only seen by the process making
+them.  If "shared_file" is set then the sequence numbers are kept in a
+fixed-size table in that file, memory-mapped by every worker process, and
+if "pubsub_dir" is set then each worker binds a unix datagram socket in
+that directory and announces changes to all the others.  Users whose ids
+hash to the same slot of the table share a sequence number, which means
+occasional spurious wakeups but never a missed change.  Every worker must
+use the same "shared_slots", which sets the size of the table.
+
+When running more than one worker process, "workers" must be set to the
+number of them, and "shared_file" must then be set too, since otherwise a
+client waiting in one worker would never see changes made in another.
+
+Waiting clients hold a request open for up to "timeout" seconds, so these
+are best served by an event-driven worker such as gunicorn's gevent one;
+see keyretrieval.storage.green.  Event streams are only held open for more
+than one change under such a worker, as detected by gevent having patched
+the socket module, or if "streaming" is set to true.  Waiters also re-check
+their sequence number every "recheck_interval" seconds, in case an
+announcement is lost.
+
+"""
+
+import os
+import time
+import errno
+import socket
+import struct
+import binascii
+import threading
+
+from zope.interface import implements
+
+from pyramid.exceptions import ConfigurationError
+from pyramid.settings import asbool
+
+from keyretrieval.storage import IKeyRetrievalStorage
+from keyretrieval.storage.slottable import SharedSlotTable
+
+
+class LocalSequenceTable(object):
+    """Per-user change sequence numbers kept in the current process."""
+
+    def __init__(self):
+        self._sequences = {}
+        self._lock = threading.Lock()
+
+    def get(self, userid):
+        return self._sequences.get(userid, 0)
+
+    def increment(self, userid):
+        with self._lock:
+            seq = self._sequences.get(userid, 0) + 1
+            self._sequences[userid] = seq
+        return seq
+
+
+class SharedSequenceTable(object):
+    """Change sequence numbers kept in a memory-mapped file.
+
+    The file holds a fixed number of counters, and each userid uses the
+    one picked by its hash.  Counters are read without locking, and locked
+    while incremented.  See SharedSlotTable for how the file is shared.
+    """
+
+    MAGIC = "KRSEQNO1"
+    COUNTER = struct.Struct("<Q")
+
+    def __init__(self, filename, slots=1024 * 1024):
+        self._table = SharedSlotTable(filename, self.MAGIC,
+                                      self.COUNTER.size, int(slots),
+                                      size_setting="changes.shared_slots")
+        self._map = self._table.map
+
+    @property
+    def slots(self):
+        return self._table.slots
+
+    def close(self):
+        self._table.close()
+
+    def get(self, userid):
+        offset = self._table.offset_for(userid)
+        return self.COUNTER.unpack_from(self._map, offset)[0]
+
+    def increment(self, userid):
+        offset = self._table.offset_for(userid)
+        with self._table.locked(offset, self.COUNTER.size):
+            seq = self.COUNTER.unpack_from(self._map, offset)[0] + 1
+            self.COUNTER.pack_into(self._map, offset, seq)
+        return seq
+
+
+class LocalPubSub(object):
+    """Announces changes to subscribers in the current process only."""
+
+    def __init__(self):
+        self._callbacks = []
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+    def start(self):
+        pass
+
+    def publish(self, userid):
+        for callback in self._callbacks:
+            callback(userid)
+
+    def close(self):
+        pass
+
+
+class SocketPubSub(object):
+    """Announces changes to every process listening in a directory.
+
+    Each process binds a unix datagram socket in the directory and sends
+    changed userids to all the sockets there, including its own, so this
+    stands in for a real message broker between the workers on a single
+    machine.  Sockets left behind by dead processes are removed when a
+    send to them is refused.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._callbacks = []
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        self._listener = None
+        self._path = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+    def start(self):
+        """Start listening, if not already doing so in this process.
+
+        This is done on first use rather than on creation, so that each
+        worker forked from a parent process gets a socket of its own.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            name = "%d-%s.sock" % (os.getpid(),
+                                   binascii.hexlify(os.urandom(4)))
+            self._path = os.path.join(self.directory, name)
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._listener.bind(self._path)
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._listen,
+                                      args=(self._listener,))
+            thread.daemon = True
+            thread.start()
+
+    def publish(self, userid):
+        if isinstance(userid, unicode):
+            userid = userid.encode("utf8")
+        for name in os.listdir(self.directory):
+            if not name.endswith(".sock"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                self._sender.sendto(userid, path)
+            except socket.error, e:
+                if e.errno == errno.ECONNREFUSED:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                # Otherwise the listener is just slow, or already gone,
+                # and its waiters will notice the change when re-checking.
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._listener.close()
+                os.unlink(self._path)
+            self._pid = None
+        self._sender.close()
+
+    def _listen(self, listener):
+        while True:
+            try:
+                userid = listener.recv(1024)
+            except socket.error:
+                return
+            for callback in self._callbacks:
+                callback(userid.decode("utf8"))
+
+
+def _sockets_are_green():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+class ChangeFeed(object):
+    """Per-user change sequence numbers, and a way to wait for changes.
+
+    If "streaming" is true then clients may hold a stream of changes open
+    for the whole timeout, and if false then only until the first change.
+    By default streaming is allowed only if gevent has patched the socket
+    module, since under a blocking worker each open stream ties one up.
+    """
+
+    def __init__(self, sequences, pubsub, timeout=60, recheck_interval=5,
+                 streaming=None):
+        self.sequences = sequences
+        self.pubsub = pubsub
+        self.timeout = float(timeout)
+        self.recheck_interval = float(recheck_interval)
+        if streaming is not None:
+            streaming = asbool(streaming)
+        self.streaming = streaming
+        self.pubsub.subscribe(self._notify)
+        self._waiters = {}
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        """The number of clients currently waiting in this process."""
+        with self._lock:
+            return sum(len(events) for events in self._waiters.itervalues())
+
+    def can_stream(self):
+        if self.streaming is None:
+            return _sockets_are_green()
+        return self.streaming
+
+    def get_sequence(self, userid):
+        return self.sequences.get(userid)
+
+    def changed(self, userid):
+        """Record a change to the data for the given userid."""
+        seq = self.sequences.increment(userid)
+        self.pubsub.publish(userid)
+        return seq
+
+    def wait(self, userid, since, timeout=None):
+        """Wait for the sequence number of a userid to differ from "since".
+
+        Returns the current sequence number once it differs, or after
+        "timeout" seconds, whichever comes first.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        self.pubsub.start()
+        event = threading.Event()
+        # Register before checking, so that no change can slip between.
+        with self._lock:
+            self._waiters.setdefault(userid, set()).add(event)
+        try:
+            while True:
+                seq = self.sequences.get(userid)
+                remaining = deadline - time.time()
+                if seq != since or remaining <= 0:
+                    return seq
+                event.wait(min(remaining, self.recheck_interval))
+                event.clear()
+        finally:
+            with self._lock:
+                events = self._waiters[userid]
+                events.discard(event)
+                if not events:
+                    del self._waiters[userid]
+
+    def iter_changes(self, userid, since, timeout=None, max_events=None):
+        """Generate the sequence number each time it changes, until timeout.
+
+        If "since" is None then the current sequence number is generated
+        first.  At most "max_events" sequence numbers are generated, if
+        given.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        count = 0
+        if since is None:
+            since = self.get_sequence(userid)
+            yield since
+            count += 1
+        while max_events is None or count < max_events:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            seq = self.wait(userid, since, remaining)
+            if seq != since:
+                yield seq
+                since = seq
+                count += 1
+
+    def _notify(self, userid):
+        with self._lock:
+            events = list(self._waiters.get(userid, ()))
+        for event in events:
+            event.set()
+
+
+class ChangeNotifyingKeyRetrievalStorage(object):
+    """IKeyRetrievalStorage that records changes in a ChangeFeed.
+
+    Every successful write through this wrapper bumps the change sequence
+    of the userids it affected.  A bulk write bumps all of its userids even
+    if it fails, since it may have written some of them before failing; a
+    spurious wakeup costs a client one extra fetch, but a missed change
+    would leave it waiting.  Rows deleted by purge_expired() are not
+    announced, since the backend doesn't say which userids they were.
+    """
+
+    implements(IKeyRetrievalStorage)
+
+    def __init__(self, wraps, feed):
+        self.storage = wraps
+        self.feed = feed
+
+    def get(self, userid):
+        return self.storage.get(userid)
+
+    def get_with_version(self, userid, gzipped=False):
+        return self.storage.get_with_version(userid, gzipped)
+
+    def get_version(self, userid):
+        return self.storage.get_version(userid)
+
+    def set(self, userid, data, if_match=None):
+        version = self.storage.set(userid, data, if_match)
+        self.feed.changed(userid)
+        return version
+
+    def delete(self, userid, if_match=None):
+        self.storage.delete(userid, if_match)
+        self.feed.changed(userid)
+
+    def get_many(self, userids):
+        return self.storage.get_many(userids)
+
+    def set_many(self, items):
+        if hasattr(items, "iteritems"):
+            items = items.iteritems()
+        items = list(items)
+        try:
+            return self.storage.set_many(items)
+        finally:
+            for userid, data in items:
+                self.feed.changed(userid)
+
+    def delete_many(self, userids):
+        userids = list(userids)
+        try:
+            return self.storage.delete_many(userids)
+        finally:
+            for userid in userids:
+                self.feed.changed(userid)
+
+    def purge_expired(self, limit=None):
+        return self.storage.purge_expired(limit)
+
+
+def includeme(config):
+    """Set up change notifications, if enabled in the [changes] section.
+
+    This must be included after the storage backend is registered, which
+    it wraps in a ChangeNotifyingKeyRetrievalStorage.  The feed is stored
+    as registry["changes"].
+    """
+    settings = config.registry.settings
+    if not asbool(settings.get("changes.enabled", False)):
+        return
+    if settings.get("changes.shared_file"):
+        sequences = SharedSequenceTable(settings["changes.shared_file"],
+                                        settings.get("changes.shared_slots",
+                                                     1024 * 1024))
+    elif int(settings.get("changes.workers", 1)) > 1:
+        raise ConfigurationError("changes.shared_file must be set when "
+                                 "running more than one worker")
+    else:
+        sequences = LocalSequenceTable()
+    if settings.get("changes.pubsub_dir"):
+        pubsub = SocketPubSub(settings["changes.pubsub_dir"])
+    else:
+        pubsub = LocalPubSub()
+    kwds = {}
+    for name in ("timeout", "recheck_interval", "streaming"):
+        if "changes." + name in settings:
+            kwds[name] = settings["changes." + name]
+    feed = ChangeFeed(sequences, pubsub, **kwds)
+    registry = config.registry
+
+    # The storage backend is registered by a deferred action, so the
+    # wrapping has to be deferred until after it.
+    def wrap_storage():
+        store = registry.getUtility(IKeyRetrievalStorage)
+        wrapped = ChangeNotifyingKeyRetrievalStorage(store, feed)
+        registry.registerUtility(wrapped, IKeyRetrievalStorage)
+
+    config.action(None, wrap_storage, order=1)
+    registry["changes"] = feed
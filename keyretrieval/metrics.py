@@ -0,0 +1,454 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Lightweight in-process metrics for the key-retrieval service.
+
+Request and storage instrumentation is switched on by a [metrics] section
+in the config file::
+
+    [metrics]
+    enabled = true
+    statsd_host = localhost
+    statsd_port = 8125
+    prefix = keyretrieval
+    stats_interval = 10
+    expose_endpoint = true
+    endpoint_allow = 127.0.0.1 ::1
+
+This records latency histograms for each endpoint and storage method, the
+number of SQL statements run per request, request and response payload
+sizes, and counts of response codes and exception classes.
+
+The stats kept by the components themselves are reported too: those of
+the storage backend and its connection pool, of any caching or coalescing
+storage wrappers, and of a CachingVerifier used by the repoze.who browserid
+plugin.  They appear under "components" in /__metrics__, and are sent to
+statsd as gauges at most once every stats_interval seconds.
+
+Metrics are sent to statsd over UDP if statsd_host is set, and can be
+fetched as JSON from /__metrics__ if expose_endpoint is set.  When
+metrics are disabled none of the instrumentation is installed, so it
+costs nothing at all.
+
+The endpoint has no authentication of its own, so it only answers clients
+connecting directly from one of the addresses in endpoint_allow, which
+default to localhost.  Requests with an X-Forwarded-For header are always
+refused, since they came through a proxy from somewhere else; the endpoint
+must not be exposed publicly, and the nginx config blocks it as well.
+
+"""
+
+import re
+import time
+import bisect
+import socket
+import logging
+import threading
+
+from pyramid.settings import asbool
+from pyramid.tweens import EXCVIEW
+from pyramid.httpexceptions import HTTPForbidden
+
+from repoze.who.interfaces import IAPIFactory
+
+from keyretrieval.storage import IKeyRetrievalStorage
+
+
+logger = logging.getLogger("keyretrieval")
+
+# Default histogram bucket boundaries, in milliseconds.
+DEFAULT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Histogram bucket boundaries for payload sizes, in bytes.
+SIZE_BUCKETS = (0, 64, 256, 1024, 2048, 4096, 8192)
+
+# Histogram bucket boundaries for statement counts.
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20)
+
+# Per-thread state for the request currently being processed.
+_request_state = threading.local()
+
+
+class RequestCounters(object):
+    """Counters for a single request, shared by every thread working on it."""
+
+    def __init__(self):
+        self.sql_statements = 0
+
+
+def in_request_context(func):
+    """Wrap a function so that it counts towards the current request.
+
+    Code that hands work over to another thread should wrap it with this
+    in the calling thread, so that e.g. the SQL statements it runs are
+    still counted against the request that it is being done for.
+    """
+    counters = getattr(_request_state, "counters", None)
+    if counters is None:
+        return func
+
+    def call_in_request_context(*args, **kwds):
+        _request_state.counters = counters
+        try:
+            return func(*args, **kwds)
+        finally:
+            del _request_state.counters
+
+    return call_in_request_context
+
+
+class Histogram(object):
+    """Thread-safe histogram of values counted into fixed buckets.
+
+    Each bucket counts the values less than or equal to its upper bound
+    and greater than the previous bound; values larger than the final
+    bound are counted in an overflow bucket labelled "inf".
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._total += value
+
+    def get_stats(self):
+        """Get a dict summarising the values recorded so far."""
+        with self._lock:
+            counts = list(self._counts)
+            count = self._count
+            total = self._total
+        labels = [str(bound) for bound in self.buckets] + ["inf"]
+        return {
+            "count": count,
+            "sum": total,
+            "buckets": dict(zip(labels, counts)),
+        }
+
+
+class StatsdClient(object):
+    """Minimal client sending metrics to statsd over UDP.
+
+    Errors while sending are logged and otherwise ignored, since metrics
+    should never be able to break a request.
+    """
+
+    def __init__(self, host, port=8125, prefix=""):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind):
+        if self.prefix:
+            name = self.prefix + "." + name
+        try:
+            self._socket.sendto("%s:%s|%s" % (name, value, kind),
+                                self.address)
+        except socket.error, e:
+            logger.debug("failed to send metrics: %s", e)
+
+
+class MetricsCollector(object):
+    """Collects counters and histograms, optionally forwarding to statsd."""
+
+    def __init__(self, statsd=None):
+        self.statsd = statsd
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+        if self.statsd is not None:
+            self.statsd.send(name, count, "c")
+
+    def timing(self, name, ms):
+        self._get_histogram(name, DEFAULT_BUCKETS).record(ms)
+        if self.statsd is not None:
+            self.statsd.send(name, "%.3f" % (ms,), "ms")
+
+    def histogram(self, name, value, buckets=SIZE_BUCKETS):
+        self._get_histogram(name, buckets).record(value)
+        if self.statsd is not None:
+            self.statsd.send(name, value, "h")
+
+    def gauge(self, name, value):
+        if self.statsd is not None:
+            self.statsd.send(name, value, "g")
+
+    def _get_histogram(self, name, buckets):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.get(name)
+                if histogram is None:
+                    histogram = self._histograms[name] = Histogram(buckets)
+        return histogram
+
+    def get_stats(self):
+        """Get a dict of all counters and histogram summaries."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = self._histograms.items()
+        return {
+            "counters": counters,
+            "histograms": dict((name, histogram.get_stats())
+                               for (name, histogram) in histograms),
+        }
+
+
+def get_endpoint_name(request):
+    """Get a metric-friendly name for the route matched by a request."""
+    route = getattr(request, "matched_route", None)
+    if route is None:
+        return "unmatched"
+    return re.sub("[^A-Za-z0-9_]+", "_", route.name).strip("_") or "root"
+
+
+def get_component_stats(registry):
+    """Get the stats kept by the storage backend and the verifier.
+
+    The storage wrappers are followed down to the backend, and each one
+    providing get_stats() or get_pool_stats() is reported under the name
+    of its module, e.g. "storage.cache" or "storage.pool".  The shards of
+    a sharded backend are reported as "storage.shard0.pool" and so on.
+    """
+    stats = {}
+    store = registry.queryUtility(IKeyRetrievalStorage)
+    if store is not None:
+        _add_storage_stats(stats, "storage", store)
+    verifier = find_verifier(registry)
+    if verifier is not None:
+        stats["verifier"] = verifier.get_stats()
+    return stats
+
+
+def _add_storage_stats(stats, prefix, store):
+    while store is not None:
+        if hasattr(store, "get_pool_stats"):
+            stats[prefix + ".pool"] = store.get_pool_stats()
+        if hasattr(store, "get_stats"):
+            name = store.__class__.__module__.rsplit(".", 1)[-1]
+            stats[prefix + "." + name] = store.get_stats()
+        for i, shard in enumerate(getattr(store, "shards", ())):
+            _add_storage_stats(stats, "%s.shard%d" % (prefix, i), shard)
+        store = getattr(store, "storage", None)
+
+
+def find_verifier(registry):
+    """Find the verifier of the browserid plugin, if it reports stats.
+
+    The plugin is built by repoze.who from its own config file, so it is
+    found through the API factory that pyramid_whoauth registers.
+    """
+    api_factory = registry.queryUtility(IAPIFactory)
+    for name, plugin in getattr(api_factory, "authenticators", ()):
+        verifier = getattr(plugin, "verifier", None)
+        if hasattr(verifier, "get_stats"):
+            return verifier
+    return None
+
+
+def send_component_stats(registry, collector):
+    """Send the component stats to statsd as gauges."""
+    for name, stats in get_component_stats(registry).iteritems():
+        for key, value in _flatten_stats(name, stats):
+            collector.gauge(key, value)
+
+
+def _flatten_stats(prefix, stats):
+    for key, value in stats.iteritems():
+        name = "%s.%s" % (prefix, key)
+        if isinstance(value, dict):
+            for item in _flatten_stats(name, value):
+                yield item
+        elif isinstance(value, (int, long, float)):
+            yield name, value
+
+
+def metrics_tween_factory(handler, registry):
+    """Tween recording timing and other metrics for each request."""
+    collector = registry["metrics"]
+    settings = registry.settings
+    stats_interval = float(settings.get("metrics.stats_interval", 10))
+    stats_lock = threading.Lock()
+    # The time at which the component stats are next sent to statsd.
+    stats_due = [0]
+
+    def maybe_send_component_stats():
+        now = time.time()
+        with stats_lock:
+            if now < stats_due[0]:
+                return
+            stats_due[0] = now + stats_interval
+        try:
+            send_component_stats(registry, collector)
+        except Exception:
+            logger.exception("failed to send component stats")
+
+    def metrics_tween(request):
+        counters = _request_state.counters = RequestCounters()
+        status = 500
+        start = time.time()
+        try:
+            response = handler(request)
+        except Exception, e:
+            # HTTP errors raised by views are still responses to the client.
+            status = getattr(e, "status_int", 500)
+            collector.incr("error." + e.__class__.__name__)
+            raise
+        else:
+            status = response.status_int
+            if response.content_length:
+                collector.histogram("payload.response_bytes",
+                                    response.content_length)
+            return response
+        finally:
+            elapsed = (time.time() - start) * 1000
+            name = "request.%s.%s" % (get_endpoint_name(request),
+                                      request.method)
+            collector.timing(name, elapsed)
+            collector.incr("response.%d" % (status,))
+            if request.content_length:
+                collector.histogram("payload.request_bytes",
+                                    request.content_length)
+            collector.histogram("sql.statements_per_request",
+                                counters.sql_statements, COUNT_BUCKETS)
+            del _request_state.counters
+            if collector.statsd is not None:
+                maybe_send_component_stats()
+
+    return metrics_tween
+
+
+def _count_sql_statement(*args):
+    """SQLAlchemy event hook counting statements run by each request."""
+    try:
+        _request_state.counters.sql_statements += 1
+    except AttributeError:
+        # Not within a request.
+        pass
+
+
+_sql_hook_installed = False
+
+
+def install_sql_hook():
+    """Start counting the SQL statements issued by each request.
+
+    The hook is installed on all SQLAlchemy engines and cannot be removed,
+    which is harmless since it only counts within instrumented requests.
+    """
+    global _sql_hook_installed
+    if not _sql_hook_installed:
+        # Imported here so that backends not using SQLAlchemy don't pay
+        # the cost of importing it at startup.
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        event.listen(Engine, "before_cursor_execute", _count_sql_statement)
+        _sql_hook_installed = True
+
+
+def instrument_storage(storage, collector):
+    """Record timings for each IKeyRetrievalStorage method of a backend.
+
+    The methods are replaced on the storage instance itself, so that code
+    holding a reference to it sees the instrumented versions.
+    """
+    for name in IKeyRetrievalStorage.names():
+        method = getattr(storage, name, None)
+        if method is not None:
+            setattr(storage, name,
+                    _timed_method(collector, "storage." + name, method))
+
+
+def _timed_method(collector, name, method):
+    def timed_method(*args, **kwds):
+        start = time.time()
+        try:
+            return method(*args, **kwds)
+        except Exception, e:
+            collector.incr("%s.error.%s" % (name, e.__class__.__name__))
+            raise
+        finally:
+            collector.timing(name, (time.time() - start) * 1000)
+    return timed_method
+
+
+def metrics_view(request):
+    """View exposing the collected metrics as JSON, to local clients only."""
+    allowed = request.registry.settings.get("metrics.endpoint_allow",
+                                            "127.0.0.1 ::1").split()
+    if request.remote_addr not in allowed or \
+            "X-Forwarded-For" in request.headers:
+        raise HTTPForbidden()
+    stats = request.registry["metrics"].get_stats()
+    stats["components"] = get_component_stats(request.registry)
+    return stats
+
+
+def includeme(config):
+    """Set up request metrics, if enabled in the [metrics] config section.
+
+    The collector is stored as registry["metrics"], so that other parts of
+    the app can record metrics of their own.
+    """
+    settings = config.registry.settings
+    if not asbool(settings.get("metrics.enabled", False)):
+        return
+    statsd = None
+    if settings.get("metrics.statsd_host"):
+        statsd = StatsdClient(settings["metrics.statsd_host"],
+                              settings.get("metrics.statsd_port", 8125),
+                              settings.get("metrics.prefix", "keyretrieval"))
+    config.registry["metrics"] = MetricsCollector(statsd)
+    install_sql_hook()
+    # Sit under the exception view, so we see the exceptions raised by views
+    # and the storage layer before they get turned into responses.
+    config.add_tween("keyretrieval.metrics.metrics_tween_factory",
+                     under=EXCVIEW)
+    if asbool(settings.get("metrics.expose_endpoint", False)):
+        config.add_route("metrics", "/__metrics__")
+        config.add_view(metrics_view, route_name="metrics", renderer="json")
@@ -0,0 +1,247 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Per-user and per-endpoint rate limiting for the key-retrieval service.
+
+Rate limiting is switched on by a [ratelimit] section in the config file::
+
+    [ratelimit]
+    enabled = true
+    user_rate = 1
+    user_burst = 10
+    endpoint_rate = 500
+    endpoint_burst = 1000
+    max_users = 100000
+    shared_file = /var/run/keyretrieval/ratelimit
+
+Each authenticated user gets a token bucket holding up to "user_burst"
+tokens and refilled at "user_rate" tokens per second, and each endpoint
+gets a bucket shared by all users.  An endpoint is a route and request
+method, such as GET of a user's key or GET of their change feed, so that
+long-polling for changes doesn't use up the tokens for fetching keys.
+A request that finds either bucket empty is rejected with a "429 Too Many
+Requests" response and a Retry-After header, before it gets anywhere near
+the storage layer.  Unauthenticated requests are not limited, since they
+are rejected before doing any storage work anyway.
+
+By default each process keeps its buckets in memory, in an LRU holding at
+most "max_users" of them; a bucket that gets evicted is simply refilled.
+If "shared_file" is set then the buckets are instead kept in a fixed-size
+table in that file, which is memory-mapped by every worker process so
+that they enforce the limits together.  Users whose keys hash to the same
+slot of the table take it over from each other, so "shared_slots" should
+be comfortably larger than the number of users active at any one time,
+and must be the same for every worker.
+
+"""
+
+import sys
+import math
+import time
+import struct
+import threading
+
+from pyramid.interfaces import IRoutesMapper
+from pyramid.response import Response
+from pyramid.security import authenticated_userid
+from pyramid.settings import asbool
+from pyramid.tweens import EXCVIEW
+
+from keyretrieval.storage.cache import LRUCache
+from keyretrieval.storage.slottable import SharedSlotTable, key_hash
+
+
+def take_token(tokens, last, rate, burst, now):
+    """Refill a token bucket and try to take a token from it.
+
+    Returns the new number of tokens, and how many seconds to wait before
+    a token will be available, which is zero if one was taken.
+    """
+    tokens = min(burst, tokens + (now - last) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / float(rate)
+
+
+class LocalBucketStore(object):
+    """Token buckets kept in the memory of the current process."""
+
+    def __init__(self, max_keys=100000):
+        self._buckets = LRUCache(max_keys, sys.maxint)
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst):
+        """Try to take a token from the named bucket.
+
+        Returns the number of seconds to wait before retrying, or zero if
+        a token was taken.
+        """
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens, wait = take_token(tokens, last, rate, burst, now)
+            # Once full again the bucket is the same as a missing one, so
+            # it can expire from the cache at that point.
+            ttl = (burst - tokens) / float(rate)
+            self._buckets.put(key, (tokens, now), 0, ttl)
+        return wait
+
+
+class SharedBucketStore(object):
+    """Token buckets kept in a memory-mapped file shared by processes.
+
+    The file holds a fixed number of slots, each holding a hash of the key
+    it belongs to along with the state of its bucket.  Each slot is locked
+    while it is updated.  See SharedSlotTable for how the file is shared.
+    """
+
+    MAGIC = "KRRATES1"
+    SLOT = struct.Struct("<Qdd")
+
+    def __init__(self, filename, slots=1024 * 1024):
+        self._table = SharedSlotTable(filename, self.MAGIC, self.SLOT.size,
+                                      int(slots),
+                                      size_setting="ratelimit.shared_slots")
+        self._map = self._table.map
+
+    @property
+    def slots(self):
+        return self._table.slots
+
+    def close(self):
+        self._table.close()
+
+    def consume(self, key, rate, burst):
+        tag = key_hash(key) or 1
+        offset = self._table.offset(tag % self.slots)
+        now = time.time()
+        with self._table.locked(offset, self.SLOT.size):
+            slot_tag, tokens, last = self.SLOT.unpack_from(self._map, offset)
+            if slot_tag != tag:
+                tokens, last = burst, now
+            tokens, wait = take_token(tokens, last, rate, burst, now)
+            self.SLOT.pack_into(self._map, offset, tag, tokens, now)
+        return wait
+
+
+class RateLimiter(object):
+    """Per-user and per-endpoint token bucket rate limits."""
+
+    def __init__(self, store, user_rate=1, user_burst=10, endpoint_rate=500,
+                 endpoint_burst=1000):
+        self.store = store
+        self.user_rate = float(user_rate)
+        self.user_burst = float(user_burst)
+        self.endpoint_rate = float(endpoint_rate)
+        self.endpoint_burst = float(endpoint_burst)
+        self.rejections = 0
+
+    def check(self, userid, endpoint):
+        """Check whether a user may make a request to an endpoint.
+
+        Returns None if so, or a tuple giving the name of the limit that
+        was hit and the number of seconds to wait before retrying.
+        """
+        wait = self.store.consume("user:" + userid, self.user_rate,
+                                  self.user_burst)
+        if wait:
+            self.rejections += 1
+            return "user", wait
+        wait = self.store.consume("endpoint:" + endpoint,
+                                  self.endpoint_rate, self.endpoint_burst)
+        if wait:
+            self.rejections += 1
+            return "endpoint", wait
+        return None
+
+
+def ratelimit_tween_factory(handler, registry):
+    """Tween rejecting requests that exceed the configured rate limits."""
+    limiter = registry["ratelimiter"]
+    mapper = registry.queryUtility(IRoutesMapper)
+
+    def get_endpoint(request):
+        # Tweens run before the router has matched the request to a route,
+        # so look it up the same way the router will.
+        route = mapper(request)["route"] if mapper is not None else None
+        if route is None:
+            return "unmatched:" + request.method
+        return route.name + ":" + request.method
+
+    def ratelimit_tween(request):
+        # Leave internal endpoints such as /__metrics__ alone.
+        if request.path.startswith("/__"):
+            return handler(request)
+        userid = authenticated_userid(request)
+        if userid is None:
+            return handler(request)
+        rejected = limiter.check(userid, get_endpoint(request))
+        if rejected is None:
+            return handler(request)
+        limit, wait = rejected
+        if "metrics" in registry:
+            registry["metrics"].incr("ratelimit.rejected." + limit)
+        response = Response(status="429 Too Many Requests")
+        response.retry_after = int(math.ceil(wait))
+        return response
+
+    return ratelimit_tween
+
+
+def includeme(config):
+    """Set up rate limiting, if enabled in the [ratelimit] config section.
+
+    The limiter is stored as registry["ratelimiter"].
+    """
+    settings = config.registry.settings
+    if not asbool(settings.get("ratelimit.enabled", False)):
+        return
+    if settings.get("ratelimit.shared_file"):
+        store = SharedBucketStore(settings["ratelimit.shared_file"],
+                                  settings.get("ratelimit.shared_slots",
+                                               1024 * 1024))
+    else:
+        store = LocalBucketStore(int(settings.get("ratelimit.max_users",
+                                                  100000)))
+    kwds = {}
+    for name in ("user_rate", "user_burst", "endpoint_rate",
+                 "endpoint_burst"):
+        if "ratelimit." + name in settings:
+            kwds[name] = settings["ratelimit." + name]
+    config.registry["ratelimiter"] = RateLimiter(store, **kwds)
+    config.add_tween("keyretrieval.ratelimit.ratelimit_tween_factory",
+                     under=EXCVIEW)
@@ -34,17 +34,88 @@
 #
 # ***** END LICENSE BLOCK *****
 
+import hashlib
+
 from zope.interface import Interface
 
 
+class ConflictError(Exception):
+    """Raised when a conditional write finds an unexpected version."""
+
+
+def compute_version(data):
+    """Compute the version string identifying the given data.
+
+    Versions are a hash of the data, so that every backend (and any cached
+    copy of the data) agrees on the version without having to store it.
+    """
+    if isinstance(data, unicode):
+        data = data.encode("utf8")
+    return hashlib.md5(data).hexdigest()
+
+
 class IKeyRetrievalStorage(Interface):
     """Interface definition for key-retrieval storage backends."""
 
     def get(userid):
         """Get the data stored for the given userid."""
 
-    def set(userid, data):
-        """Store the given data for the given userid."""
+    def get_with_version(userid, gzipped=False):
+        """Get the data stored for the given userid, and its version.
+
+        Returns a tuple of (data, version, is_gzipped), fetched together
+        so that a response can be built from a single read.  If "gzipped"
+        is true and the data is stored compressed, the data is returned as
+        a gzip stream without being decompressed and is_gzipped is true.
+        """
+
+    def get_version(userid):
+        """Get the version of the data stored for the given userid.
+
+        This should be cheaper than fetching the data itself.
+        """
+
+    def set(userid, data, if_match=None):
+        """Store the given data for the given userid.
+
+        If "if_match" is given then the data is only stored if it matches
+        the version currently stored, or if it is "*" and any data is
+        currently stored; otherwise ConflictError is raised.  Returns the
+        version of the newly-stored data.
+        """
+
+    def delete(userid, if_match=None):
+        """Delete the data stored for the given userid.
+
+        If "if_match" is given then the data is only deleted if it matches
+        the version currently stored, or if it is "*" and any data is
+        currently stored; otherwise ConflictError is raised.
+        """
+
+    def get_many(userids):
+        """Get a dict mapping each of the given userids to its stored data.
+
+        Userids that have no stored data are omitted from the result.
+        """
+
+    def set_many(items):
+        """Store data for many userids.
+
+        The items may be given as a dict or an iterable of (userid, data)
+        pairs.
+        """
+
+    def delete_many(userids):
+        """Delete the data stored for each of the given userids.
+
+        Userids that have no stored data are ignored.  Returns the number
+        of userids for which data was actually deleted.
+        """
+
+    def purge_expired(limit=None):
+        """Delete the data of userids that have not been accessed recently.
 
-    def delete(userid):
-        """Delete the data stored for the given userid."""
+        Data is deleted in small batches, stopping after "limit" userids if
+        given.  Returns the number of userids whose data was deleted, which
+        is always zero for backends that do not support expiry.
+        """
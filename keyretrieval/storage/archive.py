@@ -0,0 +1,371 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Streaming export and import of the keydata table.
+
+Rows are copied in userid order using keyset pagination, and written to a
+line-oriented archive without ever holding more than one batch in memory.
+The archive looks like this::
+
+    keyretrieval-archive 1
+    <userid>\t<version>\t<data>\t<crc>
+    ...
+    #END\t<count>\t<crc>
+
+Each record holds the url-quoted userid, its version (or "-" if none),
+and the stored value in base64, followed by the CRC32 of those fields.
+The footer gives the number of records and a running CRC32 over all of
+them, so that truncated or corrupted archives are detected on import.
+Values are copied exactly as stored, so compressed rows are not unpacked,
+and rows of a binary data column are copied byte for byte.
+
+Exports and imports both save a checkpoint alongside the archive after
+each batch, and pick up from it if interrupted and restarted.  Large tables
+can be split by userid range and exported by several worker processes at
+once, each writing its own part file; these can then be imported in
+parallel too.  From the command line::
+
+    python -m keyretrieval.storage.archive export sqluri archive
+    python -m keyretrieval.storage.archive import sqluri archive
+
+"""
+
+import os
+import zlib
+import base64
+import urllib
+import optparse
+import multiprocessing
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from keyretrieval.storage.sql import SQLKeyRetrievalStorage
+
+
+ARCHIVE_HEADER = "keyretrieval-archive 1\n"
+ARCHIVE_FOOTER = "#END"
+
+
+class ArchiveError(Exception):
+    """Exception raised when an archive is corrupted or truncated."""
+
+
+def _crc32(value, crc=0):
+    return zlib.crc32(value, crc) & 0xffffffff
+
+
+def encode_record(userid, data, version):
+    """Encode a single (userid, data, version) row as an archive line."""
+    if isinstance(userid, unicode):
+        userid = userid.encode("utf8")
+    if isinstance(data, unicode):
+        data = data.encode("utf8")
+    fields = "\t".join((urllib.quote(userid, safe="@+"), version or "-",
+                        base64.b64encode(data)))
+    return "%s\t%08x\n" % (fields, _crc32(fields))
+
+
+def decode_record(line, binary=False):
+    """Decode an archive line back into a (userid, data, version) row.
+
+    The data is returned as a bytestring if "binary" is true, as for rows
+    of a binary data column, and otherwise decoded as UTF-8.
+    """
+    try:
+        fields, crc = line.rstrip("\n").rsplit("\t", 1)
+        userid, version, data = fields.split("\t")
+        if int(crc, 16) != _crc32(fields):
+            raise ArchiveError("checksum mismatch in record %r" % (userid,))
+        userid = urllib.unquote(userid).decode("utf8")
+        data = base64.b64decode(data)
+        if not binary:
+            data = data.decode("utf8")
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ArchiveError("malformed record %r" % (line[:80],))
+    if version == "-":
+        version = None
+    return userid, data, version
+
+
+class _Checkpoint(object):
+    """Progress through an archive, saved to disk after each batch.
+
+    Holds the byte offset of the first unprocessed record, the number of
+    records and running CRC up to there, and the last userid covered.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = None
+        self.count = 0
+        self.crc = 0
+        self.userid = None
+
+    def load(self):
+        """Load the saved checkpoint, returning False if there is none."""
+        try:
+            with open(self.filename) as f:
+                state = json.load(f)
+        except IOError:
+            return False
+        self.offset = state["offset"]
+        self.count = state["count"]
+        self.crc = state["crc"]
+        self.userid = state["userid"]
+        return True
+
+    def save(self):
+        # Write to a temporary file and rename over the original, so that
+        # a crash can never leave a half-written checkpoint behind.
+        tmpfile = self.filename + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump({"offset": self.offset, "count": self.count,
+                       "crc": self.crc, "userid": self.userid}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpfile, self.filename)
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+
+def export_archive(store, filename, start=None, end=None):
+    """Export rows from the given SQLKeyRetrievalStorage to an archive.
+
+    Rows after "start" and up to and including "end" are exported, or the
+    whole table if these are not given.  If a checkpoint from a previous
+    export to the same file exists, the export continues from there.
+    Returns the total number of rows in the archive.
+    """
+    checkpoint = _Checkpoint(filename + ".checkpoint")
+    if checkpoint.load():
+        f = open(filename, "r+b")
+        f.truncate(checkpoint.offset)
+        f.seek(checkpoint.offset)
+        start = checkpoint.userid or start
+    else:
+        f = open(filename, "wb")
+        f.write(ARCHIVE_HEADER)
+    try:
+        pending = 0
+        for userid, data, version in store.iter_raw_rows(start, end):
+            line = encode_record(userid, data, version)
+            f.write(line)
+            checkpoint.crc = _crc32(line, checkpoint.crc)
+            checkpoint.count += 1
+            checkpoint.userid = userid
+            pending += 1
+            if pending >= store.batch_size:
+                _save_export_checkpoint(f, checkpoint)
+                pending = 0
+        f.write("%s\t%d\t%08x\n" % (ARCHIVE_FOOTER, checkpoint.count,
+                                   checkpoint.crc))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    checkpoint.remove()
+    return checkpoint.count
+
+
+def _save_export_checkpoint(f, checkpoint):
+    f.flush()
+    os.fsync(f.fileno())
+    checkpoint.offset = f.tell()
+    checkpoint.save()
+
+
+def iter_archive(f, checkpoint=None, binary=False):
+    """Iterate over the (userid, data, version) rows in an archive file.
+
+    The records are verified as they are read, and ArchiveError raised
+    on the first problem found.  If a checkpoint is given, reading starts
+    from its offset and the checkpoint is kept up to date with the offset
+    of the record following the one most recently yielded.  The data is
+    returned as bytestrings if "binary" is true; see decode_record().
+    """
+    if checkpoint is None:
+        checkpoint = _Checkpoint(None)
+    if checkpoint.offset is None:
+        if f.readline() != ARCHIVE_HEADER:
+            raise ArchiveError("not a keyretrieval archive")
+        checkpoint.offset = f.tell()
+    else:
+        f.seek(checkpoint.offset)
+    while True:
+        line = f.readline()
+        if not line.endswith("\n"):
+            raise ArchiveError("archive is truncated")
+        if line.startswith(ARCHIVE_FOOTER + "\t"):
+            break
+        row = decode_record(line, binary)
+        checkpoint.crc = _crc32(line, checkpoint.crc)
+        checkpoint.count += 1
+        checkpoint.userid = row[0]
+        checkpoint.offset = f.tell()
+        yield row
+    try:
+        footer, count, crc = line.split("\t")
+        count, crc = int(count), int(crc, 16)
+    except ValueError:
+        raise ArchiveError("malformed footer %r" % (line,))
+    if count != checkpoint.count or crc != checkpoint.crc:
+        raise ArchiveError("archive checksum mismatch")
+    if f.readline():
+        raise ArchiveError("trailing data after archive footer")
+
+
+def import_archive(store, filename):
+    """Import rows from an archive into the given SQLKeyRetrievalStorage.
+
+    Rows are written in batches of the store's batch_size, replacing any
+    existing rows with the same userid.  If the archive turns out to be
+    corrupt then ArchiveError is raised, and rows from before the problem
+    will already have been imported.  If a checkpoint from a previous
+    import of the same file exists, the import continues from there.
+    Returns the total number of rows imported.
+    """
+    checkpoint = _Checkpoint(filename + ".import-checkpoint")
+    checkpoint.load()
+    with open(filename, "rb") as f:
+        batch = []
+        for row in iter_archive(f, checkpoint, store.binary):
+            batch.append(row)
+            if len(batch) >= store.batch_size:
+                store.set_raw_many(batch)
+                checkpoint.save()
+                batch = []
+        if batch:
+            store.set_raw_many(batch)
+    checkpoint.remove()
+    return checkpoint.count
+
+
+def _export_worker(args):
+    sqluri, filename, start, end, kwds = args
+    store = SQLKeyRetrievalStorage(sqluri, **kwds)
+    return export_archive(store, filename, start, end)
+
+
+def _import_worker(args):
+    sqluri, filename, kwds = args
+    store = SQLKeyRetrievalStorage(sqluri, **kwds)
+    return import_archive(store, filename)
+
+
+def export_parallel(sqluri, filename, workers, **kwds):
+    """Export a database to several part files using worker processes.
+
+    The table is split into "workers" roughly equal ranges of userid,
+    each exported by a separate process to "<filename>.<n>".  Returns a
+    list of the part filenames.  Extra keyword arguments are passed on
+    to the SQLKeyRetrievalStorage constructor.
+    """
+    store = SQLKeyRetrievalStorage(sqluri, **kwds)
+    boundaries = store.get_userid_boundaries(workers)
+    jobs = []
+    for i in xrange(len(boundaries) - 1):
+        jobs.append((sqluri, "%s.%d" % (filename, i),
+                     boundaries[i], boundaries[i + 1], kwds))
+    _run_workers(_export_worker, jobs)
+    return [job[1] for job in jobs]
+
+
+def import_parallel(sqluri, filenames, workers, **kwds):
+    """Import several archive files using up to "workers" processes.
+
+    Returns the total number of rows imported.  Extra keyword arguments
+    are passed on to the SQLKeyRetrievalStorage constructor.
+    """
+    # Create the tables up front, so the workers don't race to do it.
+    SQLKeyRetrievalStorage(sqluri, create_tables=True, **kwds).warm_up()
+    jobs = [(sqluri, filename, kwds) for filename in filenames]
+    return sum(_run_workers(_import_worker, jobs, workers))
+
+
+def _run_workers(func, jobs, workers=None):
+    if len(jobs) == 1:
+        return [func(jobs[0])]
+    pool = multiprocessing.Pool(workers or len(jobs))
+    try:
+        return pool.map(func, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(args=None):
+    """Export or import a keydata archive as given on the command-line."""
+    usage = "usage: %prog [options] export sqluri archive\n" \
+            "       %prog [options] import sqluri archive [archive...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--workers", type="int", default=1,
+                      help="number of worker processes to use")
+    parser.add_option("--batch-size", type="int", default=500,
+                      help="number of rows to copy per query")
+    parser.add_option("--binary", action="store_true", default=False,
+                      help="the database has a binary data column")
+    opts, args = parser.parse_args(args)
+    if len(args) < 3 or args[0] not in ("export", "import"):
+        parser.error("expected export or import, a sqluri and an archive")
+    command, sqluri, filenames = args[0], args[1], args[2:]
+    kwds = {"batch_size": opts.batch_size, "binary": opts.binary}
+    try:
+        if command == "export":
+            if len(filenames) != 1:
+                parser.error("exactly one archive must be specified")
+            if opts.workers > 1:
+                filenames = export_parallel(sqluri, filenames[0],
+                                            opts.workers, **kwds)
+                print "exported to %s" % (", ".join(filenames),)
+            else:
+                store = SQLKeyRetrievalStorage(sqluri, **kwds)
+                count = export_archive(store, filenames[0])
+                print "%d rows exported" % (count,)
+        else:
+            count = import_parallel(sqluri, filenames, opts.workers, **kwds)
+            print "%d rows imported" % (count,)
+    except ArchiveError, e:
+        parser.exit(1, "error: %s\n" % (e,))
+
+
+if __name__ == "__main__":
+    main()
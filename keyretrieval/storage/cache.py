@@ -0,0 +1,656 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Read-through caching layer for key-retrieval storage backends.
+
+This module provides an IKeyRetrievalStorage implementation that wraps
+some other backend and keeps recently-read data in memory.  It can be
+configured in the [storage] section like so::
+
+    [storage]
+    backend = keyretrieval.storage.cache:CachingKeyRetrievalStorage
+    wraps = keyretrieval.storage.sql:SQLKeyRetrievalStorage
+    cache_max_items = 10000
+    cache_max_bytes = 16777216
+    cache_ttl = 300
+    cache_miss_ttl = 10
+    sqluri = sqlite:////tmp/keyretrieval.db
+
+Any options not consumed by the cache are passed through to the wrapped
+backend.  The cache is local to each process, so writes made through other
+processes become visible only once the cached entry expires.
+
+Setting "cache_shared_file" instead keeps the cache in a memory-mapped
+file shared by every worker process on the machine, so that each worker
+sees the others' cached reads and invalidations::
+
+    [storage]
+    backend = keyretrieval.storage.cache:CachingKeyRetrievalStorage
+    wraps = keyretrieval.storage.sql:SQLKeyRetrievalStorage
+    cache_shared_file = /var/run/keyretrieval/cache
+    cache_max_items = 10000
+
+The file has room for "cache_max_items" values of up to 8KB each, about
+80MB for the above, while "cache_max_bytes" is ignored.  Userids that hash
+alike compete for the same few slots, so "cache_max_items" should be
+comfortably larger than the number of userids active at any one time.
+
+"""
+
+import time
+import struct
+import threading
+
+from zope.interface import implements
+
+from mozsvc.util import resolve_name
+
+from keyretrieval.storage import IKeyRetrievalStorage, compute_version
+from keyretrieval.storage.slottable import SharedSlotTable, key_hash
+
+
+# Sentinel value cached in place of data for userids that have no data.
+MISSING = object()
+
+
+class _Entry(object):
+    """A single cached item, linked into the cache's LRU list."""
+
+    __slots__ = ("key", "value", "size", "expires", "prev", "next")
+
+    def __init__(self, key=None, value=None, size=0, expires=0):
+        self.key = key
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.prev = self
+        self.next = self
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache bounded by item count and total size.
+
+    Each item has its own expiry time.  Expired items are dropped when
+    they are next looked up, or when they reach the tail of the LRU list.
+
+    To avoid re-populating the cache with stale data, callers can take a
+    snapshot of the cache's "generation" before reading from the backing
+    store and pass it to put(); the put is discarded if any invalidation
+    happened in the meantime.  invalidate() returns the generation that it
+    started, for use by callers that have just written the new data.
+    """
+
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._items = {}
+        self._total_bytes = 0
+        # Sentinel head of the circular LRU list; head.next is the most
+        # recently used entry and head.prev is the least recently used.
+        self._head = _Entry()
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return default
+            if entry.expires <= time.time():
+                self._remove(entry)
+                return default
+            self._unlink(entry)
+            self._link(entry)
+            return entry.value
+
+    def put(self, key, value, size, ttl, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            if size > self.max_bytes:
+                return False
+            entry = self._items.get(key)
+            if entry is not None:
+                self._remove(entry)
+            entry = _Entry(key, value, size, time.time() + ttl)
+            self._items[key] = entry
+            self._total_bytes += size
+            self._link(entry)
+            self._evict()
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            entry = self._items.get(key)
+            if entry is not None:
+                self._remove(entry)
+            return self.generation
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._items.clear()
+            self._total_bytes = 0
+            self._head.prev = self._head.next = self._head
+
+    def _evict(self):
+        head = self._head
+        while len(self._items) > self.max_items or \
+              self._total_bytes > self.max_bytes:
+            self._remove(head.prev)
+            self.evictions += 1
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._items[entry.key]
+        self._total_bytes -= entry.size
+
+    def _link(self, entry):
+        head = self._head
+        entry.prev = head
+        entry.next = head.next
+        head.next.prev = entry
+        head.next = entry
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+        entry.prev = entry.next = entry
+
+
+class SharedMemoryCache(object):
+    """Cache kept in a memory-mapped file shared by several processes.
+
+    This has the same interface as LRUCache, except that values must be
+    strings, MISSING, or a (string, version) pair.  The file holds a fixed
+    number of slots, each big enough for a value of up to MAX_VALUE_SIZE
+    bytes and a version of up to MAX_VERSION_SIZE, grouped into sets of
+    WAYS slots.  Each key can only live in the set picked by its hash,
+    where it replaces whichever slot expires soonest.
+
+    Writers lock the set using one of STRIPES locks, each a byte of the
+    header locked with SharedSlotTable.locked().  Readers take no locks:
+    each slot has a sequence number that is odd while the slot is being
+    written, and a read that sees an odd or changed sequence number is
+    retried, or else treated as a miss.
+
+    The generation counter used to discard stale puts is kept in the file,
+    so an invalidation made by any process discards puts in all of them.
+
+    The layout of the slots is recorded in the file too, so that a file
+    laid out for a different max_items is started afresh or refused; see
+    SharedSlotTable.
+    """
+
+    MAGIC = "KRCACHE2"
+    # Besides the table's own header, this holds the generation and the
+    # bytes that are locked to take each of the locks.
+    HEADER_SIZE = 4096
+    GENERATION_OFFSET = SharedSlotTable.USER_OFFSET
+    LOCKS_OFFSET = GENERATION_OFFSET + 8
+    # The layout of each slot is given by (ways, max key size, max version
+    # size, max value size).
+    GEOMETRY = struct.Struct("<IIII")
+    STRIPES = 64
+    WAYS = 4
+    MAX_KEY_SIZE = 128
+    MAX_VERSION_SIZE = 64
+    MAX_VALUE_SIZE = 8 * 1024
+    READ_ATTEMPTS = 3
+
+    # Each slot is a header of (sequence, expiry time, kind, key length,
+    # version length, value length) followed by space for the key, the
+    # version and the value.
+    SEQUENCE = struct.Struct("<Q")
+    SLOT = struct.Struct("<QdBBBxI")
+    SLOT_SIZE = SLOT.size + MAX_KEY_SIZE + MAX_VERSION_SIZE + MAX_VALUE_SIZE
+
+    # Kinds of slot contents.  The VERSIONED flag is added to the kind of
+    # a value that was put with its version.
+    EMPTY = 0
+    BYTES = 1
+    TEXT = 2
+    MISSING = 3
+    VERSIONED = 0x80
+
+    def __init__(self, filename, max_items):
+        self.sets = max(1, (int(max_items) + self.WAYS - 1) // self.WAYS)
+        self.max_items = self.sets * self.WAYS
+        self.max_bytes = self.MAX_VALUE_SIZE
+        self.evictions = 0
+        geometry = self.GEOMETRY.pack(self.WAYS, self.MAX_KEY_SIZE,
+                                      self.MAX_VERSION_SIZE,
+                                      self.MAX_VALUE_SIZE)
+        # Each stripe, and the generation, gets a thread lock of its own,
+        # since the generation is bumped while holding a stripe's lock.
+        self._table = SharedSlotTable(filename, self.MAGIC, self.SLOT_SIZE,
+                                      self.max_items, self.HEADER_SIZE,
+                                      geometry, self.STRIPES + 1,
+                                      size_setting="cache_max_items")
+        self._map = self._table.map
+
+    def close(self):
+        self._table.close()
+
+    def __len__(self):
+        return len(self._live_slots())
+
+    @property
+    def total_bytes(self):
+        return sum(self._live_slots())
+
+    @property
+    def generation(self):
+        return self.SEQUENCE.unpack_from(self._map,
+                                         self.GENERATION_OFFSET)[0]
+
+    def get(self, key, default=None):
+        key = self._encode_key(key)
+        if key is None:
+            return default
+        for offset in self._get_offsets(key)[1]:
+            found = self._read_slot(offset, key)
+            if found is None:
+                continue
+            kind, expires, value, version = found
+            if expires <= time.time():
+                return default
+            if kind == self.MISSING:
+                return MISSING
+            if kind & ~self.VERSIONED == self.TEXT:
+                value = value.decode("utf8")
+            if kind & self.VERSIONED:
+                return value, version
+            return value
+        return default
+
+    def put(self, key, value, size, ttl, generation=None):
+        key = self._encode_key(key)
+        if key is None:
+            return False
+        flags, version = 0, ""
+        if isinstance(value, tuple):
+            value, version = value
+            flags = self.VERSIONED
+            if isinstance(version, unicode):
+                version = version.encode("utf8")
+        if value is MISSING:
+            kind, value = self.MISSING, ""
+        elif isinstance(value, unicode):
+            kind, value = self.TEXT | flags, value.encode("utf8")
+        else:
+            kind = self.BYTES | flags
+        if len(value) > self.MAX_VALUE_SIZE or \
+                len(version) > self.MAX_VERSION_SIZE:
+            return False
+        stripe, offsets = self._get_offsets(key)
+        with self._locked(stripe):
+            if generation is not None and generation != self.generation:
+                return False
+            # Overwrite any existing entry for the key, or else the slot
+            # that expires soonest, preferring empty and expired ones.
+            now = time.time()
+            victim = None
+            victim_expires = None
+            for offset in offsets:
+                seq, expires, slot_kind, keylen, verlen, length = \
+                    self.SLOT.unpack_from(self._map, offset)
+                if slot_kind == self.EMPTY:
+                    expires = 0
+                elif self._slot_key(offset, keylen) == key:
+                    victim = offset
+                    break
+                if victim is None or expires < victim_expires:
+                    victim, victim_expires = offset, expires
+            else:
+                if victim_expires > now:
+                    self.evictions += 1
+            self._write_slot(victim, now + ttl, kind, key, value, version)
+        return True
+
+    def invalidate(self, key):
+        key = self._encode_key(key)
+        if key is None:
+            return self._bump_generation()
+        stripe, offsets = self._get_offsets(key)
+        with self._locked(stripe):
+            generation = self._bump_generation()
+            for offset in offsets:
+                keylen = self.SLOT.unpack_from(self._map, offset)[3]
+                if self._slot_key(offset, keylen) == key:
+                    self._write_slot(offset, 0, self.EMPTY, "", "")
+        return generation
+
+    def clear(self):
+        self._bump_generation()
+        for stripe in xrange(self.STRIPES):
+            with self._locked(stripe):
+                for set_index in xrange(stripe, self.sets, self.STRIPES):
+                    for offset in self._get_set_offsets(set_index):
+                        self._write_slot(offset, 0, self.EMPTY, "", "")
+
+    def _encode_key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf8")
+        if len(key) > self.MAX_KEY_SIZE:
+            return None
+        return key
+
+    def _get_offsets(self, key):
+        """Get the lock stripe and slot offsets of the set for a key."""
+        set_index = key_hash(key) % self.sets
+        return set_index % self.STRIPES, self._get_set_offsets(set_index)
+
+    def _get_set_offsets(self, set_index):
+        start = self._table.offset(set_index * self.WAYS)
+        return xrange(start, start + self.WAYS * self.SLOT_SIZE,
+                      self.SLOT_SIZE)
+
+    def _slot_key(self, offset, keylen):
+        start = offset + self.SLOT.size
+        return self._map[start:start + keylen]
+
+    def _read_slot(self, offset, key):
+        """Read a slot without locking, if it holds the given key.
+
+        Returns a tuple of (kind, expires, value, version), or None if the
+        slot holds some other key or could not be read consistently.
+        """
+        for attempt in xrange(self.READ_ATTEMPTS):
+            seq, expires, kind, keylen, verlen, length = \
+                self.SLOT.unpack_from(self._map, offset)
+            if seq & 1:
+                continue
+            found = None
+            if kind != self.EMPTY and self._slot_key(offset, keylen) == key:
+                start = offset + self.SLOT.size + self.MAX_KEY_SIZE
+                verlen = min(verlen, self.MAX_VERSION_SIZE)
+                version = self._map[start:start + verlen]
+                start += self.MAX_VERSION_SIZE
+                length = min(length, self.MAX_VALUE_SIZE)
+                found = (kind, expires, self._map[start:start + length],
+                         version)
+            if self.SEQUENCE.unpack_from(self._map, offset)[0] == seq:
+                return found
+        return None
+
+    def _write_slot(self, offset, expires, kind, key, value, version=""):
+        """Overwrite a slot; the caller must hold the lock for its set."""
+        # A writer that died half way through may have left the sequence
+        # number odd, in which case it stays odd until we're done.
+        seq = self.SEQUENCE.unpack_from(self._map, offset)[0] | 1
+        self.SEQUENCE.pack_into(self._map, offset, seq)
+        start = offset + self.SLOT.size
+        self._map[start:start + len(key)] = key
+        start += self.MAX_KEY_SIZE
+        self._map[start:start + len(version)] = version
+        start += self.MAX_VERSION_SIZE
+        self._map[start:start + len(value)] = value
+        self.SLOT.pack_into(self._map, offset, seq, expires, kind, len(key),
+                            len(version), len(value))
+        self.SEQUENCE.pack_into(self._map, offset, seq + 1)
+
+    def _bump_generation(self):
+        with self._locked(self.STRIPES):
+            generation = self.generation + 1
+            self.SEQUENCE.pack_into(self._map, self.GENERATION_OFFSET,
+                                    generation)
+        return generation
+
+    def _locked(self, index):
+        """Hold the numbered lock against other threads and processes."""
+        return self._table.locked(self.LOCKS_OFFSET + index, 1)
+
+    def _live_slots(self):
+        """Get the value sizes of all unexpired slots."""
+        now = time.time()
+        sizes = []
+        for set_index in xrange(self.sets):
+            for offset in self._get_set_offsets(set_index):
+                seq, expires, kind, keylen, verlen, length = \
+                    self.SLOT.unpack_from(self._map, offset)
+                if kind != self.EMPTY and expires > now:
+                    sizes.append(length)
+        return sizes
+
+
+class CachingKeyRetrievalStorage(object):
+    """IKeyRetrievalStorage that caches reads from another backend.
+
+    Reads are served from an in-memory LRU cache where possible, falling
+    through to the wrapped backend on a miss.  Userids with no stored data
+    are cached negatively for a shorter period.  Writes go to the wrapped
+    backend first and are then written through to the cache.
+
+    Each write invalidates the userid both before and after writing to the
+    backend.  The second invalidation discards the puts of any concurrent
+    reads that may have fetched the old data, and the written-through value
+    is put using the generation that it started, so that it is discarded
+    in turn if another write follows.
+
+    The "wraps" argument may be an IKeyRetrievalStorage instance, or the
+    dotted name of a backend class to be constructed from the remaining
+    keyword arguments.  If "cache_shared_file" is given then the cache is
+    a SharedMemoryCache kept in that file.
+    """
+
+    implements(IKeyRetrievalStorage)
+
+    def __init__(self, wraps, cache_max_items=10000,
+                 cache_max_bytes=16 * 1024 * 1024, cache_ttl=300,
+                 cache_miss_ttl=10, cache_shared_file=None, **kwds):
+        if isinstance(wraps, basestring):
+            wraps = resolve_name(wraps)(**kwds)
+        self.storage = wraps
+        self.cache_ttl = int(cache_ttl)
+        self.cache_miss_ttl = int(cache_miss_ttl)
+        if cache_shared_file:
+            self.cache = SharedMemoryCache(cache_shared_file,
+                                           int(cache_max_items))
+        else:
+            self.cache = LRUCache(int(cache_max_items),
+                                  int(cache_max_bytes))
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self._stats_lock = threading.Lock()
+
+    def get_stats(self):
+        """Get a dict of counters describing cache effectiveness."""
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+            negative_hits = self.negative_hits
+        return {
+            "hits": hits,
+            "negative_hits": negative_hits,
+            "misses": misses,
+            "evictions": self.cache.evictions,
+            "items": len(self.cache),
+            "bytes": self.cache.total_bytes,
+        }
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _lookup(self, userid):
+        """Look up a userid in the cache, counting the hit or miss.
+
+        Returns the cached (data, version) pair, MISSING, or None on a miss.
+        """
+        value = self.cache.get(userid)
+        if value is MISSING:
+            self._count("negative_hits")
+        elif value is not None:
+            self._count("hits")
+        else:
+            self._count("misses")
+        return value
+
+    def get(self, userid):
+        value = self._lookup(userid)
+        if value is MISSING:
+            raise KeyError(userid)
+        if value is not None:
+            return value[0]
+        generation = self.cache.generation
+        try:
+            value = self.storage.get(userid)
+        except KeyError:
+            self.cache.put(userid, MISSING, 0, self.cache_miss_ttl,
+                           generation)
+            raise
+        self._put_data(userid, value, compute_version(value), generation)
+        return value
+
+    def get_with_version(self, userid, gzipped=False):
+        # Only uncompressed data is cached, so serve that if we have it.
+        value = self._lookup(userid)
+        if value is MISSING:
+            raise KeyError(userid)
+        if value is not None:
+            return value[0], value[1], False
+        generation = self.cache.generation
+        try:
+            result = self.storage.get_with_version(userid, gzipped)
+        except KeyError:
+            self.cache.put(userid, MISSING, 0, self.cache_miss_ttl,
+                           generation)
+            raise
+        data, version, is_gzipped = result
+        if not is_gzipped:
+            self._put_data(userid, data, version, generation)
+        return result
+
+    def get_version(self, userid):
+        value = self._lookup(userid)
+        if value is MISSING:
+            raise KeyError(userid)
+        if value is not None:
+            return value[1]
+        return self.storage.get_version(userid)
+
+    def set(self, userid, data, if_match=None):
+        self.cache.invalidate(userid)
+        try:
+            version = self.storage.set(userid, data, if_match)
+        finally:
+            generation = self.cache.invalidate(userid)
+        self._put_data(userid, data, version, generation)
+        return version
+
+    def delete(self, userid, if_match=None):
+        self.cache.invalidate(userid)
+        try:
+            self.storage.delete(userid, if_match)
+        except KeyError:
+            self._put_missing(userid)
+            raise
+        except Exception:
+            self.cache.invalidate(userid)
+            raise
+        self._put_missing(userid)
+
+    def _put_data(self, userid, data, version, generation):
+        # The version is cached too, so that hits needn't hash the data.
+        self.cache.put(userid, (data, version), len(data), self.cache_ttl,
+                       generation)
+
+    def _put_missing(self, userid):
+        generation = self.cache.invalidate(userid)
+        self.cache.put(userid, MISSING, 0, self.cache_miss_ttl, generation)
+
+    def get_many(self, userids):
+        results = {}
+        to_fetch = []
+        for userid in userids:
+            value = self._lookup(userid)
+            if value is None:
+                to_fetch.append(userid)
+            elif value is not MISSING:
+                results[userid] = value[0]
+        if to_fetch:
+            generation = self.cache.generation
+            fetched = self.storage.get_many(to_fetch)
+            for userid in to_fetch:
+                value = fetched.get(userid)
+                if value is None:
+                    self.cache.put(userid, MISSING, 0, self.cache_miss_ttl,
+                                   generation)
+                else:
+                    self._put_data(userid, value, compute_version(value),
+                                   generation)
+                    results[userid] = value
+        return results
+
+    def set_many(self, items):
+        if hasattr(items, "iteritems"):
+            items = items.iteritems()
+        items = list(items)
+        for userid, data in items:
+            self.cache.invalidate(userid)
+        try:
+            self.storage.set_many(items)
+        finally:
+            for userid, data in items:
+                self.cache.invalidate(userid)
+
+    def delete_many(self, userids):
+        userids = list(userids)
+        for userid in userids:
+            self.cache.invalidate(userid)
+        try:
+            return self.storage.delete_many(userids)
+        finally:
+            for userid in userids:
+                self.cache.invalidate(userid)
+
+    def purge_expired(self, limit=None):
+        # We don't know which userids were purged, so drop everything.
+        count = self.storage.purge_expired(limit)
+        if count:
+            self.cache.clear()
+        return count
@@ -0,0 +1,279 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Request-coalescing wrapper for key-retrieval storage backends.
+
+When a user signs in on several devices at once, or a client retries
+aggressively, identical requests for the same userid arrive together.
+This module provides an IKeyRetrievalStorage implementation that lets
+concurrent reads of one userid share a single call to the wrapped backend.
+It can be configured in the [storage] section like so::
+
+    [storage]
+    backend = keyretrieval.storage.coalesce:CoalescingKeyRetrievalStorage
+    wraps = keyretrieval.storage.sql:SQLKeyRetrievalStorage
+    coalesce_writes = true
+    sqluri = sqlite:////tmp/keyretrieval.db
+
+With "coalesce_writes" enabled, unconditional writes to a userid that
+arrive while another write to it is in progress are queued up, and only
+the last of them is sent to the backend.  Coalescing happens only between
+threads (or greenlets) of a single process.
+
+"""
+
+import sys
+import threading
+
+from zope.interface import implements
+
+from pyramid.settings import asbool
+
+from mozsvc.exceptions import BackendError
+from mozsvc.util import resolve_name
+
+from keyretrieval.storage import IKeyRetrievalStorage
+
+
+# The reads that can be coalesced, as a method name and its arguments
+# after the userid.
+READS = (("get",), ("get_version",), ("get_with_version", False),
+         ("get_with_version", True))
+
+
+class _Flight(object):
+    """A single call to the backend, whose result may be shared."""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.callers = 1
+        self.result = None
+        self.exc_info = None
+        self.mergeable = False
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        except BaseException:
+            # The caller running this was interrupted, e.g. by a gevent
+            # Timeout, which is for that caller alone to see.
+            self.abandon()
+            raise
+        finally:
+            self._done.set()
+
+    def abandon(self):
+        """Fail the call for anyone waiting on it, without running it."""
+        error = BackendError("coalesced call was interrupted")
+        self.exc_info = (BackendError, error, None)
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class CoalescingKeyRetrievalStorage(object):
+    """IKeyRetrievalStorage that coalesces concurrent calls for a userid.
+
+    A read of a userid made while an identical read is already in flight
+    waits for that read and shares its result or exception.  Writes always
+    start a fresh read, so once a write has returned no caller is served
+    data from before it.
+
+    If "coalesce_writes" is true then all writes to a userid are queued
+    and applied in order by whichever caller arrived first.  Consecutive
+    unconditional sets in the queue are merged, so that only the last of
+    them is sent, and all their callers get its version back.  Conditional
+    writes and deletes are never merged.
+
+    The "wraps" argument may be an IKeyRetrievalStorage instance, or the
+    dotted name of a backend class to be constructed from the remaining
+    keyword arguments.
+    """
+
+    implements(IKeyRetrievalStorage)
+
+    def __init__(self, wraps, coalesce_writes=False, **kwds):
+        if isinstance(wraps, basestring):
+            wraps = resolve_name(wraps)(**kwds)
+        self.storage = wraps
+        self.coalesce_writes = asbool(coalesce_writes)
+        self.reads = 0
+        self.coalesced_reads = 0
+        self.writes = 0
+        self.coalesced_writes = 0
+        self._lock = threading.Lock()
+        self._reads = {}
+        self._writes = {}
+
+    def get_stats(self):
+        """Get a dict of counters describing coalescing effectiveness."""
+        return {
+            "reads": self.reads,
+            "coalesced_reads": self.coalesced_reads,
+            "writes": self.writes,
+            "coalesced_writes": self.coalesced_writes,
+        }
+
+    def _read(self, name, userid, *args):
+        key = (name, userid) + args
+        with self._lock:
+            self.reads += 1
+            flight = self._reads.get(key)
+            if flight is not None:
+                flight.callers += 1
+                self.coalesced_reads += 1
+                leader = False
+            else:
+                func = getattr(self.storage, name)
+                flight = self._reads[key] = _Flight(func, (userid,) + args)
+                leader = True
+        if not leader:
+            return flight.wait()
+        try:
+            flight.run()
+        finally:
+            self._forget_reads(userid, flight)
+        return flight.wait()
+
+    def _forget_reads(self, userid, flight=None):
+        # Stop any new callers from joining the read(s) of this userid.
+        with self._lock:
+            for read in READS:
+                key = (read[0], userid) + read[1:]
+                if flight is None or self._reads.get(key) is flight:
+                    self._reads.pop(key, None)
+
+    def _write(self, name, userid, *args):
+        func = getattr(self.storage, name)
+        self._forget_reads(userid)
+        if not self.coalesce_writes:
+            with self._lock:
+                self.writes += 1
+            try:
+                return func(userid, *args)
+            finally:
+                self._forget_reads(userid)
+        mergeable = name == "set" and args[1] is None
+        with self._lock:
+            self.writes += 1
+            queue = self._writes.get(userid)
+            leader = queue is None
+            if leader:
+                queue = self._writes[userid] = []
+            last = queue[-1] if queue else None
+            if mergeable and last is not None and last.mergeable:
+                last.args = (userid,) + args
+                last.callers += 1
+                self.coalesced_writes += 1
+                flight = last
+            else:
+                flight = _Flight(func, (userid,) + args)
+                flight.mergeable = mergeable
+                queue.append(flight)
+        if leader:
+            self._drain_writes(userid, queue)
+        return flight.wait()
+
+    def _drain_writes(self, userid, queue):
+        try:
+            while True:
+                with self._lock:
+                    if not queue:
+                        del self._writes[userid]
+                        break
+                    flight = queue.pop(0)
+                    flight.mergeable = False
+                flight.run()
+                self._forget_reads(userid)
+        except BaseException:
+            # With no-one left to run the queued writes, fail them all and
+            # let the next write start a fresh queue.
+            with self._lock:
+                del self._writes[userid]
+                abandoned = queue[:]
+                del queue[:]
+            for flight in abandoned:
+                flight.abandon()
+            self._forget_reads(userid)
+            raise
+
+    def get(self, userid):
+        return self._read("get", userid)
+
+    def get_with_version(self, userid, gzipped=False):
+        return self._read("get_with_version", userid, bool(gzipped))
+
+    def get_version(self, userid):
+        return self._read("get_version", userid)
+
+    def set(self, userid, data, if_match=None):
+        return self._write("set", userid, data, if_match)
+
+    def delete(self, userid, if_match=None):
+        return self._write("delete", userid, if_match)
+
+    def get_many(self, userids):
+        return self.storage.get_many(userids)
+
+    def set_many(self, items):
+        if hasattr(items, "iteritems"):
+            items = items.iteritems()
+        items = list(items)
+        try:
+            return self.storage.set_many(items)
+        finally:
+            for userid, data in items:
+                self._forget_reads(userid)
+
+    def delete_many(self, userids):
+        userids = list(userids)
+        try:
+            return self.storage.delete_many(userids)
+        finally:
+            for userid in userids:
+                self._forget_reads(userid)
+
+    def purge_expired(self, limit=None):
+        return self.storage.purge_expired(limit)
@@ -0,0 +1,184 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Cooperative storage wrapper for serving requests under gevent.
+
+Rather than a thread per request, the gevent worker in gunicorn runs each
+request in a greenlet, so a single process can hold thousands of requests
+in flight while they wait on the database::
+
+    gunicorn -k gevent --worker-connections 2000 \
+             --paste etc/keyretrieval-prod.ini
+
+Pure-python database drivers become cooperative under gevent's monkey
+patching, but C drivers such as MySQLdb and sqlite3 block the whole
+process while they wait.  Wrapping the backend like so runs each storage
+call in a bounded pool of real threads, leaving the event loop free to
+serve other requests in the meantime::
+
+    [storage]
+    backend = keyretrieval.storage.green:GeventKeyRetrievalStorage
+    wraps = keyretrieval.storage.sql:SQLKeyRetrievalStorage
+    threadpool_size = 20
+    sqluri = mysql://user:pass@db/keys
+
+The thread pool size bounds the number of concurrent database calls, so
+it should be no larger than the connection pool of the wrapped backend.
+
+By default the thread pool is only used if the threading module has not
+been monkey-patched, e.g. with ``monkey.patch_all(thread=False)``.  This
+is checked on the first storage call rather than at startup, since with
+``gunicorn --preload`` the application is loaded before the gevent worker
+patches anything.  Set ``use_threadpool`` to decide explicitly.
+
+Once threading has been patched, the locks of the wrapped backend and of
+its connection pool are gevent primitives, which must not be used from
+real threads.  Storage calls are then made directly from the calling
+greenlet instead, so the database driver must be a cooperative,
+pure-python one such as PyMySQL::
+
+    sqluri = mysql+pymysql://user:pass@db/keys
+
+"""
+
+import sys
+
+from zope.interface import implements
+
+from gevent import monkey
+from gevent.threadpool import ThreadPool
+
+from pyramid.settings import asbool
+
+from mozsvc.util import resolve_name
+
+from keyretrieval.metrics import in_request_context
+from keyretrieval.storage import IKeyRetrievalStorage
+
+
+class GeventKeyRetrievalStorage(object):
+    """IKeyRetrievalStorage running another backend in gevent's threads.
+
+    Each call blocks only the calling greenlet, while the wrapped backend
+    does its work in a thread from the pool.  Results and exceptions are
+    passed back unchanged, so the semantics are exactly those of the
+    wrapped backend.  Unless "use_threadpool" is given, the pool is not
+    used if threading has been monkey-patched by the time of the first
+    call; see above.
+
+    The "wraps" argument may be an IKeyRetrievalStorage instance, or the
+    dotted name of a backend class to be constructed from the remaining
+    keyword arguments.
+    """
+
+    implements(IKeyRetrievalStorage)
+
+    def __init__(self, wraps, threadpool_size=20, use_threadpool=None,
+                 **kwds):
+        if isinstance(wraps, basestring):
+            wraps = resolve_name(wraps)(**kwds)
+        self.storage = wraps
+        self.threadpool_size = int(threadpool_size)
+        if use_threadpool is not None:
+            use_threadpool = asbool(use_threadpool)
+        self._use_threadpool = use_threadpool
+        self._threadpool = None
+
+    @property
+    def use_threadpool(self):
+        if self._use_threadpool is None:
+            patched = monkey.is_module_patched("threading")
+            self._use_threadpool = not patched
+        return self._use_threadpool
+
+    @use_threadpool.setter
+    def use_threadpool(self, value):
+        self._use_threadpool = value
+
+    @property
+    def threadpool(self):
+        # Created on first use, since the pool's threads would not survive
+        # gunicorn forking the worker processes.
+        if self._threadpool is None:
+            self._threadpool = ThreadPool(self.threadpool_size)
+        return self._threadpool
+
+    def _call(self, func, *args):
+        if not self.use_threadpool:
+            return func(*args)
+        # Exceptions are passed back as values and re-raised here, since
+        # gevent would otherwise log every KeyError as a crashed task.
+        func = in_request_context(func)
+        ok, result = self.threadpool.apply(_capture, (func, args))
+        if not ok:
+            raise result[0], result[1], result[2]
+        return result
+
+    def get(self, userid):
+        return self._call(self.storage.get, userid)
+
+    def get_with_version(self, userid, gzipped=False):
+        return self._call(self.storage.get_with_version, userid, gzipped)
+
+    def get_version(self, userid):
+        return self._call(self.storage.get_version, userid)
+
+    def set(self, userid, data, if_match=None):
+        return self._call(self.storage.set, userid, data, if_match)
+
+    def delete(self, userid, if_match=None):
+        return self._call(self.storage.delete, userid, if_match)
+
+    def get_many(self, userids):
+        return self._call(self.storage.get_many, userids)
+
+    def set_many(self, items):
+        return self._call(self.storage.set_many, items)
+
+    def delete_many(self, userids):
+        return self._call(self.storage.delete_many, userids)
+
+    def purge_expired(self, limit=None):
+        return self._call(self.storage.purge_expired, limit)
+
+
+def _capture(func, args):
+    """Call the given function, returning (success, result or exc_info)."""
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, sys.exc_info()
@@ -0,0 +1,568 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Embedded storage backend using an append-only log file.
+
+For small deployments this avoids running a database server, and the
+per-query overhead of going through SQLAlchemy.  It can be configured in
+the [storage] section like so::
+
+    [storage]
+    backend = keyretrieval.storage.logfile:LogKeyRetrievalStorage
+    path = /var/lib/keyretrieval
+    sync = true
+
+Every write appends a record to the file "keydata.log" in the given
+directory, and an in-memory index maps each userid to the offset of its
+latest record, which is read back through a memory-mapping of the log.
+The index is saved to "keydata.idx" on close and after each compaction, so
+that at startup only the part of the log written since then is scanned.
+
+Each record carries a CRC32.  If the process dies part way through a
+write, then on restart the log is truncated at the first bad record.
+
+With "sync" enabled, writes do not return until the log is fsynced to
+disk.  Writers that arrive while an fsync is in progress share the next
+one, and setting "sync_delay" (in seconds) makes each fsync wait a little
+to gather more writers.  Once overwritten and deleted records make up at
+least "compact_ratio" of a log of at least "compact_min_bytes" bytes, the
+live records are copied to a fresh log in a background thread.
+
+The log can only be opened by one process at a time, so this backend is
+not suitable for use with several worker processes.
+
+"""
+
+import os
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import hashlib
+import binascii
+import threading
+
+from zope.interface import implements
+
+from pyramid.settings import asbool
+
+from keyretrieval.storage import IKeyRetrievalStorage, ConflictError
+
+
+# The log starts with a magic string and a random id, which the saved
+# index also records so that it is never applied to the wrong log.
+LOG_MAGIC = "KRLOG1\n\x00"
+LOG_ID_SIZE = 16
+LOG_HEADER_SIZE = len(LOG_MAGIC) + LOG_ID_SIZE
+
+INDEX_MAGIC = "KRIDX1\n\x00"
+
+# Each record is a CRC32 of the rest of the record, then the record type,
+# the lengths of the userid and data, the md5 digest of the data, and the
+# userid and data themselves.  Deletes have no data and a zero digest.
+RECORD_CRC = struct.Struct("<I")
+RECORD_HEADER = struct.Struct("<BHI")
+RECORD_PREFIX_SIZE = RECORD_CRC.size + RECORD_HEADER.size + 16
+
+# Record types; unicode data is stored utf8-encoded, and decoded on read.
+RECORD_TEXT = 1
+RECORD_BYTES = 2
+RECORD_DELETE = 3
+
+# Each index entry is the offset and length of the record, the length of
+# the userid, the md5 digest of the data and the userid itself.
+INDEX_HEADER = struct.Struct("<QQI")
+INDEX_ENTRY = struct.Struct("<QIH")
+
+NO_DIGEST = "\x00" * 16
+
+
+def encode_record(userid, data):
+    """Encode a log record storing the given data, or deleting if None.
+
+    Returns a tuple of (record, digest).
+    """
+    if isinstance(userid, unicode):
+        userid = userid.encode("utf8")
+    if data is None:
+        kind, data, digest = RECORD_DELETE, "", NO_DIGEST
+    else:
+        kind = RECORD_BYTES
+        if isinstance(data, unicode):
+            kind, data = RECORD_TEXT, data.encode("utf8")
+        digest = hashlib.md5(data).digest()
+    body = "".join((RECORD_HEADER.pack(kind, len(userid), len(data)),
+                    digest, userid, data))
+    crc = zlib.crc32(body) & 0xffffffff
+    return RECORD_CRC.pack(crc) + body, digest
+
+
+def decode_record(buf, offset, length):
+    """Decode the data from the log record at the given offset."""
+    prefix_end = offset + RECORD_PREFIX_SIZE
+    kind, userid_len, data_len = RECORD_HEADER.unpack(
+        buf[offset + RECORD_CRC.size:prefix_end - 16])
+    data = buf[prefix_end + userid_len:offset + length]
+    if kind == RECORD_TEXT:
+        data = data.decode("utf8")
+    return data
+
+
+def scan_records(buf, offset, end, index):
+    """Apply the valid log records in buf[offset:end] to the given index.
+
+    The index maps userids to (offset, length, digest) tuples.  Scanning
+    stops at the first record that is incomplete or fails its checksum.
+    Returns the offset at which it stopped, and the number of bytes taken
+    up by records that have been overwritten or deleted.
+    """
+    dead = 0
+    while offset + RECORD_PREFIX_SIZE <= end:
+        prefix_end = offset + RECORD_PREFIX_SIZE
+        crc, = RECORD_CRC.unpack(buf[offset:offset + RECORD_CRC.size])
+        kind, userid_len, data_len = RECORD_HEADER.unpack(
+            buf[offset + RECORD_CRC.size:prefix_end - 16])
+        length = RECORD_PREFIX_SIZE + userid_len + data_len
+        if offset + length > end:
+            break
+        body = buf[offset + RECORD_CRC.size:offset + length]
+        if zlib.crc32(body) & 0xffffffff != crc:
+            break
+        try:
+            userid = buf[prefix_end:prefix_end + userid_len].decode("utf8")
+        except UnicodeDecodeError:
+            break
+        old = index.pop(userid, None)
+        if old is not None:
+            dead += old[1]
+        if kind == RECORD_DELETE:
+            dead += length
+        else:
+            index[userid] = (offset, length, buf[prefix_end - 16:prefix_end])
+        offset += length
+    return offset, dead
+
+
+class LogKeyRetrievalStorage(object):
+    """IKeyRetrievalStorage implemented as an append-only log file.
+
+    See the module docstring for details of the storage format and the
+    available options.
+    """
+
+    implements(IKeyRetrievalStorage)
+
+    def __init__(self, path, sync=True, sync_delay=0, compact_ratio=0.5,
+                 compact_min_bytes=1024 * 1024, **kwds):
+        self.path = path
+        self.sync = asbool(sync)
+        self.sync_delay = float(sync_delay)
+        self.compact_ratio = float(compact_ratio)
+        self.compact_min_bytes = int(compact_min_bytes)
+        self.log_file = os.path.join(path, "keydata.log")
+        self.index_file = os.path.join(path, "keydata.idx")
+        self.syncs = 0
+        self.compactions = 0
+        self.truncated_bytes = 0
+        # The sync lock must always be taken before the main lock.
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._compactor = None
+        self._compact_lock = threading.Lock()
+        self._fd = None
+        self._open()
+
+    def _open(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if os.path.exists(self.log_file + ".compact"):
+            os.unlink(self.log_file + ".compact")
+        if not os.path.exists(self.log_file):
+            self._create_log(self.log_file)
+        fd = os.open(self.log_file, os.O_RDWR | os.O_APPEND)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            raise RuntimeError("log %r is in use by another process"
+                               % (self.log_file,))
+        size = os.fstat(fd).st_size
+        buf = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        if size < LOG_HEADER_SIZE or not buf[:LOG_HEADER_SIZE].startswith(
+                LOG_MAGIC):
+            buf.close()
+            os.close(fd)
+            raise ValueError("%r is not a keyretrieval log" % (self.log_file,))
+        self._log_id = buf[len(LOG_MAGIC):LOG_HEADER_SIZE]
+        loaded = self._load_index(size)
+        if loaded is None:
+            index, offset, dead = {}, LOG_HEADER_SIZE, 0
+        else:
+            index, offset, dead = loaded
+        end, tail_dead = scan_records(buf, offset, size, index)
+        if end < size:
+            # Drop whatever was torn or corrupted by a crash.
+            buf.close()
+            os.ftruncate(fd, end)
+            os.fsync(fd)
+            self.truncated_bytes = size - end
+            buf = mmap.mmap(fd, end, access=mmap.ACCESS_READ)
+        self._fd = fd
+        self._buf = buf
+        self._index = index
+        self._size = self._synced = end
+        self._dead = dead + tail_dead
+
+    def _create_log(self, filename):
+        # Written under a temporary name, so the header is never torn.
+        tmpfile = filename + ".tmp"
+        with open(tmpfile, "wb") as f:
+            f.write(LOG_MAGIC + os.urandom(LOG_ID_SIZE))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpfile, filename)
+        self._sync_dir()
+
+    def _sync_dir(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """Wait for any compaction, save the index and close the log."""
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._sync_lock:
+            with self._lock:
+                if self._fd is None:
+                    return
+                if self.sync:
+                    os.fsync(self._fd)
+                self._save_index(dict(self._index), self._size, self._dead,
+                                 self._log_id)
+                self._buf.close()
+                os.close(self._fd)
+                self._fd = None
+
+    def get_stats(self):
+        """Get a dict of counters describing the state of the log."""
+        with self._lock:
+            return {
+                "items": len(self._index),
+                "log_bytes": self._size,
+                "dead_bytes": self._dead,
+                "syncs": self.syncs,
+                "compactions": self.compactions,
+                "truncated_bytes": self.truncated_bytes,
+            }
+
+    def _save_index(self, index, covered, dead, log_id):
+        chunks = [INDEX_MAGIC, log_id,
+                  INDEX_HEADER.pack(covered, dead, len(index))]
+        for userid, (offset, length, digest) in index.iteritems():
+            userid = userid.encode("utf8")
+            chunks.append(INDEX_ENTRY.pack(offset, length, len(userid)))
+            chunks.append(digest)
+            chunks.append(userid)
+        data = "".join(chunks)
+        data += struct.pack("<I", zlib.crc32(data) & 0xffffffff)
+        tmpfile = self.index_file + ".tmp"
+        with open(tmpfile, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpfile, self.index_file)
+
+    def _load_index(self, log_size):
+        """Load the saved index, if it is intact and matches the log.
+
+        Returns a tuple of (index, covered offset, dead bytes), or None.
+        """
+        try:
+            with open(self.index_file, "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        header_end = len(INDEX_MAGIC) + LOG_ID_SIZE + INDEX_HEADER.size
+        if len(data) < header_end + 4 or not data.startswith(INDEX_MAGIC):
+            return None
+        crc, = struct.unpack("<I", data[-4:])
+        if zlib.crc32(data[:-4]) & 0xffffffff != crc:
+            return None
+        if data[len(INDEX_MAGIC):len(INDEX_MAGIC) + LOG_ID_SIZE] != \
+                self._log_id:
+            return None
+        covered, dead, count = INDEX_HEADER.unpack(
+            data[header_end - INDEX_HEADER.size:header_end])
+        if covered > log_size:
+            return None
+        index = {}
+        pos = header_end
+        for i in xrange(count):
+            offset, length, userid_len = INDEX_ENTRY.unpack(
+                data[pos:pos + INDEX_ENTRY.size])
+            pos += INDEX_ENTRY.size
+            digest = data[pos:pos + 16]
+            userid = data[pos + 16:pos + 16 + userid_len].decode("utf8")
+            pos += 16 + userid_len
+            index[userid] = (offset, length, digest)
+        return index, covered, dead
+
+    def _read(self, userid):
+        """Get the (offset, length, digest) entry for a userid, and data."""
+        with self._lock:
+            entry = self._index.get(userid)
+            if entry is None:
+                raise KeyError(userid)
+            offset, length, digest = entry
+            if offset + length > len(self._buf):
+                self._remap()
+            return entry, decode_record(self._buf, offset, length)
+
+    def _remap(self):
+        # Any previous mapping is left open for whoever is still using it,
+        # and is closed once it is garbage-collected.
+        self._buf = mmap.mmap(self._fd, self._size, access=mmap.ACCESS_READ)
+
+    def _append(self, records):
+        """Append (userid, record, digest) tuples to the log.
+
+        Must be called with the lock held.  Returns the end offset of the
+        last record, for passing to _sync_to().
+        """
+        data = "".join(record for (userid, record, digest) in records)
+        written = 0
+        while written < len(data):
+            written += os.write(self._fd, data[written:])
+        offset = self._size
+        for userid, record, digest in records:
+            old = self._index.pop(userid, None)
+            if old is not None:
+                self._dead += old[1]
+            if digest == NO_DIGEST:
+                self._dead += len(record)
+            else:
+                self._index[userid] = (offset, len(record), digest)
+            offset += len(record)
+        self._size = offset
+        return offset
+
+    def _sync_to(self, end):
+        """Wait until the log has been fsynced up to the given offset.
+
+        Only one fsync runs at a time; any writers that append while it is
+        running are covered by the next one, and share its cost.
+        """
+        if self.sync:
+            with self._sync_lock:
+                if self._synced < end:
+                    if self.sync_delay:
+                        time.sleep(self.sync_delay)
+                    with self._lock:
+                        target = self._size
+                    os.fsync(self._fd)
+                    self.syncs += 1
+                    self._synced = target
+        self._maybe_compact()
+
+    def _check_version(self, userid, if_match):
+        entry = self._index.get(userid)
+        if entry is None:
+            raise ConflictError(userid)
+        if if_match != "*" and binascii.hexlify(entry[2]) != if_match:
+            raise ConflictError(userid)
+
+    def get(self, userid):
+        entry, data = self._read(userid)
+        return data
+
+    def get_with_version(self, userid, gzipped=False):
+        entry, data = self._read(userid)
+        return data, binascii.hexlify(entry[2]), False
+
+    def get_version(self, userid):
+        with self._lock:
+            entry = self._index.get(userid)
+        if entry is None:
+            raise KeyError(userid)
+        return binascii.hexlify(entry[2])
+
+    def set(self, userid, data, if_match=None):
+        record, digest = encode_record(userid, data)
+        with self._lock:
+            if if_match is not None:
+                self._check_version(userid, if_match)
+            end = self._append([(userid, record, digest)])
+        self._sync_to(end)
+        return binascii.hexlify(digest)
+
+    def delete(self, userid, if_match=None):
+        record, digest = encode_record(userid, None)
+        with self._lock:
+            if if_match is None:
+                if userid not in self._index:
+                    raise KeyError(userid)
+            else:
+                self._check_version(userid, if_match)
+            end = self._append([(userid, record, digest)])
+        self._sync_to(end)
+
+    def get_many(self, userids):
+        results = {}
+        for userid in userids:
+            try:
+                entry, results[userid] = self._read(userid)
+            except KeyError:
+                pass
+        return results
+
+    def set_many(self, items):
+        if hasattr(items, "iteritems"):
+            items = items.iteritems()
+        records = []
+        for userid, data in items:
+            record, digest = encode_record(userid, data)
+            records.append((userid, record, digest))
+        if records:
+            with self._lock:
+                end = self._append(records)
+            self._sync_to(end)
+
+    def delete_many(self, userids):
+        with self._lock:
+            records = []
+            for userid in set(userids):
+                if userid in self._index:
+                    record, digest = encode_record(userid, None)
+                    records.append((userid, record, digest))
+            if not records:
+                return 0
+            end = self._append(records)
+        self._sync_to(end)
+        return len(records)
+
+    def purge_expired(self, limit=None):
+        # Access times aren't tracked, so nothing ever expires.
+        return 0
+
+    def _maybe_compact(self):
+        with self._lock:
+            if self._compactor is not None or self._fd is None:
+                return
+            if self._dead < self.compact_min_bytes:
+                return
+            if self._dead < self.compact_ratio * self._size:
+                return
+            self._compactor = threading.Thread(target=self._compact_async)
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def _compact_async(self):
+        try:
+            self.compact()
+        finally:
+            self._compactor = None
+
+    def compact(self):
+        """Rewrite the log to contain only live records.
+
+        Writes carry on while the live records are copied, and anything
+        written in the meantime is copied across before the new log is
+        swapped into place.
+        """
+        with self._compact_lock:
+            self._compact()
+
+    def _compact(self):
+        with self._lock:
+            if self._fd is None:
+                return
+            self._remap()
+            buf = self._buf
+            snapshot = self._index.items()
+            snapshot_end = self._size
+        snapshot.sort(key=lambda item: item[1][0])
+        new_file = self.log_file + ".compact"
+        new_id = os.urandom(LOG_ID_SIZE)
+        new_index = {}
+        with open(new_file, "wb") as f:
+            f.write(LOG_MAGIC + new_id)
+            offset = LOG_HEADER_SIZE
+            for userid, (old_offset, length, digest) in snapshot:
+                f.write(buf[old_offset:old_offset + length])
+                new_index[userid] = (offset, length, digest)
+                offset += length
+            f.flush()
+            os.fsync(f.fileno())
+        new_fd = os.open(new_file, os.O_RDWR | os.O_APPEND)
+        try:
+            with self._sync_lock:
+                with self._lock:
+                    # Copy across anything written since the snapshot.
+                    if self._size > snapshot_end:
+                        self._remap()
+                        tail = self._buf[snapshot_end:self._size]
+                        written = 0
+                        while written < len(tail):
+                            written += os.write(new_fd, tail[written:])
+                    os.fsync(new_fd)
+                    new_size = os.fstat(new_fd).st_size
+                    new_buf = mmap.mmap(new_fd, new_size,
+                                        access=mmap.ACCESS_READ)
+                    end, dead = scan_records(new_buf, offset, new_size,
+                                             new_index)
+                    fcntl.flock(new_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.rename(new_file, self.log_file)
+                    self._sync_dir()
+                    os.close(self._fd)
+                    self._fd = new_fd
+                    self._buf = new_buf
+                    self._log_id = new_id
+                    self._index = new_index
+                    self._size = self._synced = new_size
+                    self._dead = dead
+                    self.compactions += 1
+                    index = dict(new_index)
+        except:
+            if new_fd != self._fd:
+                os.close(new_fd)
+            raise
+        self._save_index(index, new_size, dead, new_id)
@@ -0,0 +1,171 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Fixed-size tables of slots in memory-mapped files shared by processes.
+
+Several parts of the service keep state that every worker process on the
+machine must agree on, such as rate-limiting buckets or change sequence
+numbers, in a file that each of them maps into memory.  SharedSlotTable
+takes care of creating the file, checking that every process lays it out
+in the same way, and locking slots against other threads and processes.
+
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+
+
+def key_hash(key):
+    """Hash a string key to a 64-bit integer, the same in every process."""
+    if isinstance(key, unicode):
+        key = key.encode("utf8")
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+
+class SharedSlotTable(object):
+    """Fixed number of equal-sized slots in a memory-mapped file.
+
+    The file starts with a header of "header_size" bytes holding the given
+    magic string and the layout of the table, i.e. the slot size, the
+    number of slots and any other "layout" string given by the owner.  The
+    header from USER_OFFSET onwards is free for the owner's own use.  A
+    file in a different format or layout is started afresh if no other
+    process has it open, and otherwise ValueError is raised, since the
+    processes would look for each key in different places and overwrite
+    each other's slots.  The error names the "size_setting" that sets the
+    number of slots, if given, as the setting most likely to differ.
+
+    The mapped file is available as "map", and the offset of each slot
+    is given by offset().  Slots are locked with locked(), which holds a
+    byte-range lock on the file against other processes and one of
+    "lock_stripes" thread locks against other threads of this process,
+    since byte-range locks don't exclude those.
+    """
+
+    MAGIC_SIZE = 8
+    # The layout is given by (slot size, number of slots).
+    LAYOUT = struct.Struct("<II")
+    LAYOUT_OFFSET = MAGIC_SIZE
+    USER_OFFSET = 64
+
+    def __init__(self, filename, magic, slot_size, slots, header_size=None,
+                 layout="", lock_stripes=64, size_setting=None):
+        if len(magic) != self.MAGIC_SIZE:
+            raise ValueError("magic must be %d bytes" % (self.MAGIC_SIZE,))
+        layout = self.LAYOUT.pack(slot_size, slots) + layout
+        if self.LAYOUT_OFFSET + len(layout) > self.USER_OFFSET:
+            raise ValueError("layout is too long")
+        if header_size is None:
+            header_size = self.USER_OFFSET
+        self.filename = filename
+        self.slot_size = slot_size
+        self.slots = slots
+        self.header_size = header_size
+        self.size_setting = size_setting
+        size = header_size + slot_size * slots
+        self._locks = [threading.Lock() for i in xrange(lock_stripes)]
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            self._open(size, magic, layout)
+        except Exception:
+            os.close(self._fd)
+            raise
+        self.map = mmap.mmap(self._fd, size)
+
+    def _open(self, size, magic, layout):
+        """Check the header of the file, or write it if starting afresh."""
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.MAGIC_SIZE, 0)
+        try:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            header = os.read(self._fd, self.LAYOUT_OFFSET + len(layout))
+            if header[:self.MAGIC_SIZE] != magic or \
+                    header[self.LAYOUT_OFFSET:] != layout:
+                self._start_afresh(size, magic, layout)
+            elif os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            # Every process using the file holds a shared lock on it, so
+            # that the layout is never changed from under it.
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.MAGIC_SIZE, 0)
+
+    def _start_afresh(self, size, magic, layout):
+        """Empty a new file, or one in a different format or layout."""
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            msg = "%s is in use with a different layout" % (self.filename,)
+            if self.size_setting:
+                msg += "; check that %s matches" % (self.size_setting,)
+            raise ValueError(msg)
+        os.ftruncate(self._fd, 0)
+        os.ftruncate(self._fd, size)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, magic)
+        os.lseek(self._fd, self.LAYOUT_OFFSET, os.SEEK_SET)
+        os.write(self._fd, layout)
+
+    def close(self):
+        self.map.close()
+        os.close(self._fd)
+
+    def offset(self, index):
+        """Get the offset in the file of the numbered slot."""
+        return self.header_size + index * self.slot_size
+
+    def offset_for(self, key):
+        """Get the offset of the slot picked by the hash of a key."""
+        return self.offset(key_hash(key) % self.slots)
+
+    @contextmanager
+    def locked(self, offset, length):
+        """Hold a lock on the given bytes against threads and processes.
+
+        Locks on offsets less than "lock_stripes" apart never share a
+        thread lock, so that a caller may hold several of them at once.
+        """
+        with self._locks[offset % len(self._locks)]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
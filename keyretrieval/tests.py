@@ -34,17 +34,69 @@
 #
 # ***** END LICENSE BLOCK *****
 
+import os
+import sys
+import gzip
+import ConfigParser
+import time
+import shutil
+import socket
+import tempfile
+from StringIO import StringIO
+import threading
 import unittest
+import multiprocessing
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from nose.plugins.skip import SkipTest
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+from mozsvc.exceptions import BackendError, BackendTimeoutError
+from mozsvc.util import resolve_name
+
+from webob import Request
 
 from pyramid import testing
+from pyramid.exceptions import ConfigurationError
 from pyramid.httpexceptions import (HTTPNotFound,
                                     HTTPUnsupportedMediaType,
                                     HTTPLengthRequired,
-                                    HTTPRequestEntityTooLarge)
+                                    HTTPRequestEntityTooLarge,
+                                    HTTPPreconditionFailed)
 
+from repoze.who.interfaces import IAPIFactory
+
+from keyretrieval import main
+from keyretrieval.changes import (ChangeFeed, LocalSequenceTable,
+                                  SharedSequenceTable, LocalPubSub,
+                                  SocketPubSub,
+                                  ChangeNotifyingKeyRetrievalStorage)
+from keyretrieval.ratelimit import LocalBucketStore, SharedBucketStore
+from keyretrieval.verifiers import CachingVerifier
 from keyretrieval.views import get_key, put_key, delete_key
-from keyretrieval.storage import IKeyRetrievalStorage
-from keyretrieval.storage.sql import SQLKeyRetrievalStorage
+from keyretrieval.storage import (IKeyRetrievalStorage, ConflictError,
+                                  compute_version)
+from keyretrieval.storage.sql import (SQLKeyRetrievalStorage, encode_data,
+                                      decode_data, gzip_data,
+                                      SharedStickyTable)
+from keyretrieval.storage.slottable import SharedSlotTable
+from keyretrieval.storage.cache import (CachingKeyRetrievalStorage,
+                                        SharedMemoryCache, MISSING)
+from keyretrieval.storage import cache as cache_module
+from keyretrieval.storage.coalesce import CoalescingKeyRetrievalStorage
+from keyretrieval.storage.logfile import LogKeyRetrievalStorage
+from keyretrieval.storage.sharded import (ShardedSQLKeyRetrievalStorage,
+                                          rebalance)
+from keyretrieval.storage.archive import (ArchiveError, export_archive,
+                                          import_archive, export_parallel,
+                                          import_parallel)
 
 
 class ViewTests(unittest.TestCase):
@@ -132,3 +184,2205 @@ class ViewTests(unittest.TestCase):
         request.content_length = None
         request.content_type = "text/plain"
         self.assertRaises(HTTPLengthRequired, put_key, request)
+
+    def _make_put_request(self, body, headers={}):
+        request = testing.DummyRequest(headers=headers)
+        request.matchdict = {"username": "user1"}
+        request.body = body
+        request.content_length = len(body)
+        request.content_type = "text/plain"
+        return request
+
+    def test_conditional_get(self):
+        res = put_key(self._make_put_request("TEST"))
+        etag = res.etag
+        self.assertTrue(etag)
+        # A matching If-None-Match gets a 304.
+        headers = {"If-None-Match": '"%s"' % (etag,)}
+        request = testing.DummyRequest(headers=headers)
+        request.matchdict = {"username": "user1"}
+        res = get_key(request)
+        self.assertEquals(res.status_int, 304)
+        self.assertEquals(res.etag, etag)
+        # A non-matching one gets the data, and its etag.
+        request = testing.DummyRequest(headers={"If-None-Match": '"OTHER"'})
+        request.matchdict = {"username": "user1"}
+        res = get_key(request)
+        self.assertEquals(res.status_int, 200)
+        self.assertEquals(res.body, "TEST")
+        self.assertEquals(res.etag, etag)
+        # Missing data is still a 404.
+        headers = {"If-None-Match": '"%s"' % (etag,)}
+        request = testing.DummyRequest(headers=headers)
+        request.matchdict = {"username": "user2"}
+        self.assertRaises(HTTPNotFound, get_key, request)
+
+    def test_gzipped_get(self):
+        store = self.config.registry.getUtility(IKeyRetrievalStorage)
+        store.compress = True
+        data = '{"key": "%s"}' % ("A" * 1000,)
+        put_key(self._make_put_request(data))
+        headers = {"Accept-Encoding": "deflate, gzip"}
+        request = testing.DummyRequest(headers=headers)
+        request.matchdict = {"username": "user1"}
+        res = get_key(request)
+        self.assertEquals(res.content_encoding, "gzip")
+        self.assertTrue(len(res.body) < len(data))
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(res.body)).read(),
+                          data)
+        # The etag differs from the uncompressed one, but still matches.
+        self.assertEquals(res.etag, compute_version(data) + "-gzip")
+        headers["If-None-Match"] = '"%s"' % (res.etag,)
+        request = testing.DummyRequest(headers=headers)
+        request.matchdict = {"username": "user1"}
+        res = get_key(request)
+        self.assertEquals(res.status_int, 304)
+        self.assertEquals(res.etag, compute_version(data) + "-gzip")
+        # Clients that don't accept gzip get it uncompressed.
+        headers = {"Accept-Encoding": "gzip;q=0"}
+        request = testing.DummyRequest(headers=headers)
+        request.matchdict = {"username": "user1"}
+        res = get_key(request)
+        self.assertEquals(res.content_encoding, None)
+        self.assertEquals(res.body, data)
+
+    def test_get_reads_the_row_once(self):
+        store = self.config.registry.getUtility(IKeyRetrievalStorage)
+        put_key(self._make_put_request("TEST"))
+        statements = []
+        event.listen(store._engine, "before_cursor_execute",
+                     lambda *args: statements.append(args[2]))
+        for compress in (False, True):
+            store.compress = compress
+            headers = {"Accept-Encoding": "gzip"}
+            request = testing.DummyRequest(headers=headers)
+            request.matchdict = {"username": "user1"}
+            self.assertEquals(get_key(request).body, "TEST")
+        self.assertEquals(len(statements), 2)
+
+    def test_conditional_get_reads_only_the_version(self):
+        store = self.config.registry.getUtility(IKeyRetrievalStorage)
+        etag = put_key(self._make_put_request("TEST")).etag
+
+        def fail(*args):
+            raise AssertionError("the data should not be read")
+
+        store.get_with_version = fail
+        headers = {"If-None-Match": '"OTHER", W/"%s"' % (etag,)}
+        request = testing.DummyRequest(headers=headers)
+        request.matchdict = {"username": "user1"}
+        res = get_key(request)
+        self.assertEquals(res.status_int, 304)
+        self.assertEquals(res.etag, etag)
+        del store.get_with_version
+        headers = {"If-None-Match": '"OTHER"'}
+        request = testing.DummyRequest(headers=headers)
+        request.matchdict = {"username": "user1"}
+        self.assertEquals(get_key(request).body, "TEST")
+
+    def test_conditional_put_and_delete(self):
+        # If-Match fails when there's no data at all.
+        request = self._make_put_request("ONE", {"If-Match": "*"})
+        self.assertRaises(HTTPPreconditionFailed, put_key, request)
+        etag1 = put_key(self._make_put_request("ONE")).etag
+        # Two devices race to update from the same version; one loses.
+        request = self._make_put_request("TWO", {"If-Match": '"%s"' % etag1})
+        etag2 = put_key(request).etag
+        self.assertNotEquals(etag1, etag2)
+        request = self._make_put_request("BAD", {"If-Match": '"%s"' % etag1})
+        self.assertRaises(HTTPPreconditionFailed, put_key, request)
+        # Listing several etags works if any of them is current.
+        headers = {"If-Match": '"%s", "%s"' % (etag1, etag2)}
+        etag3 = put_key(self._make_put_request("THREE", headers)).etag
+        # Deletes must match too.
+        request = testing.DummyRequest(headers={"If-Match": '"%s"' % etag2})
+        request.matchdict = {"username": "user1"}
+        self.assertRaises(HTTPPreconditionFailed, delete_key, request)
+        request = testing.DummyRequest(headers={"If-Match": '"%s"' % etag3})
+        request.matchdict = {"username": "user1"}
+        self.assertEquals(delete_key(request).status_int, 204)
+        # Conditional deletes of missing data fail the precondition.
+        for if_match in ("*", '"%s"' % (etag3,)):
+            request = testing.DummyRequest(headers={"If-Match": if_match})
+            request.matchdict = {"username": "user1"}
+            self.assertRaises(HTTPPreconditionFailed, delete_key, request)
+        request = testing.DummyRequest()
+        request.matchdict = {"username": "user1"}
+        self.assertRaises(HTTPNotFound, get_key, request)
+
+
+class SQLStorageTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.dbfile = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.store = SQLKeyRetrievalStorage("sqlite:///" + self.dbfile,
+                                            create_tables=True,
+                                            warm_up=True)
+
+    def tearDown(self):
+        os.unlink(self.dbfile)
+
+    def _hammer_set(self, num_threads=10, num_writes=20):
+        errors = []
+
+        def writer(n):
+            try:
+                for i in xrange(num_writes):
+                    self.store.set("user%d" % (i % 3,), "DATA%d" % (n,))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in xrange(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        for i in xrange(3):
+            self.assertTrue(self.store.get("user%d" % (i,)).startswith("DATA"))
+
+    def test_concurrent_set_with_native_upsert(self):
+        self._hammer_set()
+
+    def test_concurrent_set_with_fallback_upsert(self):
+        self.store.engine_name = "unknown"
+        self._hammer_set()
+        self.store.set("user0", "FINAL")
+        self.assertEquals(self.store.get("user0"), "FINAL")
+
+    def test_pool_checkout_timeout(self):
+        self.store._engine = create_engine("sqlite:///" + self.dbfile,
+                                           poolclass=QueuePool, pool_size=1,
+                                           max_overflow=0, pool_timeout=0.1)
+        self.store.set("user1", "DATA")
+        connection = self.store._engine.connect()
+        try:
+            self.assertEquals(self.store.get_pool_stats()["pool_checkedout"],
+                              1)
+            try:
+                self.store.get("user1")
+            except BackendTimeoutError, e:
+                self.assertEquals(e.retry_after, 30)
+            else:
+                self.fail("pool checkout should have timed out")
+        finally:
+            connection.close()
+        self.assertEquals(self.store.get("user1"), "DATA")
+        stats = self.store.get_pool_stats()
+        self.assertEquals(stats["timeouts"], 1)
+        self.assertEquals(stats["pool_checkedout"], 0)
+        self.assertEquals(stats["checkout_wait_ms"]["count"], 3)
+
+    def test_retry_after_disconnect(self):
+        self.store.set("user1", "DATA")
+        real_checkout = self.store._checkout
+        failures = []
+
+        def flaky_checkout(**kwds):
+            connection = real_checkout(**kwds)
+            if len(failures) < num_failures:
+                orig = OperationalError("SELECT", {}, Exception("gone away"))
+                failures.append(orig)
+                exc = OperationalError("SELECT", {}, orig,
+                                       connection_invalidated=True)
+                connection.invalidate()
+                connection.execute = lambda *a, **k: self._raise(exc)
+            return connection
+
+        self.store._checkout = flaky_checkout
+        # A single dropped connection is retried transparently.
+        num_failures = 1
+        self.assertEquals(self.store.get("user1"), "DATA")
+        self.assertEquals(self.store.get_pool_stats()["retries"], 1)
+        # But deletes are never retried, and persistent failure gives up.
+        del failures[:]
+        self.assertRaises(BackendError, self.store.delete, "user1")
+        del failures[:]
+        num_failures = 2
+        try:
+            self.store.get("user1")
+        except BackendError, e:
+            self.assertEquals(e.retry_after, 30)
+        else:
+            self.fail("persistent disconnects should have failed")
+        self.assertEquals(self.store.get_pool_stats()["disconnects"], 4)
+
+    def test_database_errors_give_a_short_retry_after(self):
+        settings = {
+            "storage.backend":
+                "keyretrieval.storage.sql:SQLKeyRetrievalStorage",
+            "storage.sqluri": "sqlite:////nonexistent/keys.db",
+            "storage.retry_after": "42",
+            "multiauth.policies": "remoteuser",
+            "multiauth.policy.remoteuser.use":
+                "pyramid.authentication.RemoteUserAuthenticationPolicy",
+        }
+        app = main({}, **settings)
+        request = Request.blank("/user1")
+        request.environ["REMOTE_USER"] = "user1"
+        response = request.get_response(app)
+        self.assertEquals(response.status_int, 503)
+        self.assertEquals(response.headers["Retry-After"], "42")
+
+    def _raise(self, exc):
+        raise exc
+
+    def test_versions_of_rows_written_before_versioning(self):
+        self.store.execute("INSERT INTO keydata (userid, data) "
+                           "VALUES ('user1', 'OLD')")
+        self.assertEquals(self.store.get_version("user1"),
+                          compute_version("OLD"))
+        self.store.execute("UPDATE keydata SET version = NULL")
+        self.assertRaises(ConflictError, self.store.set, "user1", "NEW",
+                          compute_version("WRONG"))
+        self.store.set("user1", "NEW", compute_version("OLD"))
+        self.assertEquals(self.store.get("user1"), "NEW")
+        self.store.execute("UPDATE keydata SET version = NULL")
+        self.store.delete("user1", compute_version("NEW"))
+        self.assertRaises(KeyError, self.store.get_version, "user1")
+
+    def test_data_encoding(self):
+        data = '{"key": "%s"}' % ("A" * 1000,)
+        encoded = encode_data(data, compress=True)
+        self.assertTrue(len(encoded) < len(data))
+        self.assertEquals(decode_data(encoded), data)
+        gzipped = gzip_data(encoded)
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(gzipped)).read(),
+                          data)
+        # Data is left alone unless compressing it saves space.
+        self.assertEquals(encode_data("SHORT", compress=True), "SHORT")
+        self.assertEquals(encode_data(data, compress=False), data)
+        self.assertEquals(gzip_data("SHORT"), None)
+        # Data that looks like it's encoded gets escaped.
+        self.assertEquals(decode_data(encode_data("\x02XYZ")), "\x02XYZ")
+        # Text is stored as text, and compressed via its utf8 encoding.
+        text = u"\N{SNOWMAN}" * 100
+        self.assertEquals(encode_data(text), text)
+        self.assertEquals(decode_data(encode_data(text, compress=True)),
+                          text.encode("utf8"))
+        self.store.set("user1", u"ONE\N{SNOWMAN}")
+        self.assertEquals(self.store.get("user1"), u"ONE\N{SNOWMAN}")
+
+    def test_reencoding_existing_rows(self):
+        data = '{"key": "%s"}' % ("A" * 1000,)
+        self.store.set_many([("user1", data), ("user2", "SHORT")])
+        self.store.compress = True
+        self.store.set("user3", data)
+        self.assertFalse(self.store.get_with_version("user1", True)[2])
+        self.assertEquals(self.store.reencode(dry_run=True), 1)
+        self.assertEquals(self.store.reencode(), 1)
+        self.assertEquals(self.store.reencode(), 0)
+        self.assertTrue(self.store.get_with_version("user1", True)[2])
+        self.assertEquals(self.store.get_many(["user1", "user2", "user3"]),
+                          {"user1": data, "user2": "SHORT", "user3": data})
+        # And back again.
+        self.store.compress = False
+        self.assertEquals(self.store.reencode(), 2)
+        self.assertFalse(self.store.get_with_version("user3", True)[2])
+        self.assertEquals(self.store.get("user3"), data)
+
+    def _check_bulk_operations(self):
+        self.store.batch_size = 7
+        items = dict(("user%d" % (i,), "DATA%d" % (i,)) for i in xrange(20))
+        self.store.set_many(items)
+        self.assertEquals(self.store.get_many(items.keys()), items)
+        # Overwriting works, and missing userids are left out.
+        self.store.set_many([("user1", "NEW"), ("user2", "NEW")])
+        self.assertEquals(self.store.get_many(["user1", "user2", "user99"]),
+                          {"user1": "NEW", "user2": "NEW"})
+        # A userid repeated within a batch gets the last of its values.
+        self.store.set_many([("user1", "ONE"), ("user2", "TWO"),
+                             ("user1", "LAST")])
+        self.assertEquals(self.store.get_many(["user1", "user2"]),
+                          {"user1": "LAST", "user2": "TWO"})
+        # Deleting only counts the userids that were actually present.
+        self.assertEquals(self.store.delete_many(["user%d" % (i,)
+                                                  for i in xrange(25)]), 20)
+        self.assertEquals(self.store.get_many(items.keys()), {})
+
+    def test_bulk_operations_with_native_upsert(self):
+        self._check_bulk_operations()
+
+    def test_bulk_operations_with_fallback_upsert(self):
+        self.store.engine_name = "unknown"
+        self._check_bulk_operations()
+
+    def test_engine_name_is_the_dialect_name(self):
+        store = SQLKeyRetrievalStorage("postgres://user@localhost/keys")
+        self.assertEquals(store.engine_name, "postgresql")
+        store = SQLKeyRetrievalStorage("mysql+pymysql://user@localhost/keys")
+        self.assertEquals(store.engine_name, "mysql")
+
+    def test_engine_and_tables_are_set_up_on_first_use(self):
+        os.unlink(self.dbfile)
+        store = SQLKeyRetrievalStorage("sqlite:///" + self.dbfile,
+                                       create_tables=True)
+        self.assertFalse(os.path.exists(self.dbfile))
+        self.assertEquals(store.engine_name, "sqlite")
+        self.assertFalse("pool_size" in store.get_pool_stats())
+        self.assertRaises(KeyError, store.get, "user1")
+        self.assertTrue(os.path.exists(self.dbfile))
+        os.unlink(self.dbfile)
+        store = SQLKeyRetrievalStorage("sqlite:///" + self.dbfile,
+                                       create_tables=True,
+                                       warm_up="background")
+        for i in xrange(100):
+            if store._engine_instance is not None:
+                break
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(self.dbfile))
+        self.assertRaises(KeyError, store.get, "user1")
+
+    def _make_batching_store(self):
+        store = SQLKeyRetrievalStorage("sqlite:///" + self.dbfile,
+                                       create_tables=True,
+                                       write_batch_size=20,
+                                       write_batch_delay=0.005)
+        self.commits = []
+        event.listen(store._engine, "commit",
+                     lambda conn: self.commits.append(conn))
+        return store
+
+    def test_batched_writes(self):
+        store = self._make_batching_store()
+        errors = []
+
+        def writer(n):
+            try:
+                for i in xrange(10):
+                    userid = "user%d" % (n,)
+                    version = store.set(userid, "DATA%d-%d" % (n, i))
+                    self.assertEquals(version,
+                                      compute_version("DATA%d-%d" % (n, i)))
+                    self.assertRaises(ConflictError, store.set, userid, "X",
+                                      if_match="bogus")
+                store.delete(userid, if_match=version)
+                self.assertRaises(KeyError, store.delete, userid)
+                store.set(userid, "FINAL", if_match=None)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in xrange(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        stats = store.get_pool_stats()
+        self.assertEquals(stats["batched_writes"], 460)
+        self.assertEquals(len(self.commits), stats["write_batches"])
+        self.assertTrue(len(self.commits) < 230, len(self.commits))
+        self.assertEquals(store.get_many(["user%d" % (n,)
+                                          for n in xrange(20)]),
+                          dict(("user%d" % (n,), "FINAL")
+                               for n in xrange(20)))
+
+    def test_batched_conditional_writes(self):
+        store = self._make_batching_store()
+        self.assertRaises(ConflictError, store.set, "user1", "ONE",
+                          if_match="*")
+        self.assertRaises(KeyError, store.delete, "user1")
+        self.assertRaises(ConflictError, store.delete, "user1", if_match="*")
+        version = store.set("user1", "ONE")
+        self.assertEquals(store.set("user1", "UNO", if_match="*"),
+                          compute_version("UNO"))
+        self.assertRaises(ConflictError, store.delete, "user1",
+                          if_match=version)
+        # Rows from before versioning can still be updated conditionally.
+        store.execute("UPDATE keydata SET version = NULL")
+        store.set("user1", "ONE", if_match=compute_version("UNO"))
+        self.assertEquals(store.get_version("user1"), version)
+        store.execute("UPDATE keydata SET version = NULL")
+        store.delete("user1", if_match=version)
+        self.assertRaises(KeyError, store.get, "user1")
+
+    def test_batched_write_to_a_row_from_before_versioning_can_conflict(self):
+        store = self._make_batching_store()
+        store.execute("INSERT INTO keydata (userid, data) "
+                      "VALUES ('user1', 'OLD')")
+
+        class RacingConnection(object):
+            # Another writer gets in just before the conditional update.
+            def __init__(self, connection):
+                self.connection = connection
+
+            def execute(self, query, *args, **kwds):
+                if "version IS NULL" in str(query):
+                    self.connection.execute("UPDATE keydata SET data = 'X', "
+                                            "version = 'OTHER'")
+                return self.connection.execute(query, *args, **kwds)
+
+        with store._transaction() as connection:
+            self.assertRaises(ConflictError, store._apply_write,
+                              RacingConnection(connection), "set", "user1",
+                              "NEW", compute_version("OLD"))
+        self.assertEquals(store.get("user1"), "X")
+
+    def test_failed_batches_are_retried_individually(self):
+        store = self._make_batching_store()
+        apply_write = store._apply_write
+
+        def failing_apply_write(connection, kind, userid, *args):
+            if userid == "user2":
+                raise OperationalError("INSERT", {}, "database is locked")
+            return apply_write(connection, kind, userid, *args)
+
+        store._apply_write = failing_apply_write
+        store.write_batcher.delay = 0.1
+        threads = [threading.Thread(target=store.set,
+                                    args=("user%d" % (n,), "DATA"))
+                   for n in xrange(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(store.get_pool_stats()["write_batches"], 1)
+        self.assertEquals(len(store.get_many(["user0", "user1", "user2"])),
+                          3)
+
+    def test_interrupted_batches_release_their_writers(self):
+        store = self._make_batching_store()
+        flush_writes = store._flush_writes
+
+        class Interrupted(BaseException):
+            pass
+
+        def interrupted_flush_writes(batch):
+            if not errors:
+                raise Interrupted()
+            return flush_writes(batch)
+
+        def writer(n):
+            try:
+                store.set("user%d" % (n,), "DATA")
+            except (Interrupted, BackendError), e:
+                errors.append(e)
+
+        errors = []
+        store.write_batcher.flush = interrupted_flush_writes
+        store.write_batcher.delay = 0.1
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in xrange(3)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.isAlive())
+        self.assertEquals(sorted(type(e).__name__ for e in errors),
+                          ["BackendError", "BackendError", "Interrupted"])
+        self.assertFalse(store.write_batcher._flushing)
+        # Later writes are flushed as usual.
+        store.set("user1", "DATA")
+        self.assertEquals(store.get("user1"), "DATA")
+
+
+class BinaryStorageTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.dbfile = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.sqluri = "sqlite:///" + self.dbfile
+        self.store = SQLKeyRetrievalStorage(self.sqluri, create_tables=True,
+                                            binary=True, warm_up=True)
+
+    def tearDown(self):
+        os.unlink(self.dbfile)
+
+    def test_bytes_are_stored_verbatim(self):
+        data = "\xff\x00\xfe" + u"\N{SNOWMAN}".encode("utf8")
+        version = self.store.set("user1", data)
+        self.assertEquals(version, compute_version(data))
+        stored = self.store.get("user1")
+        self.assertEquals(stored, data)
+        self.assertTrue(isinstance(stored, str))
+        self.store.set("user1", "NEW", version)
+        self.assertEquals(self.store.get("user1"), "NEW")
+        # Unicode is stored as its utf8 encoding.
+        self.store.set("user2", u"\N{SNOWMAN}")
+        self.assertEquals(self.store.get("user2"),
+                          u"\N{SNOWMAN}".encode("utf8"))
+        self.store.set_many([("user3", data), ("user4", "\x02XYZ")])
+        self.assertEquals(self.store.get_many(["user3", "user4"]),
+                          {"user3": data, "user4": "\x02XYZ"})
+
+    def test_compressed_values_skip_base64(self):
+        data = '{"key": "%s"}' % ("A" * 1000,)
+        encoded = encode_data(data, compress=True, binary=True)
+        self.assertEquals(encoded[:1], "\x03")
+        self.assertTrue(len(encoded) <
+                        len(encode_data(data, compress=True)))
+        self.assertEquals(decode_data(encoded), data)
+        self.store.compress = True
+        self.store.set("user1", data)
+        row = self.store.execute("SELECT data FROM keydata").fetchone()
+        self.assertEquals(str(row[0]), encoded)
+        self.assertEquals(self.store.get("user1"), data)
+        gzipped, version, is_gzipped = self.store.get_with_version("user1",
+                                                                   True)
+        self.assertTrue(is_gzipped)
+        self.assertEquals(version, compute_version(data))
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(gzipped)).read(),
+                          data)
+
+    def test_converting_a_text_column_to_binary(self):
+        os.unlink(self.dbfile)
+        data = '{"key": "%s"}' % ("A" * 1000,)
+        store = SQLKeyRetrievalStorage(self.sqluri, create_tables=True,
+                                       compress=True)
+        store.set_many([("user1", u"\N{SNOWMAN}"), ("user2", data)])
+        store.convert_to_binary()
+        store = SQLKeyRetrievalStorage(self.sqluri, binary=True)
+        self.assertEquals(store.get_many(["user1", "user2"]),
+                          {"user1": u"\N{SNOWMAN}".encode("utf8"),
+                           "user2": data})
+        # Re-encoding strips the base64 from compressed rows.
+        store.compress = True
+        self.assertEquals(store.reencode(), 1)
+        self.assertEquals(store.get("user2"), data)
+        self.assertEquals(store.get_version("user2"), compute_version(data))
+
+    def test_request_bodies_are_stored_and_served_as_bytes(self):
+        settings = {
+            "storage.backend":
+                "keyretrieval.storage.sql:SQLKeyRetrievalStorage",
+            "storage.sqluri": self.sqluri,
+            "storage.binary": True,
+            "multiauth.policies": "remoteuser",
+            "multiauth.policy.remoteuser.use":
+                "pyramid.authentication.RemoteUserAuthenticationPolicy",
+        }
+        app = main({}, **settings)
+        data = "\xe2\x98\x83" * 2730
+        # Send the body as an unbuffered stream, as a real server would.
+        request = Request.blank("/user1", method="PUT")
+        request.environ["REMOTE_USER"] = "user1"
+        request.environ["wsgi.input"] = StringIO(data)
+        request.environ.pop("webob.is_body_seekable", None)
+        request.content_length = len(data)
+        request.content_type = "text/plain"
+        self.assertEquals(request.get_response(app).status_int, 204)
+        self.assertEquals(self.store.get("user1"), data)
+        request = Request.blank("/user1")
+        request.environ["REMOTE_USER"] = "user1"
+        response = request.get_response(app)
+        self.assertEquals(response.body, data)
+        self.assertEquals(response.etag, compute_version(data))
+        # A body shorter than its content-length is rejected.
+        request = Request.blank("/user1", method="PUT")
+        request.environ["REMOTE_USER"] = "user1"
+        request.environ["wsgi.input"] = StringIO("SHORT")
+        request.environ.pop("webob.is_body_seekable", None)
+        request.content_length = 10
+        request.content_type = "text/plain"
+        self.assertEquals(request.get_response(app).status_int, 400)
+
+
+class ExpiryTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.dbfile = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.store = SQLKeyRetrievalStorage("sqlite:///" + self.dbfile,
+                                            create_tables=True,
+                                            warm_up=True, expiry_ttl=100,
+                                            access_resolution=3600,
+                                            access_batch_size=3,
+                                            access_flush_interval=1000,
+                                            batch_size=3)
+
+    def tearDown(self):
+        os.unlink(self.dbfile)
+
+    def _age(self, seconds, userid=None):
+        query = "UPDATE keydata SET accessed = accessed - :age, " \
+                "expires = expires - :age"
+        if userid is not None:
+            query += " WHERE userid = :userid"
+        self.store.execute(query, age=seconds, userid=userid)
+
+    def test_rows_expire_unless_accessed(self):
+        self.store.set("user1", "DATA1")
+        self.store.set("user2", "DATA2")
+        self.store.set("user3", "DATA3")
+        # Writes set the access time themselves.
+        self.assertEquals(self.store.access_updates, 0)
+        self.assertEquals(self.store.purge_expired(), 0)
+        self._age(7200)
+        # Reading a row with a stale access time keeps it alive.
+        self.assertEquals(self.store.get("user2"), "DATA2")
+        self.assertEquals(self.store.get_version("user3"),
+                          compute_version("DATA3"))
+        self.assertEquals(self.store.purge_expired(), 1)
+        self.assertRaises(KeyError, self.store.get, "user1")
+        self.assertEquals(self.store.get_many(["user2", "user3"]),
+                          {"user2": "DATA2", "user3": "DATA3"})
+        self.assertEquals(self.store.get_pool_stats()["expired_purged"], 1)
+
+    def test_access_times_are_sampled_and_batched(self):
+        updates = []
+
+        def count_updates(conn, cursor, statement, *args):
+            if statement.startswith("UPDATE"):
+                updates.append(statement)
+
+        self.store.set_many(("user%d" % (i,), "DATA") for i in xrange(5))
+        self._age(7200)
+        event.listen(self.store._engine, "before_cursor_execute",
+                     count_updates)
+        for i in xrange(5):
+            self.store.get("user%d" % (i,))
+        # The first three accesses are written in a single batch.
+        self.assertEquals(len(updates), 1)
+        self.assertEquals(self.store.access_updates, 3)
+        self.assertEquals(self.store.flush_accesses(), 2)
+        # Recently-recorded accesses aren't recorded again.
+        for i in xrange(5):
+            self.store.get("user%d" % (i,))
+        self.assertEquals(self.store.flush_accesses(), 0)
+        self.assertEquals(len(updates), 2)
+        # Nor is anything recorded with a sample rate of zero.
+        self._age(7200)
+        self.store.access_sample_rate = 0
+        for i in xrange(5):
+            self.store.get("user%d" % (i,))
+        self.assertEquals(self.store.flush_accesses(), 0)
+
+    def test_purging_in_batches(self):
+        self.store.set_many(("user%d" % (i,), "DATA") for i in xrange(10))
+        # Rows written before expiry was enabled are given an expiry time
+        # when first purged.
+        self.store.execute("UPDATE keydata SET accessed = NULL, "
+                           "expires = NULL")
+        self.assertEquals(self.store.purge_expired(), 0)
+        self.store.execute("UPDATE keydata SET expires = expires - 200")
+        self.assertEquals(self.store.purge_expired(limit=4), 4)
+        self.assertEquals(self.store.purge_expired(), 6)
+        self.assertEquals(self.store.get_many(["user%d" % (i,)
+                                               for i in xrange(10)]), {})
+
+    def _check_writes_renew_the_expiry_time(self, store):
+        store.set_many([("user1", "OLD"), ("user2", "OLD"), ("user3", "OLD"),
+                        ("user4", "OLD"), ("user5", "OLD")])
+        self.store.execute("UPDATE keydata SET accessed = 0, expires = 100")
+        store.access_batch_size = 100
+        store.set("user1", "NEW")
+        store.set("user2", "NEW", if_match=compute_version("OLD"))
+        store.set("user3", "NEW", if_match="*")
+        store.set_many([("user4", "NEW")])
+        store.set_raw_many([("user5", "NEW", compute_version("NEW"))])
+        # Another process purging can't see any accesses queued by this one.
+        other_store = SQLKeyRetrievalStorage("sqlite:///" + self.dbfile,
+                                             expiry_ttl=100)
+        self.assertEquals(other_store.purge_expired(), 0)
+        self.assertEquals(store.get_many(["user%d" % (i,)
+                                          for i in xrange(1, 6)]),
+                          dict(("user%d" % (i,), "NEW")
+                               for i in xrange(1, 6)))
+
+    def test_writes_renew_the_expiry_time(self):
+        self._check_writes_renew_the_expiry_time(self.store)
+
+    def test_writes_renew_the_expiry_time_with_fallback_upsert(self):
+        self.store.engine_name = "unknown"
+        self._check_writes_renew_the_expiry_time(self.store)
+
+    def test_batched_writes_renew_the_expiry_time(self):
+        store = SQLKeyRetrievalStorage("sqlite:///" + self.dbfile,
+                                       expiry_ttl=100, write_batch_size=10,
+                                       write_batch_delay=0)
+        store.engine_name = "unknown"
+        self._check_writes_renew_the_expiry_time(store)
+
+    def test_accesses_are_flushed_in_the_background(self):
+        self.store.set("user1", "DATA1")
+        self._age(7200)
+        self.store.access_flush_interval = 0.05
+        self.assertEquals(self.store.get("user1"), "DATA1")
+        for i in xrange(100):
+            if self.store.access_updates:
+                break
+            time.sleep(0.01)
+        self.assertEquals(self.store.access_updates, 1)
+
+    def test_only_one_process_purges_in_the_background(self):
+        lockfile = self.dbfile + ".lock"
+        self.assertRaises(ValueError, SQLKeyRetrievalStorage,
+                          "sqlite:///" + self.dbfile, expiry_ttl=100,
+                          purge_interval=1000)
+        stores = [SQLKeyRetrievalStorage("sqlite:///" + self.dbfile,
+                                         expiry_ttl=100, purge_interval=1000,
+                                         purge_lock_file=lockfile)
+                  for i in xrange(2)]
+        try:
+            lock = stores[0]._acquire_purge_lock()
+            self.assertNotEquals(lock, None)
+            self.assertEquals(stores[1]._acquire_purge_lock(), None)
+            lock.close()
+            lock = stores[1]._acquire_purge_lock()
+            self.assertNotEquals(lock, None)
+            lock.close()
+        finally:
+            os.unlink(lockfile)
+
+    def test_purging_through_a_cache(self):
+        cache = CachingKeyRetrievalStorage(self.store)
+        cache.set("user1", "DATA1")
+        self.assertEquals(cache.get("user1"), "DATA1")
+        self.store.flush_accesses()
+        self._age(7200)
+        self.assertEquals(cache.purge_expired(), 1)
+        self.assertRaises(KeyError, cache.get, "user1")
+
+
+class ReplicaStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sqluris = ["sqlite:///" + os.path.join(self.tmpdir, name)
+                        for name in ("primary.db", "replica1.db",
+                                     "replica2.db")]
+        for sqluri in self.sqluris:
+            SQLKeyRetrievalStorage(sqluri, create_tables=True).warm_up()
+        self.store = SQLKeyRetrievalStorage(self.sqluris[0],
+                                            replica_sqluris=" ".join(
+                                                self.sqluris[1:]),
+                                            replica_sticky_time=0.1,
+                                            replica_retry_time=0.1)
+        # Write different data to each database, so we can tell which
+        # one a read was served from.
+        for sqluri, name in zip(self.sqluris, ("P", "R1", "R2")):
+            SQLKeyRetrievalStorage(sqluri).set_many({"user1": name,
+                                                     "user2": name})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reads_are_spread_over_replicas(self):
+        reads = [self.store.get("user1") for i in xrange(4)]
+        self.assertEquals(sorted(reads), ["R1", "R1", "R2", "R2"])
+        self.assertTrue(self.store.get_version("user1") in
+                        (compute_version("R1"), compute_version("R2")))
+        self.assertTrue(self.store.get_many(["user1", "user2"]) in
+                        ({"user1": "R1", "user2": "R1"},
+                         {"user1": "R2", "user2": "R2"}))
+        self.assertEquals(self.store.get_pool_stats()["replica_reads"], 6)
+
+    def test_reads_after_writes_go_to_the_primary(self):
+        self.store.set("user1", "NEW")
+        self.assertEquals(self.store.get("user1"), "NEW")
+        self.assertEquals(self.store.get_version("user1"),
+                          compute_version("NEW"))
+        self.assertEquals(self.store.get_many(["user1", "user2"]),
+                          {"user1": "NEW", "user2": "P"})
+        self.assertTrue(self.store.get("user2").startswith("R"))
+        time.sleep(0.15)
+        self.assertTrue(self.store.get("user1").startswith("R"))
+        # Conditional writes check the version on the primary.
+        self.store.set("user1", "NEWER", if_match=compute_version("NEW"))
+        self.store.delete_many(["user2"])
+        self.assertRaises(KeyError, self.store.get, "user2")
+
+    def test_failover_from_broken_replicas(self):
+        os.unlink(self.sqluris[1][len("sqlite:///"):])
+        os.unlink(self.sqluris[2][len("sqlite:///"):])
+        os.mkdir(self.sqluris[2][len("sqlite:///"):])
+        reads = [self.store.get("user1") for i in xrange(4)]
+        self.assertEquals(reads, ["P", "P", "P", "P"])
+        stats = self.store.get_pool_stats()
+        self.assertEquals(stats["replica_failovers"], 2)
+        self.assertEquals(stats["replicas_down"], 2)
+        # Once the retry time has passed, replicas are tried again.
+        os.rmdir(self.sqluris[2][len("sqlite:///"):])
+        SQLKeyRetrievalStorage(self.sqluris[2],
+                               create_tables=True).set("user1", "R2")
+        time.sleep(0.15)
+        reads = [self.store.get("user1") for i in xrange(4)]
+        self.assertEquals(reads, ["R2", "R2", "R2", "R2"])
+        stats = self.store.get_pool_stats()
+        self.assertEquals(stats["replica_failovers"], 3)
+        self.assertEquals(stats["replicas_down"], 1)
+
+    def test_writes_are_seen_by_other_processes_sharing_a_sticky_file(self):
+        stickyfile = os.path.join(self.tmpdir, "sticky")
+        stores = [SQLKeyRetrievalStorage(self.sqluris[0],
+                                         replica_sqluris=self.sqluris[1:],
+                                         replica_sticky_time=0.1,
+                                         replica_sticky_file=stickyfile)
+                  for i in xrange(2)]
+        stores[0].set("user1", "NEW")
+        self.assertEquals(stores[1].get("user1"), "NEW")
+        self.assertEquals(stores[1].get_many(["user1", "user2"]),
+                          {"user1": "NEW", "user2": "P"})
+        self.assertTrue(stores[1].get("user2").startswith("R"))
+        time.sleep(0.15)
+        self.assertTrue(stores[1].get("user1").startswith("R"))
+
+
+class ShardedStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.dbfiles = []
+        for i in xrange(3):
+            fd, dbfile = tempfile.mkstemp(suffix=".db")
+            os.close(fd)
+            self.dbfiles.append(dbfile)
+        self.sqluris = ["sqlite:///" + dbfile for dbfile in self.dbfiles]
+
+    def tearDown(self):
+        for dbfile in self.dbfiles:
+            os.unlink(dbfile)
+
+    def _make_store(self, num_shards):
+        return ShardedSQLKeyRetrievalStorage(self.sqluris[:num_shards],
+                                             create_tables=True,
+                                             batch_size=10)
+
+    def test_every_shard_is_purged(self):
+        lockfile = self.dbfiles[0] + ".lock"
+        stores = [ShardedSQLKeyRetrievalStorage(self.sqluris, expiry_ttl=100,
+                                                purge_interval=1000,
+                                                purge_lock_file=lockfile)
+                  for i in xrange(2)]
+        locks = []
+        try:
+            for shard in stores[0].shards:
+                locks.append(shard._acquire_purge_lock())
+                self.assertNotEquals(locks[-1], None)
+            for shard in stores[1].shards:
+                self.assertEquals(shard._acquire_purge_lock(), None)
+        finally:
+            for lock in locks:
+                if lock is not None:
+                    lock.close()
+            for shard in stores[0].shards:
+                os.unlink(shard.purge_lock_file)
+
+    def test_users_are_spread_across_shards(self):
+        store = self._make_store(3)
+        items = dict(("user%d" % (i,), "DATA%d" % (i,)) for i in xrange(60))
+        store.set_many(items)
+        self.assertEquals(store.get_many(items.keys()), items)
+        for shard in store.shards:
+            shard_items = list(shard.iter_items())
+            self.assertTrue(0 < len(shard_items) < 60)
+            for userid, data in shard_items:
+                self.assertTrue(store.get_shard(userid) is shard)
+                self.assertEquals(store.get(userid), data)
+        store.delete("user1")
+        self.assertRaises(KeyError, store.get, "user1")
+        self.assertEquals(store.delete_many(items.keys()), 59)
+
+    def test_rebalance_after_adding_a_shard(self):
+        store = self._make_store(2)
+        items = dict(("user%d" % (i,), "DATA%d" % (i,)) for i in xrange(60))
+        store.set_many(items)
+        store = self._make_store(3)
+        to_move = rebalance(store, dry_run=True)
+        self.assertTrue(0 < to_move < 60)
+        self.assertEquals(rebalance(store), to_move)
+        self.assertEquals(rebalance(store), 0)
+        self.assertEquals(store.get_many(items.keys()), items)
+        self.assertEquals(len(list(store.shards[2].iter_items())), to_move)
+
+    def test_rebalance_keeps_data_written_to_the_new_shard(self):
+        store = self._make_store(2)
+        items = dict(("user%d" % (i,), "DATA%d" % (i,)) for i in xrange(60))
+        store.set_many(items)
+        store = self._make_store(3)
+        moving = [userid for userid in items
+                  if store.get_shard(userid) is store.shards[2]]
+        # A client writes to the new shard before the move gets there.
+        store.set(moving[0], "NEWER")
+        items[moving[0]] = "NEWER"
+        self.assertEquals(rebalance(store), len(moving))
+        self.assertEquals(store.get_many(items.keys()), items)
+
+
+class ArchiveTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmpdir, "keydata.archive")
+        self.source_uri = "sqlite:///" + os.path.join(self.tmpdir, "src.db")
+        self.target_uri = "sqlite:///" + os.path.join(self.tmpdir, "dst.db")
+        self.source = SQLKeyRetrievalStorage(self.source_uri, batch_size=7,
+                                             create_tables=True)
+        self.target = SQLKeyRetrievalStorage(self.target_uri, batch_size=7,
+                                             create_tables=True)
+        self.items = dict(("user%02d@example.com" % (i,),
+                           u"DATA\t%d\u2603" % (i,)) for i in xrange(50))
+        self.items["END"] = "odd\nuserid"
+        self.source.set_many(self.items)
+        # Compressed values should be copied without being unpacked.
+        self.source.compress = True
+        self.source.set("squashy", "X" * 1000)
+        self.items["squashy"] = "X" * 1000
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _assertCopied(self, target=None):
+        target = target or self.target
+        self.assertEquals(target.get_many(self.items.keys()), self.items)
+        self.assertEquals(target.get_version("user01@example.com"),
+                          self.source.get_version("user01@example.com"))
+        self.assertEquals(target._get_raw("squashy"),
+                          self.source._get_raw("squashy"))
+
+    def test_export_and_import(self):
+        self.assertEquals(export_archive(self.source, self.archive), 52)
+        self.assertEquals(import_archive(self.target, self.archive), 52)
+        self._assertCopied()
+        self.assertEquals(sorted(os.listdir(self.tmpdir)),
+                          ["dst.db", "keydata.archive", "src.db"])
+
+    def test_corrupted_archives_are_rejected(self):
+        export_archive(self.source, self.archive)
+        with open(self.archive) as f:
+            lines = f.readlines()
+        corruptions = [
+            lines[:-1],
+            lines[:-1] + [lines[-1][:-1]],
+            lines[:10] + lines[11:],
+            lines[:10] + [lines[10].replace("user", "resu")] + lines[11:],
+            lines + ["junk\n"],
+            ["bogus\n"] + lines[1:],
+        ]
+        for corrupted in corruptions:
+            with open(self.archive, "w") as f:
+                f.writelines(corrupted)
+            self.assertRaises(ArchiveError,
+                              import_archive, self.target, self.archive)
+            if os.path.exists(self.archive + ".import-checkpoint"):
+                os.unlink(self.archive + ".import-checkpoint")
+
+    def test_resuming_from_a_checkpoint(self):
+        # Interrupt the export partway through reading the table, and
+        # check that it picks up from the last checkpoint.
+        rows = list(self.source.iter_raw_rows())
+        calls = []
+
+        def iter_raw_rows(start=None, end=None):
+            calls.append(start)
+            for row in rows:
+                if start is None or row[0] > start:
+                    if len(calls) == 1 and row[0] == "user30@example.com":
+                        raise RuntimeError("interrupted")
+                    yield row
+
+        self.source.iter_raw_rows = iter_raw_rows
+        self.assertRaises(RuntimeError,
+                          export_archive, self.source, self.archive)
+        self.assertTrue(os.path.exists(self.archive + ".checkpoint"))
+        self.assertEquals(export_archive(self.source, self.archive), 52)
+        self.assertEquals(calls, [None, "user25@example.com"])
+        self.assertFalse(os.path.exists(self.archive + ".checkpoint"))
+        # Now do the same for the import.
+        set_raw_many = self.target.set_raw_many
+        imported = []
+        failures = []
+
+        def failing_set_raw_many(batch):
+            if len(imported) == 3 and not failures:
+                failures.append(batch)
+                raise RuntimeError("interrupted")
+            imported.append(batch[0][0])
+            set_raw_many(batch)
+
+        self.target.set_raw_many = failing_set_raw_many
+        self.assertRaises(RuntimeError,
+                          import_archive, self.target, self.archive)
+        self.assertTrue(os.path.exists(self.archive + ".import-checkpoint"))
+        self.assertEquals(import_archive(self.target, self.archive), 52)
+        self.assertEquals(len(imported), 8)
+        self.assertEquals(len(set(imported)), 8)
+
+    def test_export_and_import_of_a_binary_column(self):
+        source_uri = "sqlite:///" + os.path.join(self.tmpdir, "binsrc.db")
+        target_uri = "sqlite:///" + os.path.join(self.tmpdir, "bindst.db")
+        source = SQLKeyRetrievalStorage(source_uri, batch_size=7,
+                                        create_tables=True, binary=True)
+        target = SQLKeyRetrievalStorage(target_uri, batch_size=7,
+                                        create_tables=True, binary=True)
+        items = {"text": u"DATA\u2603".encode("utf8"),
+                 "bytes": "\xff\xfe\x00\x80 not utf8"}
+        source.set_many(items)
+        # Compressed values are stored as raw deflated bytes.
+        source.compress = True
+        source.set("squashy", "\xff" * 1000)
+        items["squashy"] = "\xff" * 1000
+        self.assertEquals(export_archive(source, self.archive), 3)
+        self.assertEquals(import_archive(target, self.archive), 3)
+        self.assertEquals(target.get_many(items.keys()), items)
+        self.assertEquals(target._get_raw("squashy"),
+                          source._get_raw("squashy"))
+        self.assertEquals(target.get_version("bytes"),
+                          source.get_version("bytes"))
+
+    def test_parallel_export_and_import(self):
+        filenames = export_parallel(self.source_uri, self.archive, 3,
+                                    batch_size=7)
+        self.assertEquals(len(filenames), 3)
+        self.assertEquals(import_parallel(self.target_uri, filenames, 2,
+                                          batch_size=7), 52)
+        self._assertCopied()
+
+
+class CachingStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLKeyRetrievalStorage("sqlite://", create_tables=True)
+        self.store = CachingKeyRetrievalStorage(self.backend,
+                                                cache_max_items=2,
+                                                cache_max_bytes=10)
+
+    def test_hits_are_served_with_the_cached_version(self):
+        self.backend.set("user1", "ONE")
+        self.assertEquals(self.store.get_with_version("user1"),
+                          ("ONE", compute_version("ONE"), False))
+        orig_compute_version = cache_module.compute_version
+        cache_module.compute_version = None
+        try:
+            self.assertEquals(self.store.get_with_version("user1"),
+                              ("ONE", compute_version("ONE"), False))
+            self.assertEquals(self.store.get_version("user1"),
+                              compute_version("ONE"))
+        finally:
+            cache_module.compute_version = orig_compute_version
+        self.assertEquals(self.store.get_stats()["hits"], 2)
+
+    def test_read_through_and_write_through(self):
+        self.backend.set("user1", "ONE")
+        self.assertEquals(self.store.get("user1"), "ONE")
+        self.assertEquals(self.store.get("user1"), "ONE")
+        self.assertEquals(self.store.get_stats()["misses"], 1)
+        self.assertEquals(self.store.get_stats()["hits"], 1)
+        # Writes through the cache are immediately visible.
+        self.store.set("user1", "TWO")
+        self.assertEquals(self.store.get("user1"), "TWO")
+        self.assertEquals(self.store.get_stats()["misses"], 1)
+        # Writes behind its back are not, until invalidated.
+        self.backend.set("user1", "THREE")
+        self.assertEquals(self.store.get("user1"), "TWO")
+        self.store.cache.invalidate("user1")
+        self.assertEquals(self.store.get("user1"), "THREE")
+
+    def test_negative_caching(self):
+        self.assertRaises(KeyError, self.store.get, "user1")
+        self.backend.set("user1", "ONE")
+        self.assertRaises(KeyError, self.store.get, "user1")
+        self.assertEquals(self.store.get_stats()["negative_hits"], 1)
+        self.store.cache_miss_ttl = 0
+        self.store.cache.clear()
+        self.assertRaises(KeyError, self.store.delete, "user2")
+        self.assertEquals(self.store.get("user1"), "ONE")
+        self.store.delete("user1")
+        self.assertRaises(KeyError, self.store.get, "user1")
+
+    def test_eviction_by_count_and_size(self):
+        for userid in ("user1", "user2", "user3"):
+            self.store.set(userid, "DATA")
+        self.assertEquals(len(self.store.cache), 2)
+        self.assertEquals(self.store.cache.get("user1"), None)
+        self.store.set("user4", "LARGEDATA")
+        self.assertEquals(len(self.store.cache), 1)
+        self.assertEquals(self.store.cache.total_bytes, 9)
+        # Items larger than the whole cache are never stored.
+        self.store.set("user5", "X" * 11)
+        self.assertEquals(self.store.cache.get("user5"), None)
+        self.assertEquals(self.store.get("user5"), "X" * 11)
+
+    def test_bulk_operations(self):
+        self.backend.set("user1", "ONE")
+        self.assertRaises(KeyError, self.store.get, "user2")
+        self.assertEquals(self.store.get_many(["user1", "user2"]),
+                          {"user1": "ONE"})
+        self.assertEquals(self.store.get_stats()["negative_hits"], 1)
+        self.store.set_many({"user1": "NEW", "user2": "TWO"})
+        self.assertEquals(self.store.get_many(["user1", "user2"]),
+                          {"user1": "NEW", "user2": "TWO"})
+        self.assertEquals(self.store.delete_many(["user1", "user3"]), 1)
+        self.assertRaises(KeyError, self.store.get, "user1")
+
+    def test_concurrent_read_cannot_cache_stale_data(self):
+        # A read that misses just as a write starts, and fetches the old
+        # data, must not cache it once the write has finished.
+        stored = {"user1": "OLD"}
+        writing, write_go = threading.Event(), threading.Event()
+        read_done, read_go = threading.Event(), threading.Event()
+
+        class InterleavedBackend(object):
+            def get(self, userid):
+                value = stored[userid]
+                read_done.set()
+                read_go.wait(5)
+                return value
+
+            def set(self, userid, data, if_match=None):
+                writing.set()
+                write_go.wait(5)
+                stored[userid] = data
+
+        store = CachingKeyRetrievalStorage(InterleavedBackend())
+        writer = threading.Thread(target=store.set, args=("user1", "NEW"))
+        writer.start()
+        writing.wait()
+        reader = threading.Thread(target=store.get, args=("user1",))
+        reader.start()
+        read_done.wait()
+        write_go.set()
+        writer.join()
+        read_go.set()
+        reader.join()
+        self.assertEquals(store.cache.get("user1")[0], "NEW")
+
+    def test_loading_wrapped_backend_by_name(self):
+        store = CachingKeyRetrievalStorage(
+                    "keyretrieval.storage.sql:SQLKeyRetrievalStorage",
+                    sqluri="sqlite://", create_tables=True)
+        self.assertTrue(isinstance(store.storage, SQLKeyRetrievalStorage))
+        store.set("user1", "ONE")
+        self.assertEquals(store.get("user1"), "ONE")
+
+
+class SharedCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "cache")
+        self.sqluri = "sqlite:///" + os.path.join(self.tmpdir, "keys.db")
+        SQLKeyRetrievalStorage(self.sqluri, create_tables=True).warm_up()
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _make_cache(self, max_items=8):
+        self.caches.append(SharedMemoryCache(self.filename, max_items))
+        return self.caches[-1]
+
+    def _make_store(self):
+        store = CachingKeyRetrievalStorage(
+                    "keyretrieval.storage.sql:SQLKeyRetrievalStorage",
+                    cache_shared_file=self.filename, cache_max_items=8,
+                    sqluri=self.sqluri)
+        self.caches.append(store.cache)
+        return store
+
+    def test_values_are_shared(self):
+        cache, other_cache = self._make_cache(), self._make_cache()
+        self.assertTrue(cache.put("user1", "DATA", 4, 10))
+        self.assertTrue(cache.put("user2", u"\N{SNOWMAN}", 1, 10))
+        self.assertTrue(cache.put("user3", MISSING, 0, 10))
+        self.assertEquals(other_cache.get("user1"), "DATA")
+        self.assertEquals(other_cache.get("user2"), u"\N{SNOWMAN}")
+        self.assertTrue(other_cache.get("user3") is MISSING)
+        self.assertEquals(other_cache.get("user4"), None)
+        self.assertEquals(len(other_cache), 3)
+        # Values can be stored along with their version.
+        self.assertTrue(cache.put("user5", (u"\N{SNOWMAN}", u"V1"), 1, 10))
+        self.assertEquals(other_cache.get("user5"), (u"\N{SNOWMAN}", "V1"))
+        self.assertFalse(cache.put("user5", ("DATA", "V" * 65), 4, 10))
+        other_cache.invalidate("user5")
+        # Values must fit in a slot.
+        self.assertFalse(cache.put("user4", "X" * 8193, 8193, 10))
+        self.assertTrue(cache.put("user4", "X" * 8192, 8192, 10))
+        # Expired values are not returned.
+        cache.put("user1", "DATA", 4, -1)
+        self.assertEquals(other_cache.get("user1"), None)
+        other_cache.clear()
+        self.assertEquals(cache.get("user4"), None)
+
+    def test_invalidation_discards_concurrent_puts(self):
+        cache, other_cache = self._make_cache(), self._make_cache()
+        cache.put("user1", "OLD", 3, 10)
+        generation = cache.generation
+        other_cache.invalidate("user1")
+        self.assertEquals(cache.get("user1"), None)
+        self.assertFalse(cache.put("user1", "OLD", 3, 10, generation))
+        self.assertTrue(cache.put("user1", "NEW", 3, 10, cache.generation))
+        self.assertEquals(other_cache.get("user1"), "NEW")
+
+    def test_layout_must_match(self):
+        cache = self._make_cache(max_items=8)
+        cache.put("user1", "DATA", 4, 10)
+        self.assertRaises(ValueError, self._make_cache, max_items=16)
+        self.assertEquals(self._make_cache(max_items=7).get("user1"), "DATA")
+        # Once no process is using it, the file is laid out afresh.
+        for cache in self.caches:
+            cache.close()
+        self.caches = []
+        cache = self._make_cache(max_items=16)
+        self.assertEquals(cache.max_items, 16)
+        self.assertEquals(cache.get("user1"), None)
+        cache.put("user1", "DATA", 4, 10)
+        self.assertEquals(self._make_cache(max_items=16).get("user1"),
+                          "DATA")
+
+    def test_eviction_from_full_sets(self):
+        cache = self._make_cache(max_items=4)
+        for i in xrange(5):
+            cache.put("user%d" % (i,), "DATA", 4, 10 + i)
+        self.assertEquals(cache.evictions, 1)
+        self.assertEquals(len(cache), 4)
+        self.assertEquals(cache.get("user0"), None)
+        # Overwriting a key reuses its slot.
+        cache.put("user4", "NEW", 3, 10)
+        self.assertEquals(cache.evictions, 1)
+        self.assertEquals(cache.get("user4"), "NEW")
+
+    def test_slots_being_written_are_not_read(self):
+        cache = self._make_cache()
+        cache.put("user1", "DATA", 4, 10)
+        offset = [offset for offset in cache._get_offsets("user1")[1]
+                  if cache._read_slot(offset, "user1") is not None][0]
+        seq = cache.SEQUENCE.unpack_from(cache._map, offset)[0]
+        cache.SEQUENCE.pack_into(cache._map, offset, seq + 1)
+        self.assertEquals(cache.get("user1"), None)
+        # The next writer recovers the slot.
+        cache.put("user1", "NEW", 3, 10)
+        self.assertEquals(cache.get("user1"), "NEW")
+
+    def test_writes_in_other_processes_invalidate_the_cache(self):
+        store = self._make_store()
+        store.set("user1", "ONE")
+        self.assertEquals(store.get("user1"), "ONE")
+        self.assertRaises(KeyError, store.get, "user2")
+
+        def write():
+            other_store = self._make_store()
+            other_store.set("user1", "TWO")
+            other_store.set("user2", "TWO")
+
+        child = multiprocessing.Process(target=write)
+        child.start()
+        child.join()
+        self.assertEquals(child.exitcode, 0)
+        self.assertEquals(store.get("user1"), "TWO")
+        self.assertEquals(store.get("user2"), "TWO")
+        # Both were served from what the other process cached.
+        self.assertEquals(store.get_stats()["misses"], 1)
+
+
+class SharedSlotTableTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "table")
+        self.tables = []
+
+    def tearDown(self):
+        for table in self.tables:
+            table.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _make_table(self, slots=8, magic="TESTING1"):
+        self.tables.append(SharedSlotTable(self.filename, magic, 8, slots,
+                                           size_setting="test_slots"))
+        return self.tables[-1]
+
+    def test_slots_are_shared(self):
+        table, other_table = self._make_table(), self._make_table()
+        offset = table.offset_for("user1")
+        self.assertEquals(offset, other_table.offset_for(u"user1"))
+        self.assertTrue(table.header_size <= offset < table.offset(8))
+        with table.locked(offset, 8):
+            table.map[offset:offset + 8] = "ABCDEFGH"
+        self.assertEquals(other_table.map[offset:offset + 8], "ABCDEFGH")
+
+    def test_layout_must_match(self):
+        table = self._make_table()
+        offset = table.offset(0)
+        table.map[offset:offset + 8] = "ABCDEFGH"
+        try:
+            self._make_table(slots=16)
+        except ValueError, e:
+            self.assertTrue("test_slots" in str(e))
+        else:
+            self.fail("a different layout should have been refused")
+        self.assertRaises(ValueError, self._make_table, magic="TESTING2")
+        # Once no process is using it, the file is laid out afresh.
+        table.close()
+        self.tables = []
+        table = self._make_table(slots=16)
+        self.assertEquals(table.map[offset:offset + 8], "\0" * 8)
+
+    def test_each_table_checks_its_layout(self):
+        tables = ((SharedSequenceTable, "changes.shared_slots"),
+                  (SharedBucketStore, "ratelimit.shared_slots"),
+                  (SharedStickyTable, None))
+        for cls, setting in tables:
+            filename = os.path.join(self.tmpdir, cls.__name__)
+            self.tables.append(cls(filename, slots=1000))
+            try:
+                cls(filename, slots=2000)
+            except ValueError, e:
+                if setting is not None:
+                    self.assertTrue(setting in str(e))
+            else:
+                self.fail("%s accepted a different layout" % (cls,))
+            self.tables.append(cls(filename, slots=1000))
+
+
+class LogStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = LogKeyRetrievalStorage(self.tmpdir)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _reopen(self, crash=False, **kwds):
+        if crash:
+            # Drop the log without saving the index, as if killed.
+            self.store._buf.close()
+            os.close(self.store._fd)
+            self.store._fd = None
+        else:
+            self.store.close()
+        self.store = LogKeyRetrievalStorage(self.tmpdir, **kwds)
+
+    def test_get_set_delete_cycle(self):
+        self.assertRaises(KeyError, self.store.get, "user1")
+        version = self.store.set("user1", u"ONE\u2603")
+        self.assertEquals(version, compute_version(u"ONE\u2603"))
+        self.assertEquals(self.store.get("user1"), u"ONE\u2603")
+        self.assertEquals(self.store.get_version("user1"), version)
+        self.assertEquals(self.store.get_with_version("user1", True),
+                          (u"ONE\u2603", version, False))
+        self.store.set("user2", "TWO\xff")
+        self.assertEquals(self.store.get("user2"), "TWO\xff")
+        self.assertRaises(ConflictError, self.store.set, "user1", "X",
+                          if_match="bogus")
+        self.assertRaises(ConflictError, self.store.set, "user3", "X",
+                          if_match="*")
+        self.store.set("user1", "UNO", if_match=version)
+        self.assertRaises(ConflictError, self.store.delete, "user1",
+                          if_match=version)
+        self.store.delete("user1", if_match=compute_version("UNO"))
+        self.assertRaises(KeyError, self.store.get, "user1")
+        self.assertRaises(KeyError, self.store.delete, "user1")
+        self.assertRaises(ConflictError, self.store.delete, "user1",
+                          if_match="*")
+        self.store.set_many({"user1": "ONE", "user3": "THREE"})
+        self.assertEquals(self.store.get_many(["user1", "user3", "user4"]),
+                          {"user1": "ONE", "user3": "THREE"})
+        self.assertEquals(self.store.delete_many(["user1", "user4"]), 1)
+        self.assertEquals(self.store.get_stats()["items"], 2)
+
+    def test_recovery_after_restart(self):
+        self.store.set_many(("user%d" % (i,), "DATA%d" % (i,))
+                            for i in xrange(100))
+        self.store.delete("user5")
+        self._reopen()
+        self.assertTrue(os.path.exists(self.store.index_file))
+        self.assertEquals(self.store.get("user7"), "DATA7")
+        self.assertRaises(KeyError, self.store.get, "user5")
+        # Writes since the index was saved are found by scanning the log.
+        self.store.set("user7", "SEVEN")
+        self.store.delete("user8")
+        self._reopen(crash=True)
+        self.assertEquals(self.store.get("user7"), "SEVEN")
+        self.assertRaises(KeyError, self.store.get, "user8")
+        self.assertEquals(self.store.get_stats()["items"], 98)
+        # A stale or corrupt index is ignored.
+        with open(self.store.index_file, "r+b") as f:
+            f.seek(100)
+            f.write("XXXX")
+        self._reopen(crash=True)
+        self.assertEquals(self.store.get("user7"), "SEVEN")
+        self.assertEquals(self.store.get_stats()["items"], 98)
+
+    def test_torn_writes_are_truncated(self):
+        self.store.set("user1", "ONE")
+        self.store.set("user2", "TWO")
+        size = self.store.get_stats()["log_bytes"]
+        self.store.set("user1", "UNO")
+        self.store.set("user3", "THREE")
+        self._reopen(crash=True)
+        with open(self.store.log_file, "r+b") as f:
+            f.seek(size + 10)
+            f.write("X")
+        self._reopen(crash=True)
+        self.assertEquals(self.store.get("user1"), "ONE")
+        self.assertRaises(KeyError, self.store.get, "user3")
+        self.assertEquals(self.store.get_stats()["log_bytes"], size)
+        self.assertTrue(self.store.truncated_bytes > 0)
+        self.store.set("user3", "THREE")
+        self._reopen(crash=True)
+        self.assertEquals(self.store.get("user3"), "THREE")
+
+    def test_log_can_only_be_opened_once(self):
+        self.assertRaises(RuntimeError, LogKeyRetrievalStorage, self.tmpdir)
+
+    def test_compaction(self):
+        self._reopen(compact_min_bytes=20000, compact_ratio=0.5)
+        self.store.set_many(("user%d" % (i,), "X" * 100)
+                            for i in xrange(100))
+        errors = []
+
+        def writer(n):
+            try:
+                for i in xrange(200):
+                    self.store.set("user%d" % (n,), "DATA%d-%d" % (n, i))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        if self.store._compactor is not None:
+            self.store._compactor.join()
+        self.store.compact()
+        stats = self.store.get_stats()
+        self.assertTrue(stats["compactions"] > 1, stats)
+        self.assertEquals(stats["dead_bytes"], 0)
+        # Writers share fsyncs rather than each doing their own.
+        self.assertTrue(stats["syncs"] < 2001, stats)
+        for n in xrange(100):
+            expected = "DATA%d-199" % (n,) if n < 10 else "X" * 100
+            self.assertEquals(self.store.get("user%d" % (n,)), expected)
+        self._reopen()
+        self.assertEquals(self.store.get("user3"), "DATA3-199")
+        self.assertEquals(self.store.get_stats()["log_bytes"],
+                          stats["log_bytes"])
+
+
+class CoalescingStorageTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.dbfile = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.backend = SQLKeyRetrievalStorage("sqlite:///" + self.dbfile,
+                                              create_tables=True)
+        self.store = CoalescingKeyRetrievalStorage(self.backend,
+                                                   coalesce_writes=True)
+        self.queries = []
+
+        # Slow down every query, so that concurrent calls overlap.
+        def before_cursor_execute(conn, cursor, statement, *args):
+            self.queries.append(statement.split()[0].upper())
+            time.sleep(0.01)
+        event.listen(self.backend._engine, "before_cursor_execute",
+                     before_cursor_execute)
+
+    def tearDown(self):
+        os.unlink(self.dbfile)
+
+    def _run_threads(self, func, num_threads=20):
+        errors = []
+
+        def run(n):
+            try:
+                func(n)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(n,))
+                   for n in xrange(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_reads_are_coalesced(self):
+        self.backend.set("user1", "ONE")
+        del self.queries[:]
+
+        def reader(n):
+            for i in xrange(10):
+                self.assertEquals(self.store.get("user1"), "ONE")
+                self.assertRaises(KeyError, self.store.get, "user2")
+
+        self.assertEquals(self._run_threads(reader), [])
+        stats = self.store.get_stats()
+        self.assertEquals(stats["reads"], 400)
+        self.assertEquals(len(self.queries),
+                          stats["reads"] - stats["coalesced_reads"])
+        self.assertTrue(len(self.queries) < 100, len(self.queries))
+
+    def test_concurrent_writes_are_coalesced(self):
+        def writer(n):
+            for i in xrange(10):
+                version = self.store.set("user1", "DATA%d-%d" % (n, i))
+                self.assertEquals(len(version), 32)
+
+        self.assertEquals(self._run_threads(writer), [])
+        stats = self.store.get_stats()
+        self.assertEquals(stats["writes"], 200)
+        num_upserts = self.queries.count("INSERT")
+        self.assertEquals(num_upserts,
+                          stats["writes"] - stats["coalesced_writes"])
+        self.assertTrue(num_upserts < 100, num_upserts)
+        self.assertTrue(self.store.get("user1").endswith("-9"))
+
+    def test_conditional_writes_are_not_merged(self):
+        def writer(n):
+            if n % 2:
+                self.store.set("user1", "DATA%d" % (n,))
+            else:
+                self.store.set("user1", "DATA%d" % (n,),
+                               if_match="no-such-version")
+
+        errors = self._run_threads(writer, num_threads=10)
+        self.assertEquals(len(errors), 5)
+        for error in errors:
+            self.assertTrue(isinstance(error, ConflictError))
+        self.store.set("user1", "ONE")
+        self.store.delete("user1")
+        self.assertRaises(KeyError, self.store.get, "user1")
+
+    def test_reads_after_a_write_see_the_write(self):
+        self.store.set("user1", "ONE")
+        self.assertEquals(self.store.get("user1"), "ONE")
+        results = []
+        reader = threading.Thread(
+            target=lambda: results.append(self.store.get("user1")))
+        reader.start()
+        time.sleep(0.002)
+        self.store.set("user1", "TWO")
+        self.assertEquals(self.store.get("user1"), "TWO")
+        self.assertEquals(self.store.get_version("user1"),
+                          compute_version("TWO"))
+        reader.join()
+        self.assertEquals(len(results), 1)
+
+    def test_interrupted_calls_release_their_waiters(self):
+        started, go = threading.Event(), threading.Event()
+
+        class Interrupted(BaseException):
+            pass
+
+        class InterruptedBackend(object):
+            def get(self, userid, *args):
+                started.set()
+                go.wait(5)
+                raise Interrupted()
+
+            set = get
+
+        store = CoalescingKeyRetrievalStorage(InterruptedBackend(),
+                                              coalesce_writes=True)
+        for call in (lambda: store.get("user1"),
+                     lambda: store.set("user1", "DATA")):
+            started.clear()
+            go.clear()
+            errors = []
+
+            def leader():
+                try:
+                    call()
+                except Interrupted, e:
+                    errors.append(e)
+
+            def follower():
+                try:
+                    call()
+                except BackendError, e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=leader)]
+            threads[0].start()
+            started.wait(5)
+            threads.extend(threading.Thread(target=follower)
+                           for i in xrange(2))
+            for thread in threads[1:]:
+                thread.daemon = True
+                thread.start()
+            time.sleep(0.05)
+            go.set()
+            for thread in threads:
+                thread.join(5)
+                self.assertFalse(thread.isAlive())
+            self.assertEquals(len(errors), 3)
+            self.assertEquals(store._reads, {})
+            self.assertEquals(store._writes, {})
+
+
+class GeventStorageTests(unittest.TestCase):
+    def setUp(self):
+        try:
+            from keyretrieval.storage.green import GeventKeyRetrievalStorage
+        except ImportError:
+            raise SkipTest("gevent is not installed")
+        fd, self.dbfile = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        backend = SQLKeyRetrievalStorage("sqlite:///" + self.dbfile,
+                                         create_tables=True)
+        self.store = GeventKeyRetrievalStorage(backend, threadpool_size=4)
+
+    def tearDown(self):
+        os.unlink(self.dbfile)
+
+    def test_many_concurrent_greenlets(self):
+        import gevent
+        version = self.store.set("user1", "ONE")
+        self.assertEquals(self.store.get_version("user1"), version)
+        self.assertRaises(KeyError, self.store.get, "user2")
+        self.assertRaises(ConflictError, self.store.set, "user1", "TWO",
+                          "WRONG")
+        greenlets = [gevent.spawn(self.store.get, "user1")
+                     for i in xrange(200)]
+        gevent.joinall(greenlets)
+        self.assertEquals(set(g.value for g in greenlets), set(["ONE"]))
+        self.store.delete("user1")
+        self.assertEquals(self.store.get_many(["user1"]), {})
+
+    def test_statements_in_the_threadpool_are_counted(self):
+        settings = {
+            "storage.backend":
+                "keyretrieval.storage.green:GeventKeyRetrievalStorage",
+            "storage.wraps":
+                "keyretrieval.storage.sql:SQLKeyRetrievalStorage",
+            "storage.sqluri": "sqlite:///" + self.dbfile,
+            "multiauth.policies": "remoteuser",
+            "multiauth.policy.remoteuser.use":
+                "pyramid.authentication.RemoteUserAuthenticationPolicy",
+            "metrics.enabled": "true",
+        }
+        app = main({}, **settings)
+        self.store.set("user1", "ONE")
+        request = Request.blank("/user1", environ={"REMOTE_USER": "user1"})
+        self.assertEquals(request.get_response(app).status_int, 200)
+        stats = app.registry["metrics"].get_stats()["histograms"]
+        buckets = stats["sql.statements_per_request"]["buckets"]
+        self.assertEquals(buckets["1"], 1)
+
+    def test_no_threadpool_under_monkey_patching(self):
+        threads = []
+
+        class RecordingBackend(object):
+            def get(self, userid):
+                threads.append(threading.current_thread())
+
+        self.store.storage = RecordingBackend()
+        # The tests run unpatched, so storage calls use the thread pool.
+        self.assertTrue(self.store.use_threadpool)
+        self.store.get("user1")
+        self.store.use_threadpool = False
+        self.store.get("user1")
+        self.assertNotEquals(threads[0], threading.current_thread())
+        self.assertEquals(threads[1], threading.current_thread())
+
+    def test_threadpool_use_is_decided_on_first_call(self):
+        from gevent import monkey
+        from keyretrieval.storage.green import GeventKeyRetrievalStorage
+        store = GeventKeyRetrievalStorage(self.store.storage)
+        # As when gunicorn --preload loads the app before the gevent
+        # worker applies its monkey-patching.
+        patched = [True]
+        orig_is_module_patched = monkey.is_module_patched
+        monkey.is_module_patched = lambda name: patched[0]
+        try:
+            self.assertRaises(KeyError, store.get, "user1")
+            self.assertFalse(store.use_threadpool)
+            patched[0] = False
+            self.assertFalse(store.use_threadpool)
+        finally:
+            monkey.is_module_patched = orig_is_module_patched
+        store = GeventKeyRetrievalStorage(self.store.storage,
+                                          use_threadpool="false")
+        self.assertFalse(store.use_threadpool)
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.settimeout(1)
+        settings = {
+            "storage.backend":
+                "keyretrieval.storage.sql:SQLKeyRetrievalStorage",
+            "storage.sqluri": "sqlite://",
+            "storage.create_tables": True,
+            "storage.warm_up": True,
+            "multiauth.policies": "remoteuser",
+            "multiauth.policy.remoteuser.use":
+                "pyramid.authentication.RemoteUserAuthenticationPolicy",
+            "metrics.enabled": "true",
+            "metrics.statsd_host": "127.0.0.1",
+            "metrics.statsd_port": self.listener.getsockname()[1],
+            "metrics.prefix": "test",
+            "metrics.expose_endpoint": "true",
+        }
+        self.app = main({}, **settings)
+
+    def tearDown(self):
+        self.listener.close()
+
+    def _request(self, path, method="GET", body=None):
+        request = Request.blank(path, method=method)
+        request.environ["REMOTE_USER"] = "user1"
+        if body is not None:
+            request.body = body
+            request.content_type = "text/plain"
+        return request.get_response(self.app)
+
+    def _received_metrics(self):
+        metrics = {}
+        try:
+            while True:
+                packet = self.listener.recv(1024)
+                name, value = packet.split(":", 1)
+                metrics.setdefault(name, []).append(value)
+        except socket.timeout:
+            pass
+        return metrics
+
+    def test_metrics_are_sent_to_statsd(self):
+        self.assertEquals(self._request("/user1", "PUT", "DATA").status_int,
+                          204)
+        self.assertEquals(self._request("/user1").status_int, 200)
+        self.assertEquals(self._request("/user2").status_int, 403)
+        self.assertEquals(self._request("/user1", "DELETE").status_int, 204)
+        self.assertEquals(self._request("/user1").status_int, 404)
+        self.listener.settimeout(0.2)
+        metrics = self._received_metrics()
+        self.assertEquals(len(metrics["test.request.username.GET"]), 3)
+        put_timings = metrics["test.request.username.PUT"]
+        self.assertTrue(put_timings[0].endswith("|ms"))
+        self.assertEquals(len(metrics["test.storage.get_with_version"]), 2)
+        self.assertEquals(
+            metrics["test.storage.get_with_version.error.KeyError"], ["1|c"])
+        self.assertEquals(metrics["test.error.HTTPNotFound"], ["1|c"])
+        self.assertEquals(metrics["test.response.403"], ["1|c"])
+        self.assertEquals(metrics["test.payload.request_bytes"], ["4|h"])
+        self.assertEquals(sorted(metrics["test.sql.statements_per_request"]),
+                          ["0|h", "1|h", "1|h", "1|h", "1|h"])
+
+    def test_metrics_endpoint(self):
+        self._request("/user1", "PUT", "DATA")
+        request = Request.blank("/__metrics__",
+                                environ={"REMOTE_ADDR": "127.0.0.1"})
+        res = request.get_response(self.app)
+        self.assertEquals(res.status_int, 200)
+        stats = json.loads(res.body)
+        self.assertEquals(stats["counters"]["response.204"], 1)
+        timings = stats["histograms"]["request.username.PUT"]
+        self.assertEquals(timings["count"], 1)
+        # Only local clients connecting directly can see the metrics.
+        request = Request.blank("/__metrics__",
+                                environ={"REMOTE_ADDR": "192.0.2.1"})
+        self.assertEquals(request.get_response(self.app).status_int, 403)
+        request = Request.blank("/__metrics__",
+                                environ={"REMOTE_ADDR": "127.0.0.1"},
+                                headers={"X-Forwarded-For": "192.0.2.1"})
+        self.assertEquals(request.get_response(self.app).status_int, 403)
+
+    def test_component_stats(self):
+        settings = dict(self.app.registry.settings)
+        settings["storage.backend"] = \
+            "keyretrieval.storage.cache:CachingKeyRetrievalStorage"
+        settings["storage.wraps"] = \
+            "keyretrieval.storage.sql:SQLKeyRetrievalStorage"
+        self.app = main({}, **settings)
+        verifier = CachingVerifier(StubVerifier())
+        verifier.verify("user1@example.com:%d" % (time.time() * 1000 + 1e6))
+
+        class Plugin(object):
+            pass
+
+        class APIFactory(object):
+            authenticators = [("browserid", Plugin())]
+
+        APIFactory.authenticators[0][1].verifier = verifier
+        self.app.registry.registerUtility(APIFactory(), IAPIFactory)
+        self._request("/user1", "PUT", "DATA")
+        self._request("/user1")
+        self.listener.settimeout(0.2)
+        metrics = self._received_metrics()
+        # Only the first request sends the gauges, within the interval.
+        self.assertEquals(metrics["test.storage.cache.misses"], ["0|g"])
+        self.assertEquals(metrics["test.storage.pool.retries"], ["0|g"])
+        self.assertEquals(metrics["test.verifier.misses"], ["1|g"])
+        self.assertTrue("test.storage.pool.checkout_wait_ms.count" in metrics)
+        request = Request.blank("/__metrics__",
+                                environ={"REMOTE_ADDR": "127.0.0.1"})
+        stats = json.loads(request.get_response(self.app).body)
+        components = stats["components"]
+        self.assertEquals(components["storage.cache"]["hits"], 1)
+        self.assertEquals(components["storage.pool"]["timeouts"], 0)
+        self.assertEquals(components["verifier"]["misses"], 1)
+
+
+class RateLimitTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = {
+            "storage.backend":
+                "keyretrieval.storage.sql:SQLKeyRetrievalStorage",
+            "storage.sqluri": "sqlite://",
+            "storage.create_tables": True,
+            "multiauth.policies": "remoteuser",
+            "multiauth.policy.remoteuser.use":
+                "pyramid.authentication.RemoteUserAuthenticationPolicy",
+            "ratelimit.enabled": "true",
+            "ratelimit.user_rate": "0.5",
+            "ratelimit.user_burst": "2",
+            "ratelimit.endpoint_rate": "0.5",
+            "ratelimit.endpoint_burst": "3",
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _request(self, app, path, method="GET", body=None):
+        request = Request.blank(path, method=method)
+        request.environ["REMOTE_USER"] = path.split("/")[1]
+        if body is not None:
+            request.body = body
+            request.content_type = "text/plain"
+        return request.get_response(app)
+
+    def _check_bucket_store(self, store, other_store=None):
+        self.assertEquals(store.consume("key1", 0.5, 2), 0)
+        self.assertEquals(store.consume("key1", 0.5, 2), 0)
+        wait = store.consume("key1", 0.5, 2)
+        self.assertTrue(1.9 < wait <= 2, wait)
+        self.assertEquals(store.consume("key2", 0.5, 2), 0)
+        # Buckets refill over time.
+        self.assertEquals(store.consume("key3", 100, 1), 0)
+        self.assertNotEquals((other_store or store).consume("key3", 100, 1),
+                             0)
+        time.sleep(0.02)
+        self.assertEquals(store.consume("key3", 100, 1), 0)
+
+    def test_local_bucket_store(self):
+        self._check_bucket_store(LocalBucketStore())
+        # Evicted buckets start again full.
+        store = LocalBucketStore(max_keys=1)
+        store.consume("key1", 0.5, 1)
+        store.consume("key2", 0.5, 1)
+        self.assertEquals(store.consume("key1", 0.5, 1), 0)
+
+    def test_shared_bucket_store(self):
+        filename = os.path.join(self.tmpdir, "buckets")
+        store = SharedBucketStore(filename, slots=1000)
+        other_store = SharedBucketStore(filename, slots=1000)
+        try:
+            self._check_bucket_store(store, other_store)
+            self.assertNotEquals(other_store.consume("key1", 0.5, 2), 0)
+        finally:
+            store.close()
+            other_store.close()
+
+    def test_requests_are_rejected_before_touching_storage(self):
+        app = main({}, **self.settings)
+        store = app.registry.getUtility(IKeyRetrievalStorage)
+        self.assertEquals(self._request(app, "/user1", "PUT", "1").status_int,
+                          204)
+        self.assertEquals(self._request(app, "/user1", "PUT", "2").status_int,
+                          204)
+        res = self._request(app, "/user1", "PUT", "3")
+        self.assertEquals(res.status_int, 429)
+        self.assertEquals(res.headers["Retry-After"], "2")
+        self.assertEquals(store.get("user1"), "2")
+        # Other users have their own limits, up to the endpoint's limit.
+        for userid in ("user2", "user3", "user4"):
+            self.assertEquals(self._request(app, "/" + userid).status_int,
+                              404)
+        res = self._request(app, "/user5")
+        self.assertEquals(res.status_int, 429)
+        self.assertEquals(app.registry["ratelimiter"].rejections, 2)
+
+    def test_each_route_has_its_own_endpoint_limit(self):
+        self.settings["changes.enabled"] = "true"
+        app = main({}, **self.settings)
+        for userid in ("user1", "user2", "user3"):
+            self.assertEquals(self._request(app, "/" + userid).status_int,
+                              404)
+        self.assertEquals(self._request(app, "/user4").status_int, 429)
+        # Polling for changes doesn't use up the tokens for fetching keys.
+        for userid in ("user5", "user6", "user7"):
+            res = self._request(app, "/%s/changes" % (userid,))
+            self.assertEquals(res.status_int, 200)
+        res = self._request(app, "/user8/changes")
+        self.assertEquals(res.status_int, 429)
+
+    def test_limits_can_be_shared_between_processes(self):
+        self.settings["ratelimit.shared_file"] = os.path.join(self.tmpdir,
+                                                              "buckets")
+        self.settings["ratelimit.shared_slots"] = "1000"
+        app1 = main({}, **self.settings)
+        app2 = main({}, **self.settings)
+        self.assertEquals(self._request(app1, "/user1").status_int, 404)
+        self.assertEquals(self._request(app2, "/user1").status_int, 404)
+        self.assertEquals(self._request(app1, "/user1").status_int, 429)
+        self.assertEquals(self._request(app2, "/user1").status_int, 429)
+
+
+class ChangeFeedTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = {
+            "storage.backend":
+                "keyretrieval.storage.sql:SQLKeyRetrievalStorage",
+            "storage.sqluri": "sqlite://",
+            "storage.create_tables": True,
+            "multiauth.policies": "remoteuser",
+            "multiauth.policy.remoteuser.use":
+                "pyramid.authentication.RemoteUserAuthenticationPolicy",
+            "changes.enabled": "true",
+            "changes.timeout": "5",
+        }
+        self.closeables = []
+
+    def tearDown(self):
+        for closeable in self.closeables:
+            closeable.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _request(self, app, path, method="GET", body=None, headers={}):
+        request = Request.blank(path, method=method, headers=headers)
+        request.environ["REMOTE_USER"] = "user1"
+        if body is not None:
+            request.body = body
+            request.content_type = "text/plain"
+        return request.get_response(app)
+
+    def _make_shared_feed(self):
+        sequences = SharedSequenceTable(os.path.join(self.tmpdir, "seqs"),
+                                        slots=1000)
+        pubsub = SocketPubSub(os.path.join(self.tmpdir, "pubsub"))
+        self.closeables.extend((sequences, pubsub))
+        return ChangeFeed(sequences, pubsub, recheck_interval=60)
+
+    def _wait_in_thread(self, feed, userid, since, timeout=5):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+                                  feed.wait(userid, since, timeout)))
+        thread.start()
+        return thread, results
+
+    def test_writes_bump_the_sequence(self):
+        feed = ChangeFeed(LocalSequenceTable(), LocalPubSub())
+        store = ChangeNotifyingKeyRetrievalStorage(
+                    SQLKeyRetrievalStorage("sqlite://", create_tables=True),
+                    feed)
+        store.set("user1", "ONE")
+        self.assertEquals(feed.get_sequence("user1"), 1)
+        self.assertRaises(ConflictError, store.set, "user1", "TWO", "WRONG")
+        self.assertRaises(KeyError, store.delete, "user2")
+        self.assertEquals(feed.get_sequence("user1"), 1)
+        self.assertEquals(feed.get_sequence("user2"), 0)
+        store.set_many([("user1", "TWO"), ("user2", "TWO")])
+        store.delete("user1")
+        self.assertEquals(feed.get_sequence("user1"), 3)
+        self.assertEquals(feed.get_sequence("user2"), 1)
+        # Failed bulk writes are still announced, since they may have
+        # written some of their userids before failing.
+
+        def fail(*args):
+            raise RuntimeError("failed")
+
+        store.storage.set_many = store.storage.delete_many = fail
+        self.assertRaises(RuntimeError, store.set_many, [("user2", "X")])
+        self.assertRaises(RuntimeError, store.delete_many, ["user2"])
+        self.assertEquals(feed.get_sequence("user2"), 3)
+
+    def test_waiting_for_changes(self):
+        feed = ChangeFeed(LocalSequenceTable(), LocalPubSub(),
+                          recheck_interval=60)
+        feed.changed("user1")
+        # No waiting if the sequence already differs, and a timeout if
+        # nothing changes.
+        self.assertEquals(feed.wait("user1", 0), 1)
+        self.assertEquals(feed.wait("user1", 1, timeout=0.05), 1)
+        # Waiters are woken by a change to their own userid only.
+        thread, results = self._wait_in_thread(feed, "user1", 1)
+        other_thread, other_results = self._wait_in_thread(feed, "user2", 0,
+                                                           timeout=0.5)
+        while feed.waiting < 2:
+            time.sleep(0.01)
+        start = time.time()
+        feed.changed("user1")
+        thread.join()
+        self.assertEquals(results, [2])
+        self.assertTrue(time.time() - start < 1)
+        other_thread.join()
+        self.assertEquals(other_results, [0])
+        self.assertEquals(feed.waiting, 0)
+
+    def test_changes_are_announced_between_processes(self):
+        feed, other_feed = self._make_shared_feed(), self._make_shared_feed()
+        other_feed.pubsub.start()
+        thread, results = self._wait_in_thread(other_feed, "user1", 0)
+        while other_feed.waiting < 1:
+            time.sleep(0.01)
+        start = time.time()
+        self.assertEquals(feed.changed("user1"), 1)
+        thread.join()
+        self.assertEquals(results, [1])
+        self.assertTrue(time.time() - start < 1)
+
+    def test_long_polling_endpoint(self):
+        app = main({}, **self.settings)
+        res = self._request(app, "/user1/changes")
+        self.assertEquals(json.loads(res.body), {"seq": 0})
+        res = self._request(app, "/user1/changes?since=0&timeout=0.05")
+        self.assertEquals(json.loads(res.body), {"seq": 0})
+        self.assertEquals(self._request(app, "/user1", "PUT", "DATA")
+                          .status_int, 204)
+        res = self._request(app, "/user1/changes?since=0")
+        self.assertEquals(json.loads(res.body), {"seq": 1})
+        res = self._request(app, "/user1/changes?since=x")
+        self.assertEquals(res.status_int, 400)
+        for timeout in ("x", "nan", "inf", "-inf", "0", "-1"):
+            res = self._request(app, "/user1/changes?since=1&timeout=" +
+                                timeout)
+            self.assertEquals(res.status_int, 400)
+        # Timeouts are cut down to the configured maximum.
+        app.registry["changes"].timeout = 0.05
+        res = self._request(app, "/user1/changes?since=1&timeout=1000")
+        self.assertEquals(json.loads(res.body), {"seq": 1})
+        res = self._request(app, "/user2/changes")
+        self.assertEquals(res.status_int, 403)
+
+    def test_event_stream_endpoint(self):
+        app = main({}, **self.settings)
+        self._request(app, "/user1", "PUT", "DATA")
+        res = self._request(app, "/user1/changes?timeout=0.05",
+                            headers={"Accept": "text/event-stream"})
+        self.assertEquals(res.content_type, "text/event-stream")
+        self.assertEquals(res.body, 'id: 1\ndata: {"seq": 1}\n\n')
+        # Reconnecting clients pick up where they left off.
+        self._request(app, "/user1", "DELETE")
+        res = self._request(app, "/user1/changes?timeout=0.05",
+                            headers={"Accept": "text/event-stream",
+                                     "Last-Event-ID": "1"})
+        self.assertEquals(res.body, 'id: 2\ndata: {"seq": 2}\n\n')
+
+    def test_event_streams_end_early_unless_streaming(self):
+        headers = {"Accept": "text/event-stream"}
+        app = main({}, **self.settings)
+        self.assertFalse(app.registry["changes"].can_stream())
+        start = time.time()
+        res = self._request(app, "/user1/changes", headers=headers)
+        self.assertEquals(res.body, 'id: 0\ndata: {"seq": 0}\n\n')
+        self.assertTrue(time.time() - start < 1)
+        self.settings["changes.streaming"] = "true"
+        app = main({}, **self.settings)
+        start = time.time()
+        res = self._request(app, "/user1/changes?timeout=0.1",
+                            headers=headers)
+        self.assertEquals(res.body, 'id: 0\ndata: {"seq": 0}\n\n')
+        self.assertTrue(time.time() - start >= 0.1)
+
+    def test_several_workers_need_a_shared_file(self):
+        self.settings["changes.workers"] = "4"
+        self.assertRaises(ConfigurationError, main, {}, **self.settings)
+        self.settings["changes.shared_file"] = os.path.join(self.tmpdir,
+                                                            "seqs")
+        app = main({}, **self.settings)
+        self.closeables.append(app.registry["changes"].sequences)
+        self.assertEquals(self._request(app, "/user1/changes").status_int,
+                          200)
+
+    def test_endpoint_is_missing_unless_enabled(self):
+        del self.settings["changes.enabled"]
+        app = main({}, **self.settings)
+        self.assertEquals(self._request(app, "/user1/changes").status_int,
+                          404)
+
+
+class StubVerifier(object):
+    """Verifier accepting assertions of the form "email" or "email:expires".
+
+    This performs no cryptographic checks whatsoever.  The expiry time, if
+    given, is in milliseconds since the epoch; by default assertions expire
+    in five minutes.  Assertions starting with "invalid" are rejected.
+    """
+
+    def __init__(self):
+        self.num_verifications = 0
+
+    def verify(self, assertion, audience=None):
+        self.num_verifications += 1
+        if assertion.startswith("invalid"):
+            raise ValueError("invalid assertion")
+        if ":" in assertion:
+            email, expires = assertion.rsplit(":", 1)
+            expires = int(expires)
+        else:
+            email = assertion
+            expires = int((time.time() + 5 * 60) * 1000)
+        return {"status": "okay", "email": email, "audience": audience,
+                "expires": expires}
+
+
+class CachingVerifierTests(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubVerifier()
+        self.verifier = CachingVerifier(self.stub, cache_max_items=2)
+
+    def test_repeat_verifications_are_cached(self):
+        data = self.verifier.verify("user1@example.com", "http://a.com")
+        self.assertEquals(data["email"], "user1@example.com")
+        data = self.verifier.verify("user1@example.com", "http://a.com")
+        self.assertEquals(data["email"], "user1@example.com")
+        self.assertEquals(self.stub.num_verifications, 1)
+        # Different audiences are verified separately.
+        self.verifier.verify("user1@example.com", "http://b.com")
+        self.assertEquals(self.stub.num_verifications, 2)
+        self.assertEquals(self.verifier.get_stats()["hits"], 1)
+        self.assertEquals(self.verifier.get_stats()["misses"], 2)
+        # Invalidating forces a re-verification.
+        self.verifier.invalidate("user1@example.com", "http://a.com")
+        self.verifier.verify("user1@example.com", "http://a.com")
+        self.assertEquals(self.stub.num_verifications, 3)
+
+    def test_counters_are_thread_safe(self):
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+
+        def verify():
+            for i in xrange(2000):
+                self.verifier.verify("user1@example.com")
+
+        try:
+            threads = [threading.Thread(target=verify) for i in xrange(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        stats = self.verifier.get_stats()
+        self.assertEquals(stats["hits"] + stats["misses"], 8000)
+
+    def test_cache_never_outlives_the_assertion(self):
+        expires = int((time.time() + 0.2) * 1000)
+        assertion = "user1@example.com:%d" % (expires,)
+        self.verifier.verify(assertion)
+        self.verifier.verify(assertion)
+        self.assertEquals(self.stub.num_verifications, 1)
+        time.sleep(0.3)
+        self.verifier.verify(assertion)
+        self.assertEquals(self.stub.num_verifications, 2)
+        # Already-expired results are not cached at all.
+        self.verifier.verify(assertion)
+        self.assertEquals(self.stub.num_verifications, 3)
+
+    def test_failures_are_not_cached(self):
+        self.assertRaises(ValueError, self.verifier.verify, "invalid")
+        self.assertRaises(ValueError, self.verifier.verify, "invalid")
+        self.assertEquals(self.stub.num_verifications, 2)
+        self.assertEquals(len(self.verifier.cache), 0)
+
+    def test_loading_wrapped_verifier_by_name(self):
+        verifier = CachingVerifier("keyretrieval.tests:StubVerifier",
+                                   cache_ttl="60")
+        self.assertTrue(isinstance(verifier.verifier, StubVerifier))
+        verifier.verify("user1@example.com")
+        verifier.verify("user1@example.com")
+        self.assertEquals(verifier.verifier.num_verifications, 1)
+
+    def test_caching_verifier_is_configured(self):
+        etc = os.path.join(os.path.dirname(__file__), "..", "etc")
+        for filename in ("keyretrieval-dev.ini", "keyretrieval-prod.ini"):
+            config = ConfigParser.RawConfigParser()
+            config.read(os.path.join(etc, filename))
+            verifier = config.get("who:plugin:browserid", "verifier")
+            self.assertTrue(resolve_name(verifier) is CachingVerifier)
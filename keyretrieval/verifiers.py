@@ -0,0 +1,136 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is keyretrieval.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Ryan Kelly (rkelly@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+BrowserID verifiers for use with the repoze.who browserid plugin.
+
+Verifying a BrowserID assertion is by far the most expensive part of a
+request, and devices tend to send the same assertion on every request
+until it expires.  CachingVerifier remembers the result of successful
+verifications so that repeat requests can skip it.  It is configured in
+the who plugin section like so::
+
+    [who:plugin:browserid]
+    use = repoze.who.plugins.browserid:make_plugin
+    verifier = keyretrieval.verifiers:CachingVerifier
+    verifier_wraps = vep:RemoteVerifier
+    verifier_cache_max_items = 10000
+    verifier_cache_ttl = 300
+
+Options for the wrapped verifier can be given with a "wraps_" prefix.
+
+"""
+
+import time
+import hashlib
+import threading
+
+from mozsvc.util import resolve_name
+
+from keyretrieval.storage.cache import LRUCache
+
+
+class CachingVerifier(object):
+    """BrowserID verifier that caches the results of another verifier.
+
+    Successful verifications are cached under a hash of the assertion and
+    audience, until the earlier of "cache_ttl" seconds from now and the
+    expiry time reported by the wrapped verifier.  Results without an
+    expiry time are never cached, and neither are failures.
+    """
+
+    def __init__(self, wraps, cache_max_items=10000, cache_ttl=300, **kwds):
+        if isinstance(wraps, basestring):
+            wraps_kwds = {}
+            for key, value in kwds.iteritems():
+                if key.startswith("wraps_"):
+                    wraps_kwds[key[len("wraps_"):]] = value
+            wraps = resolve_name(wraps)(**wraps_kwds)
+        self.verifier = wraps
+        self.cache_ttl = int(cache_ttl)
+        # Each cached result is small, so only the item count matters.
+        self.cache = LRUCache(int(cache_max_items), int(cache_max_items))
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get_stats(self):
+        """Get a dict of counters describing cache effectiveness."""
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "evictions": self.cache.evictions,
+            "items": len(self.cache),
+        }
+
+    def verify(self, assertion, audience=None):
+        key = self._get_cache_key(assertion, audience)
+        data = self.cache.get(key)
+        if data is not None:
+            self._count("hits")
+            return dict(data)
+        self._count("misses")
+        data = self.verifier.verify(assertion, audience)
+        # Expiry times in BrowserID are in milliseconds.
+        expires = data.get("expires")
+        if expires is not None:
+            ttl = min(self.cache_ttl, float(expires) / 1000 - time.time())
+            if ttl > 0:
+                self.cache.put(key, dict(data), 1, ttl)
+        return data
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def invalidate(self, assertion, audience=None):
+        """Remove any cached result for the given assertion."""
+        self.cache.invalidate(self._get_cache_key(assertion, audience))
+
+    def clear(self):
+        """Remove all cached results."""
+        self.cache.clear()
+
+    def _get_cache_key(self, assertion, audience):
+        if isinstance(audience, (list, tuple)):
+            audience = " ".join(audience)
+        key = "%s\n%s" % (assertion, audience or "")
+        if isinstance(key, unicode):
+            key = key.encode("utf8")
+        return hashlib.sha1(key).hexdigest()
+
@@ -34,16 +34,25 @@
 #
 # ***** END LICENSE BLOCK *****
 
+import math
+
 from pyramid.security import Allow
 from pyramid.response import Response
 from pyramid.httpexceptions import (HTTPNotFound,
+                                    HTTPBadRequest,
                                     HTTPUnsupportedMediaType,
                                     HTTPLengthRequired,
-                                    HTTPRequestEntityTooLarge)
+                                    HTTPRequestEntityTooLarge,
+                                    HTTPPreconditionFailed)
 
 from cornice import Service
 
-from keyretrieval.storage import IKeyRetrievalStorage
+from keyretrieval.storage import IKeyRetrievalStorage, ConflictError
+
+
+# Suffix added to the etags of gzipped responses, since they are a
+# different representation of the data than uncompressed ones.
+GZIP_ETAG_SUFFIX = "-gzip"
 
 
 def user_key_acl(request):
@@ -56,20 +65,153 @@ def user_key_acl(request):
     return [(Allow, username, "view"), (Allow, username, "edit")]
 
 
+def parse_etags(header):
+    """Parse an If-Match or If-None-Match header into a list of etags.
+
+    Weak etags are treated as strong ones, since we only ever generate
+    strong etags.  The suffix we add to etags of gzipped responses is
+    removed, leaving the plain version.  The special value "*" is returned
+    as-is.
+    """
+    etags = []
+    for etag in header.split(","):
+        etag = etag.strip()
+        if etag.startswith("W/"):
+            etag = etag[2:]
+        etag = etag.strip('"')
+        if etag.endswith(GZIP_ETAG_SUFFIX):
+            etag = etag[:-len(GZIP_ETAG_SUFFIX)]
+        if etag:
+            etags.append(etag)
+    return etags
+
+
+def find_matching_etag(header, version):
+    """Find the etag in an If-None-Match header matching the given version.
+
+    This returns the etag as the client sent it, including any gzip suffix,
+    so that a 304 response carries the same etag as the 200 response that
+    the client has cached.  The special value "*" matches any version, and
+    gives the plain version.  If nothing matches then None is returned.
+    """
+    for etag in header.split(","):
+        etag = etag.strip()
+        if etag.startswith("W/"):
+            etag = etag[2:]
+        etag = etag.strip('"')
+        if etag == "*":
+            return version
+        if etag in (version, version + GZIP_ETAG_SUFFIX):
+            return etag
+    return None
+
+
+def accepts_gzip(request):
+    """Check whether the client accepts gzip content-encoding."""
+    header = request.headers.get("Accept-Encoding")
+    if not header:
+        return False
+    for item in header.split(","):
+        params = item.split(";")
+        if params[0].strip().lower() not in ("gzip", "x-gzip"):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def read_body(request):
+    """Read the body of a request as a single bytestring.
+
+    Unless something has already buffered the body, it is read directly
+    from the WSGI input stream; request.body would first copy it into a
+    seekable buffer and then copy it again on the way out.
+    """
+    environ = request.environ
+    if environ.get("webob.is_body_seekable") or "wsgi.input" not in environ:
+        return request.body
+    body = environ["wsgi.input"].read(request.content_length)
+    if len(body) != request.content_length:
+        raise HTTPBadRequest()
+    return body
+
+
+def get_if_match(request, store):
+    """Get the version that a write request is conditional on, if any.
+
+    This returns None for an unconditional request, or a version (or "*")
+    to pass to the storage backend.  If the request lists several etags
+    then the current version is checked against all of them, and the
+    write is made conditional on it remaining unchanged.
+    """
+    header = request.headers.get("If-Match")
+    if not header:
+        return None
+    etags = parse_etags(header)
+    if "*" in etags:
+        return "*"
+    if len(etags) == 1:
+        return etags[0]
+    username = request.matchdict["username"]
+    try:
+        version = store.get_version(username)
+    except KeyError:
+        raise HTTPPreconditionFailed()
+    if version not in etags:
+        raise HTTPPreconditionFailed()
+    return version
+
+
 user_key = Service(name="user_key", path="/{username}", acl=user_key_acl)
 
 
 @user_key.get(permission="view")
 def get_key(request):
-    """Returns the uploaded key-retrieval information."""
+    """Returns the uploaded key-retrieval information.
+
+    If the request has an If-None-Match header then only the version is
+    read at first, and if it matches then a "304 Not Modified" response is
+    sent without reading the data at all.
+
+    If the client accepts gzip and the data is stored compressed, it is
+    sent as-is with a gzip content-encoding.  Data that the backend stores
+    as bytes is used directly as the response body, without re-encoding.
+    The data, its version and its encoding all come from a single read.
+    """
     username = request.matchdict["username"]
     store = request.registry.getUtility(IKeyRetrievalStorage)
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        try:
+            version = store.get_version(username)
+        except KeyError:
+            raise HTTPNotFound()
+        etag = find_matching_etag(if_none_match, version)
+        if etag is not None:
+            response = Response(status=304)
+            response.etag = etag
+            response.vary = ("Accept-Encoding",)
+            return response
     try:
-        key = store.get(username)
+        data, version, is_gzipped = store.get_with_version(
+                                        username, accepts_gzip(request))
     except KeyError:
         raise HTTPNotFound()
-    else:
-        return Response(key, content_type="text/plain")
+    etag = version
+    if is_gzipped:
+        etag += GZIP_ETAG_SUFFIX
+    response = Response(data, content_type="text/plain")
+    if is_gzipped:
+        response.content_encoding = "gzip"
+    response.etag = etag
+    response.vary = ("Accept-Encoding",)
+    return response
 
 
 @user_key.put(permission="edit")
@@ -87,18 +229,90 @@ def put_key(request):
     # Store the uploaded data.
     username = request.matchdict["username"]
     store = request.registry.getUtility(IKeyRetrievalStorage)
-    store.set(username, request.body)
-    return Response(status=204)
+    if_match = get_if_match(request, store)
+    try:
+        version = store.set(username, read_body(request), if_match)
+    except ConflictError:
+        raise HTTPPreconditionFailed()
+    response = Response(status=204)
+    response.etag = version
+    return response
 
 
 @user_key.delete(permission="edit")
 def delete_key(request):
-    """Delete any uploaded key-retrieval information."""
+    """Delete any uploaded key-retrieval information.
+
+    A conditional delete of missing data fails with "412 Precondition
+    Failed", even for "If-Match: *", rather than with a 404.
+    """
     username = request.matchdict["username"]
     store = request.registry.getUtility(IKeyRetrievalStorage)
+    if_match = get_if_match(request, store)
     try:
-        store.delete(username)
+        store.delete(username, if_match)
     except KeyError:
         raise HTTPNotFound()
+    except ConflictError:
+        raise HTTPPreconditionFailed()
     else:
         return Response(status=204)
+
+
+user_changes = Service(name="user_changes", path="/{username}/changes",
+                       acl=user_key_acl)
+
+
+@user_changes.get(permission="view")
+def get_changes(request):
+    """Waits for the uploaded key-retrieval information to change.
+
+    The response gives the change sequence number of the user's data as
+    JSON, e.g. {"seq": 3}.  If the "since" query parameter is given then
+    the response is held until the sequence number differs from it, or
+    until a timeout, so clients can loop on this instead of polling.  The
+    optional "timeout" parameter gives the longest to wait, in seconds,
+    which must be positive and is cut down to the configured maximum.
+
+    If the client accepts text/event-stream then each change is sent as a
+    server-sent event instead, with the sequence number as its id, until
+    the timeout expires; a reconnecting client's Last-Event-ID header is
+    used in place of "since".  Unless the feed can stream (see ChangeFeed)
+    the stream ends after its first event, so that it ties up a worker for
+    no longer than a long poll would.
+    """
+    feed = request.registry.get("changes")
+    if feed is None:
+        raise HTTPNotFound()
+    username = request.matchdict["username"]
+    since = request.GET.get("since", request.headers.get("Last-Event-ID"))
+    timeout = request.GET.get("timeout")
+    try:
+        if since is not None:
+            since = int(since)
+        if timeout is not None:
+            timeout = float(timeout)
+    except ValueError:
+        raise HTTPBadRequest()
+    if timeout is not None:
+        # NaN would get through min() and leave us waiting forever.
+        if math.isnan(timeout) or math.isinf(timeout) or timeout <= 0:
+            raise HTTPBadRequest()
+        timeout = min(timeout, feed.timeout)
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        max_events = None if feed.can_stream() else 1
+        changes = feed.iter_changes(username, since, timeout, max_events)
+        events = ("id: %d\ndata: {\"seq\": %d}\n\n" % (seq, seq)
+                  for seq in changes)
+        response = Response(content_type="text/event-stream",
+                            app_iter=events)
+        response.cache_control = "no-cache"
+        return response
+    if since is None:
+        seq = feed.get_sequence(username)
+    else:
+        seq = feed.wait(username, since, timeout)
+    response = Response('{"seq": %d}' % (seq,),
+                        content_type="application/json")
+    response.cache_control = "no-cache"
+    return response